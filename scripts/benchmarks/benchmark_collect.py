@@ -0,0 +1,97 @@
+"""Compare gathering the orm objects, counts and deletions from a mapped tree
+with a single iterative walk (Node.collect) against the original recursive
+functions, which built fresh lists and dicts at every node. The trees are
+synthetic: a root with lab orders each holding result items, every third
+record modified and every tenth staging a deletion.
+"""
+
+import time
+
+from ukrdc_cupid.core.store.models.structure import Node, RecordStatus
+
+# Config
+SIZES = [(100, 99), (1000, 99), (10000, 9)]  # (lab orders, result items each)
+REPEATS = 5
+STATUSES = [RecordStatus.NEW, RecordStatus.MODIFIED]
+
+
+class SyntheticNode(Node):
+    def __init__(self, n: int):
+        super().__init__(xml=None, orm_model=None)
+        self.orm_object = n
+        self.status = list(RecordStatus)[n % 3]
+        if n % 10 == 0:
+            self.deletions.append(n)
+
+    def sqla_mapped() -> None:
+        return None
+
+    def map_xml_to_orm(self, session) -> None:
+        pass
+
+
+def build_tree(lab_orders: int, result_items: int) -> Node:
+    n = 0
+    root = SyntheticNode(n)
+    for _ in range(lab_orders):
+        n += 1
+        lab_order = SyntheticNode(n)
+        for _ in range(result_items):
+            n += 1
+            lab_order.mapped_classes.append(SyntheticNode(n))
+        root.mapped_classes.append(lab_order)
+    return root
+
+
+def recursive_orm_list(node: Node, statuses: list):
+    # get_orm_list as it was before Node.collect
+    orm_objects = {status: [] for status in statuses}
+    counts = {status: 0 for status in RecordStatus}
+    counts[node.status] += 1
+    if node.status in statuses:
+        orm_objects[node.status].append(node.orm_object)
+
+    for child in node.mapped_classes:
+        child_objects, child_counts = recursive_orm_list(child, statuses)
+        for status in statuses:
+            orm_objects[status].extend(child_objects[status])
+        for status in RecordStatus:
+            counts[status] += child_counts[status]
+
+    return orm_objects, counts
+
+
+def recursive_deletions(node: Node) -> list:
+    # get_orm_deleted as it was before Node.collect
+    deletions = node.deletions
+    for child in node.mapped_classes:
+        deletions = deletions + recursive_deletions(child)
+    return deletions
+
+
+def recursive(tree: Node):
+    orm_objects, counts = recursive_orm_list(tree, STATUSES)
+    return orm_objects, counts, recursive_deletions(tree)
+
+
+def iterative(tree: Node):
+    collection = tree.collect(STATUSES)
+    return collection.orm_objects, collection.counts, collection.deletions
+
+
+def timed(func, tree: Node):
+    t0 = time.perf_counter()
+    for _ in range(REPEATS):
+        result = func(tree)
+    return result, (time.perf_counter() - t0) / REPEATS
+
+
+print(f"{'nodes':>8} {'recursive s':>12} {'iterative s':>12}")
+for lab_orders, result_items in SIZES:
+    tree = build_tree(lab_orders, result_items)
+    expected, recursive_time = timed(recursive, tree)
+    collected, iterative_time = timed(iterative, tree)
+    assert collected == expected
+
+    nodes = 1 + lab_orders * (result_items + 1)
+    print(f"{nodes:>8} {recursive_time:>12.4f} {iterative_time:>12.4f}")
@@ -0,0 +1,85 @@
+"""Write amplification of small edits to a patient's medication list with
+positional keys (pid:seq_no) and with content keys. Each edited file is
+diffed against the original the way a stored record would be: rows whose key
+is new are inserted, rows whose key has gone are deleted and rows whose key
+survives but whose columns differ are updated. Only one medication changes in
+each case, the other update is the file hash on the patient record, so
+anything more is churn.
+
+Mapping a new patient doesn't query the database so no server is needed.
+"""
+
+from sqlalchemy.orm import Session
+from synthetic_files import make_patient_file
+from ukrdc_cupid.core.parse.utils import load_xml_from_str
+from ukrdc_cupid.core.store.bulk import orm_to_row
+from ukrdc_cupid.core.store.models.structure import RecordStatus
+from ukrdc_cupid.core.store.models.ukrdc import PatientRecord
+
+# Config
+MEDICATIONS = 200
+
+START = "        <Medication>\n"
+END = "        </Medication>\n"
+
+
+def split_medications(xml_str: str):
+    head, rest = xml_str.split(START, 1)
+    end = rest.rindex(END) + len(END)
+    blocks = [START + block for block in rest[:end].split(START)]
+    return head, blocks, rest[end:]
+
+
+def join_medications(head: str, blocks: list, tail: str) -> str:
+    return head + "".join(blocks) + tail
+
+
+def mapped_rows(xml_str: str, content_keys: bool) -> dict:
+    patient_record = PatientRecord(
+        load_xml_from_str(xml_str), content_keys=content_keys
+    )
+    patient_record.map_to_database("1", "1", Session(), is_new=True)
+    rows = {}
+    for orm_object in patient_record.collect().orm_objects[RecordStatus.NEW]:
+        row = orm_to_row(orm_object)
+        rows[(orm_object.__tablename__, row.get("id"))] = row
+    return rows
+
+
+def writes(before: dict, after: dict):
+    inserted = after.keys() - before.keys()
+    deleted = before.keys() - after.keys()
+    updated = [
+        key for key in after.keys() & before.keys() if after[key] != before[key]
+    ]
+    return len(inserted), len(updated), len(deleted)
+
+
+original = make_patient_file(medications=MEDICATIONS)
+head, blocks, tail = split_medications(original)
+assert join_medications(head, blocks, tail) == original
+
+middle = MEDICATIONS // 2
+cases = {
+    "drop first": blocks[1:],
+    "drop middle": blocks[:middle] + blocks[middle + 1 :],
+    "drop last": blocks[:-1],
+    "move last to top": blocks[-1:] + blocks[:-1],
+}
+
+print(f"{MEDICATIONS} medications, rows inserted/updated/deleted")
+print(f"{'edit':>18} {'positional':>14} {'content':>14}")
+for content_keys in (False, True):
+    mapped_rows(original, content_keys)  # fill import time caches
+
+results = {}
+for content_keys in (False, True):
+    before = mapped_rows(original, content_keys)
+    for edit, edited_blocks in cases.items():
+        edited = join_medications(head, edited_blocks, tail)
+        results[edit, content_keys] = writes(before, mapped_rows(edited, content_keys))
+
+for edit in cases:
+    positional = "/".join(str(n) for n in results[edit, False])
+    content = "/".join(str(n) for n in results[edit, True])
+    print(f"{edit:>18} {positional:>14} {content:>14}")
@@ -0,0 +1,96 @@
+"""Per record cost of mapping the columns of observations and result items
+with the compiled field specs (Node.map_fields) against the equivalent
+add_item and add_code call for each column, which is how every node was
+mapped before. Each is timed writing into fresh orm objects, as for a new
+patient, and remapping onto objects already holding the same values, as for
+an unchanged record of an existing patient.
+"""
+
+import time
+
+from synthetic_files import make_patient_file
+from ukrdc_cupid.core.parse.utils import load_xml_from_str
+from ukrdc_cupid.core.store.bulk import orm_to_row
+from ukrdc_cupid.core.store.models.fields import Code
+from ukrdc_cupid.core.store.models.longitudinal_records import (
+    Observation,
+    ResultItem,
+)
+from ukrdc_cupid.core.store.models.structure import RecordStatus
+
+# Config
+RECORDS = 10000
+REPEATS = 5
+
+
+def add_items(node) -> None:
+    # one call per column as the map_xml_to_orm methods used to make
+    for field in node.fields:
+        value = getattr(node.xml, field.xml_path)
+        if isinstance(field, Code):
+            node.add_code(field.code, field.std, field.desc, value, field.optional)
+        else:
+            node.add_item(field.column, value, field.optional)
+
+
+def map_fields(node) -> None:
+    node.map_fields()
+
+
+def make_nodes(node_class, xml_items: list) -> list:
+    nodes = []
+    for xml in xml_items:
+        node = node_class(xml)
+        node.orm_object = node.orm_model()
+        node.status = RecordStatus.NEW
+        nodes.append(node)
+    return nodes
+
+
+def timed(mapper, nodes: list, fresh: bool) -> float:
+    if not fresh:
+        # bring the objects up to date with the xml before timing
+        for node in nodes:
+            mapper(node)
+
+    total = 0.0
+    for _ in range(REPEATS):
+        if fresh:
+            for node in nodes:
+                node.orm_object = node.orm_model()
+        else:
+            for node in nodes:
+                node.status = RecordStatus.UNCHANGED
+
+        t0 = time.perf_counter()
+        for node in nodes:
+            mapper(node)
+        total += time.perf_counter() - t0
+
+    if not fresh:
+        assert all(node.status == RecordStatus.UNCHANGED for node in nodes)
+    return 1e6 * total / (REPEATS * len(nodes))
+
+
+xml = load_xml_from_str(make_patient_file(RECORDS // 10, 10, RECORDS))
+result_items = [
+    item for order in xml.lab_orders.lab_order for item in order.result_items.result_item
+]
+cases = [
+    (Observation, xml.observations.observation),
+    (ResultItem, result_items),
+]
+
+print(f"{'node':>12} {'orm':>10} {'add_item us':>12} {'map_fields us':>14}")
+for node_class, xml_items in cases:
+    for fresh in (True, False):
+        nodes = make_nodes(node_class, xml_items)
+        add_item_us = timed(add_items, nodes, fresh)
+        expected = [orm_to_row(node.orm_object) for node in nodes]
+        map_fields_us = timed(map_fields, nodes, fresh)
+        assert [orm_to_row(node.orm_object) for node in nodes] == expected
+
+        orm = "fresh" if fresh else "unchanged"
+        print(
+            f"{node_class.__name__:>12} {orm:>10} {add_item_us:>12.2f} {map_fields_us:>14.2f}"
+        )
@@ -0,0 +1,56 @@
+"""Compare the canonical file hash (hash_xml_tree) with the original
+implementation (hash_xml_legacy) which deep copies the decoded file and
+renders it back to xml. Timings and peak memory are reported for each.
+"""
+
+import time
+import tracemalloc
+
+from synthetic_files import make_patient_file
+from ukrdc_cupid.core.parse.utils import (
+    XmlPipeline,
+    hash_xml_legacy,
+    load_xml_from_str,
+)
+
+# Config
+SIZES = [(10, 10, 100), (100, 10, 1000), (1000, 10, 10000)]
+REPEATS = 3
+
+
+def measure(func, *args):
+    t0 = time.perf_counter()
+    for _ in range(REPEATS):
+        result = func(*args)
+    elapsed = (time.perf_counter() - t0) / REPEATS
+
+    # memory is traced separately since tracing slows everything down
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def canonical(xml_str: str) -> str:
+    # includes the parse since the pipeline parses the file anyway
+    return XmlPipeline(xml_str).content_hash
+
+
+print(f"{'records':>8} {'legacy s':>10} {'legacy MB':>10} {'tree s':>10} {'tree MB':>10}")
+for lab_orders, results, observations in SIZES:
+    xml_str = make_patient_file(lab_orders, results, observations)
+    xml_obj = load_xml_from_str(xml_str)
+    records = lab_orders * (results + 1) + observations
+
+    _, legacy_time, legacy_peak = measure(hash_xml_legacy, xml_obj)
+    file_hash, tree_time, tree_peak = measure(canonical, xml_str)
+
+    # resending the same content in a new batch shouldn't change the hash
+    resent = make_patient_file(lab_orders, results, observations, batch_no=2)
+    assert canonical(resent) == file_hash
+
+    print(
+        f"{records:>8} {legacy_time:>10.4f} {legacy_peak / 1e6:>10.1f} "
+        f"{tree_time:>10.4f} {tree_peak / 1e6:>10.1f}"
+    )
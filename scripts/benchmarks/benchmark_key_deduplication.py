@@ -0,0 +1,65 @@
+"""Pathological key deduplication: every observation in the file has the same
+timestamp and code so all of their keys start out identical. The linear
+keygen.deduplicate_keys is compared against the original loop, which checked
+each candidate against a list and re-split the key on every collision, and
+the time to map the whole file is shown alongside. The original grows with
+the cube of the number of duplicates so it is only run for smaller files,
+at 20k observations it would take hours.
+
+Mapping a new patient doesn't query the database so no server is needed.
+"""
+
+import time
+
+from sqlalchemy.orm import Session
+from synthetic_files import make_patient_file
+from ukrdc_cupid.core.parse.utils import load_xml_from_str
+from ukrdc_cupid.core.store.keygen import KEY_SEPARATOR, deduplicate_keys
+from ukrdc_cupid.core.store.models.ukrdc import PatientRecord
+
+# Config
+SIZES = [250, 500, 1000, 20000]
+ORIGINAL_LIMIT = 1000
+
+
+def original(keys: list) -> list:
+    # PatientRecord.deduplicate_keys as it was
+    ids = []
+    for id in keys:
+        while id in ids:
+            id_components = id.split(KEY_SEPARATOR)
+            id_components[-1] = str(int(id_components[-1]) + 1)
+            id = KEY_SEPARATOR.join(id_components)
+        ids.append(id)
+    return ids
+
+
+def timed(func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - t0
+
+
+print(f"{'records':>8} {'original s':>11} {'linear s':>9} {'map file s':>11}")
+for observations in SIZES:
+    xml_str = make_patient_file(observations=observations, identical_times=True)
+    xml = load_xml_from_str(xml_str)
+
+    _, map_time = timed(
+        PatientRecord(xml).map_to_database, "1", "1", Session(), True
+    )
+
+    keys = [f"1{KEY_SEPARATOR}1609459200.0{KEY_SEPARATOR}DIA{KEY_SEPARATOR}0"]
+    keys = keys * observations
+    deduplicated, linear_time = timed(deduplicate_keys, keys)
+    assert len(set(deduplicated)) == observations
+
+    original_s = "-"
+    if observations <= ORIGINAL_LIMIT:
+        expected, original_time = timed(original, keys)
+        assert deduplicated == expected
+        original_s = f"{original_time:.3f}"
+
+    print(
+        f"{observations:>8} {original_s:>11} {linear_time:>9.4f} {map_time:>11.3f}"
+    )
@@ -0,0 +1,55 @@
+"""Memory used by the mapped tree of a new patient for increasing file sizes.
+For each file the peak while decoding and mapping is reported along with the
+memory still held once the caller has dropped the decoded file, first with
+the nodes keeping their xsdata (keep_xml=True) and then with it released.
+
+Mapping a new patient doesn't query the database so no server is needed.
+"""
+
+import gc
+import tracemalloc
+
+from sqlalchemy.orm import Session
+from synthetic_files import make_patient_file
+from ukrdc_cupid.core.parse.utils import load_xml_from_str
+from ukrdc_cupid.core.store.models.ukrdc import PatientRecord
+
+# Config
+SIZES = [(10, 10, 100), (100, 10, 1000), (1000, 10, 10000)]
+
+
+def map_tree(xml_str: str, keep_xml: bool):
+    """Returns the mapped tree and the peak memory used getting there"""
+    gc.collect()
+    tracemalloc.start()
+
+    xml_obj = load_xml_from_str(xml_str)
+    patient_record = PatientRecord(xml_obj, keep_xml=keep_xml)
+    patient_record.map_to_database("1", "1", Session(), is_new=True)
+    del xml_obj
+
+    _, peak = tracemalloc.get_traced_memory()
+    return patient_record, peak
+
+
+def retained(xml_str: str, keep_xml: bool):
+    patient_record, peak = map_tree(xml_str, keep_xml)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del patient_record
+    return peak, current
+
+
+# the first run fills import time caches which would count against it
+retained(make_patient_file(1, 1, 1), keep_xml=True)
+
+print(f"{'records':>8} {'peak MB':>8} {'kept MB':>8} {'released MB':>12}")
+for lab_orders, results, observations in SIZES:
+    xml_str = make_patient_file(lab_orders, results, observations)
+    records = lab_orders * (results + 1) + observations
+
+    peak, kept = retained(xml_str, keep_xml=True)
+    _, released = retained(xml_str, keep_xml=False)
+
+    print(f"{records:>8} {peak / 1e6:>8.1f} {kept / 1e6:>8.1f} {released / 1e6:>12.1f}")
@@ -0,0 +1,191 @@
+"""Generate large synthetic RDA files for the benchmarks in this folder. The
+records are based on scripts/xml_examples/UKRDC_v4.xml but repeated as many
+times as required.
+"""
+
+import datetime as dt
+
+START_TIME = dt.datetime(2021, 1, 1)
+
+HEADER = """<ukrdc:PatientRecord xmlns:ukrdc="http://www.rixg.org.uk/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+    <SendingFacility channelName="UKRDCSampleExtract" schemaVersion="4.2.0" time="{sending_time}" batchNo="{batch_no}">ABC123</SendingFacility>
+    <SendingExtract>UKRDC</SendingExtract>
+    <Patient>
+        <PatientNumbers>
+            <PatientNumber>
+                <Number>{mrn}</Number>
+                <Organization>LOCALHOSP</Organization>
+                <NumberType>MRN</NumberType>
+            </PatientNumber>
+            <PatientNumber>
+                <Number>{nhs_number}</Number>
+                <Organization>NHS</Organization>
+                <NumberType>NI</NumberType>
+            </PatientNumber>
+        </PatientNumbers>
+        <Names>
+            <Name use="L">
+                <Family>Sample</Family>
+                <Given>John</Given>
+            </Name>
+        </Names>
+        <BirthTime>1966-05-04T00:00:00</BirthTime>
+        <Gender>1</Gender>
+    </Patient>
+"""
+
+LAB_ORDER = """        <LabOrder>
+            <PlacerId>Placer{order_no}</PlacerId>
+            <FillerId>Filler{order_no}</FillerId>
+            <SpecimenCollectedTime>{time}</SpecimenCollectedTime>
+            <SpecimenSource>BLOOD</SpecimenSource>
+            <ResultItems>
+{result_items}            </ResultItems>
+            <EnteredAt>
+                <CodingStandard>RR1+</CodingStandard>
+                <Code>ABC123</Code>
+                <Description>Test Hospital</Description>
+            </EnteredAt>
+        </LabOrder>
+"""
+
+RESULT_ITEM = """                <ResultItem>
+                    <PrePost>PRE</PrePost>
+                    <ServiceId>
+                        <CodingStandard>UKRR</CodingStandard>
+                        <Code>QBL{item_no:02d}</Code>
+                        <Description>Test {item_no}</Description>
+                    </ServiceId>
+                    <ResultValue>{value}</ResultValue>
+                    <ResultValueUnits>mmol/L</ResultValueUnits>
+                    <ObservationTime>{time}</ObservationTime>
+                </ResultItem>
+"""
+
+OBSERVATION = """        <Observation>
+            <ObservationTime>{time}</ObservationTime>
+            <ObservationCode>
+                <CodingStandard>UKRR</CodingStandard>
+                <Code>{code}</Code>
+                <Description>Diastolic BP</Description>
+            </ObservationCode>
+            <ObservationValue>{value}</ObservationValue>
+            <ObservationUnits>mmHg</ObservationUnits>
+            <PrePost>PRE</PrePost>
+        </Observation>
+"""
+
+MEDICATION = """        <Medication>
+            <FromTime>{time}</FromTime>
+            <Route>
+                <CodingStandard>RR22</CodingStandard>
+                <Code>1</Code>
+                <Description>Oral</Description>
+            </Route>
+            <DrugProduct>
+                <Generic>Generic{drug_no}</Generic>
+                <LabelName>LabelName{drug_no}</LabelName>
+            </DrugProduct>
+            <Frequency>Once daily</Frequency>
+            <DoseQuantity>{dose}</DoseQuantity>
+        </Medication>
+"""
+
+
+def timestamp(n: int, identical_times: bool = False) -> str:
+    if identical_times:
+        n = 0
+    return (START_TIME + dt.timedelta(minutes=n)).isoformat()
+
+
+def datestamp(n: int) -> str:
+    return (START_TIME + dt.timedelta(minutes=n)).date().isoformat()
+
+
+def make_patient_file(
+    lab_orders: int = 0,
+    results_per_order: int = 10,
+    observations: int = 0,
+    identical_times: bool = False,
+    mrn: str = "AAA111C",
+    nhs_number: str = "9434765870",
+    batch_no: int = 1,
+    value_offset: int = 0,
+    medications: int = 0,
+) -> str:
+    """Build a synthetic patient file.
+
+    Args:
+        lab_orders (int, optional): number of lab orders.
+        results_per_order (int, optional): result items in each lab order.
+        observations (int, optional): number of observations.
+        identical_times (bool, optional): give every observation the same
+        timestamp and code, the worst case for key deduplication.
+        mrn (str, optional): local hospital number of the patient.
+        nhs_number (str, optional): nhs number of the patient.
+        batch_no (int, optional): batch number, changing it shouldn't change
+        the file hash.
+        value_offset (int, optional): added to every result/observation
+        value so modified versions of a file can be generated.
+        medications (int, optional): number of medications, each of a
+        different drug.
+
+    Returns:
+        str: the file as a string
+    """
+    parts = [
+        HEADER.format(
+            sending_time=dt.datetime.now().replace(microsecond=0).isoformat(),
+            batch_no=batch_no,
+            mrn=mrn,
+            nhs_number=nhs_number,
+        )
+    ]
+
+    if lab_orders:
+        stop = datestamp(lab_orders + 24 * 60)
+        parts.append(f'    <LabOrders start="{datestamp(0)}" stop="{stop}">\n')
+        for order_no in range(lab_orders):
+            items = "".join(
+                RESULT_ITEM.format(
+                    item_no=item_no,
+                    value=order_no + item_no + value_offset,
+                    time=timestamp(order_no, identical_times),
+                )
+                for item_no in range(results_per_order)
+            )
+            parts.append(
+                LAB_ORDER.format(
+                    order_no=order_no,
+                    time=timestamp(order_no, identical_times),
+                    result_items=items,
+                )
+            )
+        parts.append("    </LabOrders>\n")
+
+    if observations:
+        stop = datestamp(observations + 24 * 60)
+        parts.append(f'    <Observations start="{datestamp(0)}" stop="{stop}">\n')
+        for obs_no in range(observations):
+            code = "QBLG4" if identical_times else f"QBLG{obs_no % 10}"
+            parts.append(
+                OBSERVATION.format(
+                    time=timestamp(obs_no, identical_times),
+                    code=code,
+                    value=obs_no % 200 + value_offset,
+                )
+            )
+        parts.append("    </Observations>\n")
+
+    if medications:
+        parts.append("    <Medications>\n")
+        for drug_no in range(medications):
+            parts.append(
+                MEDICATION.format(
+                    time=timestamp(drug_no), drug_no=drug_no, dose=drug_no % 4 + 1
+                )
+            )
+        parts.append("    </Medications>\n")
+
+    parts.append("</ukrdc:PatientRecord>\n")
+    return "".join(parts)
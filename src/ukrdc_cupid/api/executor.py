@@ -0,0 +1,174 @@
+"""
+The store pipeline (lxml, xsdata, sqlalchemy and the advisory lock) is entirely
+synchronous. Running it directly inside an async route stalls the event loop
+for the duration of the file so everything queued behind it (validation,
+health checks etc) has to wait. This module hands the work to a bounded pool
+of threads or processes instead.
+"""
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+
+from sqlalchemy.orm import sessionmaker
+
+from ukrdc_cupid.core.match.cache import MatchCacheListener
+from ukrdc_cupid.core.store.insert import process_file
+from ukrdc_cupid.core.utils import ENV, UKRDCConnection
+
+EXECUTOR_KINDS = ("thread", "process")
+
+# entries in the match cache of each process, 0 turns the cache off
+MATCH_CACHE_SIZE = int(ENV.get("CUPID_MATCH_CACHE_SIZE", 0))
+
+# Each worker process in a process pool gets its own engine since neither
+# connections nor sessions can be shared across processes. The same goes for
+# the match cache.
+_worker_sessionmaker: Optional[sessionmaker] = None
+_worker_cache_listener: Optional[MatchCacheListener] = None
+
+
+def start_match_cache(url: str) -> Optional[MatchCacheListener]:
+    """Listen for match changes and enable the match cache of this process,
+    if it is turned on.
+    """
+    if MATCH_CACHE_SIZE <= 0:
+        return None
+
+    listener = MatchCacheListener(url, maxsize=MATCH_CACHE_SIZE)
+    listener.start()
+    return listener
+
+
+def _init_worker() -> None:
+    global _worker_sessionmaker, _worker_cache_listener
+    connection = UKRDCConnection()
+    _worker_sessionmaker = connection.create_sessionmaker()
+    _worker_cache_listener = start_match_cache(connection.url)
+
+
+def _process_file_in_session(
+    session_factory: sessionmaker, xml_body: str, mode: str, **kwargs
+) -> str:
+    # the session belongs to the job, so it stays open for as long as the job
+    # runs whatever happens to the request which submitted it
+    with session_factory() as session:
+        return process_file(xml_body, session, mode, **kwargs)
+
+
+def _process_file_in_worker(xml_body: str, mode: str, **kwargs) -> str:
+    return _process_file_in_session(_worker_sessionmaker, xml_body, mode, **kwargs)
+
+
+def _job_done(semaphore: asyncio.Semaphore, future: asyncio.Future) -> None:
+    semaphore.release()
+    # nobody is waiting on the job if its request was cancelled, retrieve
+    # the error so it isn't reported as never retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+class StoreExecutor:
+    """Bounded executor for the store pipeline.
+
+    Args:
+        kind (str): "thread" or "process". Threads share the engine of the
+        api worker (see process_file), processes create their own.
+        max_workers (int): size of the thread/process pool.
+        concurrency (int, optional): maximum number of files stored at once
+        by this api worker. Further uploads wait (without blocking the event
+        loop) until a slot is free. Defaults to max_workers.
+    """
+
+    def __init__(self, kind: str, max_workers: int, concurrency: int = None):
+        if kind not in EXECUTOR_KINDS:
+            raise ValueError(
+                f"Unknown store executor {kind}, expected one of {EXECUTOR_KINDS}"
+            )
+
+        self.kind = kind
+        self.max_workers = max_workers
+        self.concurrency = concurrency or max_workers
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @classmethod
+    def from_env(cls) -> "StoreExecutor":
+        return cls(
+            kind=ENV.get("CUPID_STORE_EXECUTOR", "thread"),
+            max_workers=int(ENV.get("CUPID_STORE_WORKERS", 4)),
+            concurrency=int(ENV.get("CUPID_STORE_CONCURRENCY", 0)) or None,
+        )
+
+    def start(self) -> None:
+        if self._executor is not None:
+            return
+
+        if self.kind == "process":
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, initializer=_init_worker
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="cupid-store"
+            )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._executor = None
+        self._semaphore = None
+
+    async def process_file(
+        self,
+        xml_body: str,
+        mode: str,
+        session_factory: sessionmaker = None,
+        **kwargs,
+    ) -> str:
+        """Run process_file on the executor and wait for the result. The job
+        opens its own session rather than borrowing one from the request.
+
+        A job can't be stopped once it is running, so if the request waiting
+        on it is cancelled the job carries on and keeps its slot until it
+        finishes.
+
+        Args:
+            xml_body (str): xml file as a string
+            mode (str): insertion mode passed to process_file
+            session_factory (sessionmaker, optional): sessionmaker thread jobs
+            open their session from. It is ignored in process mode where the
+            worker has its own.
+            **kwargs: further options passed to process_file
+
+        Raises:
+            RuntimeError: in thread mode if no session_factory is given
+
+        Returns:
+            str: message returned by process_file
+        """
+        self.start()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        if self.kind == "process":
+            job = partial(_process_file_in_worker, xml_body, mode, **kwargs)
+        elif session_factory is not None:
+            job = partial(
+                _process_file_in_session, session_factory, xml_body, mode, **kwargs
+            )
+        else:
+            raise RuntimeError("Thread store executor needs a session_factory")
+
+        semaphore = self._semaphore
+        await semaphore.acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, job)
+        except BaseException:
+            semaphore.release()
+            raise
+
+        future.add_done_callback(partial(_job_done, semaphore))
+        return await asyncio.shield(future)
@@ -1,13 +1,22 @@
+import threading
+from contextlib import asynccontextmanager
+from typing import Optional
+
 from fastapi import Depends, FastAPI, Request, HTTPException, Response
-from ukrdc_cupid.core.parse.xml_validate import validate_rda_xml_string
+from ukrdc_cupid.core.parse.xml_validate import (
+    env_variables as schema_settings,
+    validate_rda_xml_string,
+    warm_schema_cache,
+)
 
 from ukrdc_cupid.core.utils import UKRDCConnection
 
-from ukrdc_cupid.core.store.insert import process_file
+from ukrdc_cupid.api.executor import StoreExecutor, start_match_cache
+from ukrdc_cupid.core.match.cache import match_cache, notify_match_change
 
 # from ukrdc_cupid.core.store.exceptions import
 from ukrdc_cupid.core.modify.edit_feed import ukrdcid_split_merge, force_quarantined
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, sessionmaker
 from ukrdc_sqla.ukrdc import PatientRecord
 from ukrdc_cupid.core.store.exceptions import (
     SchemaVersionError,
@@ -19,12 +28,64 @@ from ukrdc_cupid.core.audit.domain import (
 )
 
 
-app = FastAPI()
+# One engine (and therefore one connection pool) per worker process. It is
+# created when the app starts up and shared between all routes so the pool
+# settings in UKRDCConnection.get_engine actually take effect.
+_connection_lock = threading.Lock()
+_ukrdc_connection: Optional[UKRDCConnection] = None
+_ukrdc_sessionmaker: Optional[sessionmaker] = None
+
+# files are stored on a bounded pool of threads/processes so the event loop
+# stays free to serve other requests
+store_executor = StoreExecutor.from_env()
+
+
+def get_ukrdc_connection() -> UKRDCConnection:
+    """Return the process wide connection creating it if it doesn't exist
+    yet. Normally this happens in the lifespan hook but scripts which use
+    get_session directly will create it lazily.
+    """
+    global _ukrdc_connection, _ukrdc_sessionmaker
+
+    with _connection_lock:
+        if _ukrdc_connection is None:
+            _ukrdc_connection = UKRDCConnection()
+            _ukrdc_sessionmaker = _ukrdc_connection.create_sessionmaker()
+
+    return _ukrdc_connection
+
+
+def close_ukrdc_connection() -> None:
+    """Dispose of the process wide engine and its pool"""
+    global _ukrdc_connection, _ukrdc_sessionmaker
+
+    with _connection_lock:
+        if _ukrdc_connection is not None:
+            _ukrdc_connection.dispose()
+        _ukrdc_connection = None
+        _ukrdc_sessionmaker = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    connection = get_ukrdc_connection()
+    cache_listener = start_match_cache(connection.url)
+    store_executor.start()
+    if schema_settings.warm_schema_cache:
+        warm_schema_cache()
+    yield
+    store_executor.shutdown()
+    if cache_listener is not None:
+        cache_listener.stop()
+    close_ukrdc_connection()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def get_session() -> Session:
-    sessionmaker = UKRDCConnection().create_sessionmaker()
-    session = sessionmaker()
+    get_ukrdc_connection()
+    session = _ukrdc_sessionmaker()
     try:
 
         yield session
@@ -32,6 +93,14 @@ def get_session() -> Session:
         session.close()
 
 
+def get_sessionmaker() -> sessionmaker:
+    """Sessionmaker for work which outlives the request, like store jobs,
+    and so has to open its own session rather than use get_session.
+    """
+    get_ukrdc_connection()
+    return _ukrdc_sessionmaker
+
+
 async def _get_xml_body(request: Request) -> str:
     """
     Based on function lifted from the rda_xml_schema_conversion this lifts
@@ -56,6 +125,22 @@ async def _get_xml_body(request: Request) -> str:
         )
 
 
+@app.get("/health/pool")
+async def pool_statistics():
+    """Statistics for the database connection pool of this worker process.
+    Useful for tuning UKRDC_POOL_SIZE under load.
+    """
+    return get_ukrdc_connection().pool_statistics()
+
+
+@app.get("/health/match_cache")
+async def match_cache_statistics():
+    """Hit and miss counts for the match cache of this worker process. With
+    the process executor each store process has its own cache.
+    """
+    return match_cache.statistics()
+
+
 @app.post("/parse/xml_validate/{schema_version}")
 async def validate_xml(schema_version: str, xml_body=Depends(_get_xml_body)):
     """Cupid validation functionality simply checks if an xml file is valid
@@ -88,15 +173,20 @@ async def validate_xml(schema_version: str, xml_body=Depends(_get_xml_body)):
 async def load_xml(
     mode: str,
     xml_body: str = Depends(_get_xml_body),
-    ukrdc_session_factory: Session = Depends(get_session),
+    ukrdc_sessionmaker: sessionmaker = Depends(get_sessionmaker),
+    show_changes: bool = False,
 ):
     """Main CUPID Api route. Cupid will attempt to load any xml posted here to
-    the database.
+    the database. In diff mode nothing is written, instead the changes the
+    file would make are returned as json.
 
     Args:
-        mode (str): _description_
+        mode (str): "full", "ex-missing", "clear" or "diff"
         xml_body (str, optional): _description_. Defaults to Depends(_get_xml_body).
-        ukrdc_session_factory (Session, optional): _description_. Defaults to Depends(get_session).
+        ukrdc_sessionmaker (sessionmaker, optional): the store job opens its
+        session from this. Defaults to Depends(get_sessionmaker).
+        show_changes (bool, optional): in diff mode list the keys and columns
+        which would change. Defaults to False.
 
     Raises:
         HTTPException: _description_
@@ -107,24 +197,28 @@ async def load_xml(
         _type_: _description_
     """
 
-    with ukrdc_session_factory as session:
-        # identify patient
-        try:
-            msg = process_file(xml_body, session, mode)
-        except Exception as e:
-            # handle exception based on what it is
-            if isinstance(e, SchemaVersionError):
-                raise HTTPException(status_code=422, detail=str(e))
+    # the store job opens its own session so it is unaffected if this request
+    # is cancelled while the job is still running
+    try:
+        msg = await store_executor.process_file(
+            xml_body, mode, ukrdc_sessionmaker, show_changes=show_changes
+        )
+    except Exception as e:
+        # handle exception based on what it is
+        if isinstance(e, SchemaVersionError):
+            raise HTTPException(status_code=422, detail=str(e))
 
-            elif isinstance(e, InsertionBlockedError):
-                raise HTTPException(status_code=422, detail=str(e))
+        elif isinstance(e, InsertionBlockedError):
+            raise HTTPException(status_code=422, detail=str(e))
 
-            else:
-                error_msg = str(e)
-                raise HTTPException(
-                    status_code=500, detail=f"Upload failed with error: {error_msg}"
-                )
+        else:
+            error_msg = str(e)
+            raise HTTPException(
+                status_code=500, detail=f"Upload failed with error: {error_msg}"
+            )
 
+    if mode == "diff":
+        return Response(content=msg, media_type="application/json")
     return Response(content=msg)
 
 
@@ -191,6 +285,7 @@ async def delete_patient(
     ukrdcid = patient_record.ukrdcid
     localhosp = patient_record.localpatientid
     ukrdc_session.delete(patient_record)
+    notify_match_change(ukrdc_session, pids=[pid])
     ukrdc_session.commit()
 
     msg = f"Deleted patient with identifiers: pid = {pid}, ukrdcid = {ukrdcid}, localpatientid = {localhosp}"
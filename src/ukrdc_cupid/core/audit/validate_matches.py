@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import List, Optional
 from sqlalchemy.orm import Session
 import ukrdc_sqla.ukrdc as orm
 from sqlalchemy import select
@@ -23,14 +24,28 @@ def validate_demog(
     """
 
     dob_query = select(orm.Patient.birthtime).where(orm.Patient.pid == pid)
-    domain_dob = session.execute(dob_query).fetchall()
-    length = len(domain_dob)
+    domain_dobs = session.execute(dob_query).scalars().all()
+    return check_demog(domain_dobs, dob, is_anon)
+
+
+def check_demog(
+    domain_dobs: List[Optional[datetime]], dob: datetime, is_anon: bool = False
+) -> bool:
+    """The comparison made by validate_demog for birth times which have
+    already been looked up (e.g. by the combined matching query).
+
+    Args:
+        domain_dobs (List[Optional[datetime]]): birth times held for the pid
+        dob (datetime): incoming date of birth.
+        is_anon (bool, optional): only compare the year. Defaults to False.
+    """
+    length = len(domain_dobs)
 
     if length != 1:
         # To be expanded when properly thought through
         raise Exception("validate_demog is broken")
     else:
-        domain_dob = domain_dob[0][0]
+        domain_dob = domain_dobs[0]
         if is_anon:
             # anonomised patients only get validated on year this allows a
             # a record to be overridden
@@ -60,6 +75,13 @@ def validate_demog_ukrdc(session: Session, dob: datetime, ukrdcid: str) -> bool:
     )
     dob_ukrdc = [row[0] for row in session.execute(dob_query).fetchall()]
 
+    return check_demog_ukrdc(dob_ukrdc, dob)
+
+
+def check_demog_ukrdc(dob_ukrdc: List[Optional[datetime]], dob: datetime) -> bool:
+    """The comparison made by validate_demog_ukrdc for the birth times of a
+    ukrdcid which have already been looked up (e.g. by match_ukrdc_demog).
+    """
     return dob in dob_ukrdc
 
 
@@ -1,7 +1,8 @@
 import json
 
 from ukrdc_cupid.core.investigate.models import PatientID, Issue, XmlFile
-from ukrdc_cupid.core.parse.utils import load_xml_from_str, hash_xml
+from ukrdc_cupid.core.match.cache import notify_match_change
+from ukrdc_cupid.core.parse.utils import XmlPipeline
 
 from datetime import datetime
 from typing import List, Tuple, Union
@@ -97,8 +98,12 @@ class Investigation:
             error_message=error_msg,
         )
 
-        # Link the issue to patients
+        # Link the issue to patients, a blocking issue changes what they match
         self.session.add(new_issue)
+        if is_blocking:
+            notify_match_change(
+                self.session, pids=[patient.pid for patient in self.patients]
+            )
         self.session.commit()
 
         return new_issue
@@ -123,16 +128,20 @@ class Investigation:
         # file.
         if xml is not None:
             if isinstance(xml, str):
-                xml_obj = load_xml_from_str(xml)
+                pipeline = XmlPipeline(xml)
+                xml_file_hash = pipeline.content_hash
+                xml_obj = pipeline.decode()
             else:
+                # without the raw file the rendered copy is kept, and hashed,
+                # instead. Callers which have the raw file should pass that.
                 xml_obj = xml
                 xml = serializer.render(xml_obj)
+                xml_file_hash = XmlPipeline(xml).content_hash
 
             if not isinstance(xml_obj, xsd_ukrdc.PatientRecord):
                 raise Exception("No bueno hombre")
 
             xml = xml.strip(" ").strip("\n")
-            xml_file_hash = hash_xml(xml_obj)
             xml_file = self.session.execute(
                 select(XmlFile).filter_by(file_hash=xml_file_hash)
             ).scalar_one_or_none()
@@ -0,0 +1,289 @@
+"""
+In process cache of feed matches (see match_feed). Most files come from the
+same feeds again and again and the patients their numbers match almost never
+change, so the matches are kept in an LRU keyed on the feed and patient
+numbers of the file.
+
+Anything which changes what a file would match to (new patients, changes to
+patient numbers or demographics, ukrdcid splits and merges, deleted patients
+and new investigations) has to call notify_match_change before committing.
+This drops the affected entries from the local cache and sends a postgres
+NOTIFY, which is delivered when the transaction commits, so every worker
+process listening (see MatchCacheListener) drops them too.
+
+The cache is only used while its listener is connected. Without it changes
+made by other processes would go unnoticed so it is cleared and bypassed
+until the listener reconnects. Entries are also tagged with the generation
+of the cache when their query was made, a match looked up before an
+invalidation is never stored after it.
+
+The process making a change drops the entries before it commits. Other
+processes only drop them once their listener receives the notification, so
+for the moment between the commit and its delivery (normally milliseconds)
+they can still match a file against the old state. Deployments which can't
+accept that should leave the cache off.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+import psycopg
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+MATCH_CACHE_CHANNEL = "cupid_match_cache"
+MATCH_CACHE_SIZE = 10000
+
+# notification payloads are limited to 8000 bytes, anything bigger clears
+# every cache
+MAX_PAYLOAD = 7500
+CLEAR_ALL = "*"
+
+# (numbertype, patientid, organization)
+Number = Tuple[str, str, str]
+
+
+def match_key(patient_info: dict) -> tuple:
+    """Cache key of a file, its feed and patient numbers"""
+    mrn_id, mrn_org = patient_info["MRN"]
+    nis = {("NI", ni_id, ni_org) for ni_id, ni_org in patient_info["NI"]}
+    return (
+        patient_info["sending_facility"],
+        patient_info["sending_extract"],
+        ("MRN", mrn_id, mrn_org),
+        tuple(sorted(nis)),
+    )
+
+
+def key_numbers(key: tuple) -> Tuple[Number, ...]:
+    _, _, mrn, nis = key
+    return (mrn,) + nis
+
+
+def copy_match(match: Any) -> Any:
+    """Copy of a FeedMatch which doesn't share any containers with it"""
+    return type(match)(
+        list(match.mrn),
+        list(match.ni),
+        {pid: list(birth_times) for pid, birth_times in match.birth_times.items()},
+        set(match.blocked),
+    )
+
+
+class MatchCache:
+    """LRU of feed matches by match_key.
+
+    Args:
+        maxsize (int, optional): entries kept. Defaults to MATCH_CACHE_SIZE.
+    """
+
+    def __init__(self, maxsize: int = MATCH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.enabled = False
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[tuple, Any]" = OrderedDict()
+        self._by_pid: Dict[str, Set[tuple]] = {}
+        self._by_number: Dict[Number, Set[tuple]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def enable(self, maxsize: int = None) -> None:
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            self._clear()
+            self.enabled = True
+
+    def disable(self) -> None:
+        with self._lock:
+            self.enabled = False
+            self._clear()
+
+    def get(self, key: tuple) -> Optional[Any]:
+        """Cached match for the key, None if there isn't one or the cache is
+        disabled
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            match = self._entries.get(key)
+            if match is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy_match(match)
+
+    def put(self, key: tuple, match: Any, generation: int) -> None:
+        """Store a match unless the cache has been invalidated since the
+        query it came from was made.
+
+        Args:
+            key (tuple): match_key of the file
+            match (FeedMatch): result of the query
+            generation (int): generation of the cache before the query
+        """
+        with self._lock:
+            if not self.enabled or generation != self.generation:
+                return
+
+            self._remove(key)
+            self._entries[key] = copy_match(match)
+            for pid in match.birth_times:
+                self._by_pid.setdefault(pid, set()).add(key)
+            for number in key_numbers(key):
+                self._by_number.setdefault(number, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(
+        self, pids: Iterable[str] = (), numbers: Iterable[Number] = ()
+    ) -> None:
+        """Drop the matches of the pids and the files holding any of the
+        numbers
+        """
+        with self._lock:
+            keys = set()
+            for pid in pids:
+                keys.update(self._by_pid.get(pid, ()))
+            for number in numbers:
+                keys.update(self._by_number.get(tuple(number), ()))
+            for key in keys:
+                self._remove(key)
+            self.generation += 1
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def statistics(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+    def _clear(self) -> None:
+        self._entries.clear()
+        self._by_pid.clear()
+        self._by_number.clear()
+        self.generation += 1
+
+    def _remove(self, key: tuple) -> None:
+        match = self._entries.pop(key, None)
+        if match is None:
+            return
+        for pid in match.birth_times:
+            self._discard(self._by_pid, pid, key)
+        for number in key_numbers(key):
+            self._discard(self._by_number, number, key)
+
+    @staticmethod
+    def _discard(index: dict, item: Any, key: tuple) -> None:
+        keys = index.get(item)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[item]
+
+
+# one per process, enabled by MatchCacheListener
+match_cache = MatchCache()
+
+
+def apply_notification(cache: MatchCache, payload: str) -> None:
+    """Invalidate the cache as described by a notification payload"""
+    if payload == CLEAR_ALL:
+        cache.clear()
+        return
+
+    change = json.loads(payload)
+    cache.invalidate(change.get("pids", ()), change.get("numbers", ()))
+
+
+def notify_match_change(
+    session: Session, pids: Iterable[str] = (), numbers: Iterable[Number] = ()
+) -> None:
+    """Invalidate the matches of the pids and the files holding any of the
+    numbers in every process. This must be called in the transaction making
+    the change, the other processes are notified when it commits.
+
+    Args:
+        session (Session): ukrdc database session
+        pids (Iterable[str], optional): patients whose numbers, demographics,
+        ukrdcid or investigations have changed
+        numbers (Iterable[Number], optional): (numbertype, patientid,
+        organization) of new or changed patient numbers
+    """
+    pids = [pid for pid in pids if pid is not None]
+    numbers = [list(number) for number in numbers]
+    if not pids and not numbers:
+        return
+
+    payload = json.dumps({"pids": pids, "numbers": numbers})
+    if len(payload) > MAX_PAYLOAD:
+        payload = CLEAR_ALL
+
+    match_cache.invalidate(pids, numbers)
+    session.execute(select(func.pg_notify(MATCH_CACHE_CHANNEL, payload)))
+
+
+class MatchCacheListener(threading.Thread):
+    """Background thread which LISTENs for match changes made by any process
+    and applies them to the cache. The cache is enabled while the listener is
+    connected.
+
+    Args:
+        url (str): sqlalchemy url of the ukrdc
+        cache (MatchCache, optional): Defaults to match_cache.
+        maxsize (int, optional): entries kept. Defaults to MATCH_CACHE_SIZE.
+    """
+
+    # seconds between checks for stop and attempts to reconnect
+    POLL_INTERVAL = 1.0
+
+    def __init__(
+        self, url: str, cache: MatchCache = None, maxsize: int = MATCH_CACHE_SIZE
+    ):
+        super().__init__(name="cupid-match-cache", daemon=True)
+        url = make_url(url).set(drivername="postgresql")
+        self.conninfo = url.render_as_string(hide_password=False)
+        # an empty cache is falsy
+        self.cache = cache if cache is not None else match_cache
+        self.maxsize = maxsize
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+        self.cache.disable()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as connection:
+                    connection.execute(f"LISTEN {MATCH_CACHE_CHANNEL}")
+                    # anything may have changed while we weren't listening
+                    self.cache.enable(self.maxsize)
+                    while not self._stop_event.is_set():
+                        for notify in connection.notifies(timeout=self.POLL_INTERVAL):
+                            apply_notification(self.cache, notify.payload)
+            except psycopg.Error as e:
+                print(f"Match cache listener disconnected: {e}")
+            finally:
+                self.cache.disable()
+            self._stop_event.wait(self.POLL_INTERVAL)
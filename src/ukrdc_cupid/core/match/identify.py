@@ -7,20 +7,85 @@ Returns:
 import ukrdc_sqla.ukrdc as orm
 import ukrdc_xsdata.ukrdc as xsd_ukrdc  # type: ignore
 
-from sqlalchemy.orm import Session
-from sqlalchemy import select, and_, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import (
+    ARRAY,
+    ColumnElement,
+    Integer,
+    Select,
+    String,
+    and_,
+    bindparam,
+    distinct,
+    false,
+    func,
+    or_,
+    select,
+    tuple_,
+)
 from ukrdc_cupid.core.audit.validate_matches import (
-    validate_demog,
-    validate_demog_ukrdc,
+    check_demog,
+    check_demog_ukrdc,
     validate_NI_mismatch,
 )
 from ukrdc_cupid.core.investigate.models import Issue, PatientID, LinkPatientToIssue
+from ukrdc_cupid.core.match.cache import match_cache, match_key
 from ukrdc_cupid.core.investigate.create_investigation import Investigation
+from ukrdc_cupid.core.utils import ENV
 
-from typing import List, Any
+from typing import Dict, List, Any, NamedTuple, Optional, Set, Tuple
 from nhs_number.validate import is_valid
 from datetime import datetime
 
+# files matched by each query of match_many
+MATCH_BATCH_SIZE = 5000
+
+# Open blocking investigations on a patient stop files being written to it.
+# The original check never matched so this is off unless switched on.
+BLOCK_ON_INVESTIGATIONS = ENV.get("CUPID_BLOCK_ON_INVESTIGATIONS", "false") == "true"
+
+
+def feed_criteria(patient_info: dict) -> ColumnElement:
+    """Patient records of the feed the file was sent on"""
+    return and_(
+        orm.PatientRecord.sendingextract == patient_info["sending_extract"],
+        orm.PatientRecord.sendingfacility == patient_info["sending_facility"],
+    )
+
+
+def mrn_criteria(patient_info: dict) -> ColumnElement:
+    """Patient numbers matching the MRN of the file"""
+    return and_(
+        orm.PatientNumber.patientid == patient_info["MRN"][0],
+        orm.PatientNumber.organization == patient_info["MRN"][1],
+        orm.PatientNumber.numbertype == "MRN",
+    )
+
+
+def ni_criteria(patient_info: dict) -> ColumnElement:
+    """Patient numbers matching any of the NIs of the file"""
+    return and_(
+        orm.PatientNumber.numbertype == "NI",
+        tuple_(orm.PatientNumber.patientid, orm.PatientNumber.organization).in_(
+            patient_info["NI"]
+        ),
+    )
+
+
+def blocking_issue_criteria(pid: Any) -> ColumnElement:
+    """Open blocking issues linked to the pid, nothing unless
+    BLOCK_ON_INVESTIGATIONS is set
+    """
+    if not BLOCK_ON_INVESTIGATIONS:
+        return false()
+
+    return and_(
+        PatientID.pid == pid,
+        Issue.is_blocking.is_(True),
+        Issue.is_resolved.is_(False),
+    )
+
 
 def match_ni(session: Session, patient_info: dict) -> Any:
     """This secondary matching query in conjunction with the MRN match. It
@@ -40,16 +105,7 @@ def match_ni(session: Session, patient_info: dict) -> Any:
     pid_query = (
         select(orm.PatientRecord.pid, orm.PatientRecord.ukrdcid)
         .join(orm.PatientNumber, orm.PatientNumber.pid == orm.PatientRecord.pid)
-        .where(
-            orm.PatientRecord.sendingextract == patient_info["sending_extract"],
-            orm.PatientRecord.sendingfacility == patient_info["sending_facility"],
-            orm.PatientNumber.numbertype == "NI",
-            and_(
-                tuple_(orm.PatientNumber.patientid, orm.PatientNumber.organization).in_(
-                    patient_info["NI"]
-                )
-            ),
-        )
+        .where(feed_criteria(patient_info), ni_criteria(patient_info))
         .group_by(orm.PatientRecord.pid, orm.PatientRecord.ukrdcid)
     )
 
@@ -73,15 +129,7 @@ def match_mrn(session: Session, patient_info: dict) -> Any:
     pid_query = (
         select(orm.PatientRecord.pid, orm.PatientRecord.ukrdcid)
         .join(orm.PatientNumber, orm.PatientNumber.pid == orm.PatientRecord.pid)
-        .where(
-            orm.PatientRecord.sendingextract == patient_info["sending_extract"],
-            orm.PatientRecord.sendingfacility == patient_info["sending_facility"],
-            and_(
-                orm.PatientNumber.patientid == patient_info["MRN"][0],
-                orm.PatientNumber.organization == patient_info["MRN"][1],
-                orm.PatientNumber.numbertype == "MRN",
-            ),
-        )
+        .where(feed_criteria(patient_info), mrn_criteria(patient_info))
         .group_by(orm.PatientRecord.pid, orm.PatientRecord.ukrdcid)
     )
 
@@ -198,7 +246,220 @@ def read_patient_metadata_etree(xml_doc) -> dict:
     return patient_info
 
 
-def match_pid(ukrdc_session: Session, patient_info: dict) -> Any:
+class FeedMatch(NamedTuple):
+    """Everything matching a file to a patient feed needs from the database,
+    see match_feed.
+
+    Args:
+        mrn (List[Tuple[str, str]]): pids and ukrdcids matched on the MRN
+        ni (List[Tuple[str, str]]): pids and ukrdcids matched on the NIs
+        birth_times (Dict[str, List[Optional[datetime]]]): birth times held
+        for each matched pid
+        blocked (Set[str]): matched pids with open blocking issues
+    """
+
+    mrn: List[Tuple[str, str]]
+    ni: List[Tuple[str, str]]
+    birth_times: Dict[str, List[Optional[datetime]]]
+    blocked: Set[str]
+
+
+def feed_match_query(patient_info: dict) -> Select:
+    """The query made by match_feed, a row for each patient record on the
+    feed with a patient number matching the MRN or one of the NIs.
+    """
+    mrn_hit = mrn_criteria(patient_info)
+    ni_hit = ni_criteria(patient_info)
+    numbers = (
+        select(
+            orm.PatientRecord.pid,
+            orm.PatientRecord.ukrdcid,
+            func.bool_or(mrn_hit).label("mrn"),
+            func.bool_or(ni_hit).label("ni"),
+        )
+        .join(orm.PatientNumber, orm.PatientNumber.pid == orm.PatientRecord.pid)
+        .where(feed_criteria(patient_info), or_(mrn_hit, ni_hit))
+        .group_by(orm.PatientRecord.pid, orm.PatientRecord.ukrdcid)
+        .cte("numbers")
+    )
+
+    blocking_issue = (
+        select(PatientID.id)
+        .join(LinkPatientToIssue, PatientID.id == LinkPatientToIssue.c.patient_id)
+        .join(Issue, Issue.id == LinkPatientToIssue.c.issue_id)
+        .where(blocking_issue_criteria(numbers.c.pid))
+    )
+
+    # patient.pid is the primary key so there is at most one birth time
+    return (
+        select(
+            numbers.c.pid,
+            numbers.c.ukrdcid,
+            numbers.c.mrn,
+            numbers.c.ni,
+            orm.Patient.pid.label("patient_pid"),
+            orm.Patient.birthtime,
+            blocking_issue.exists().label("blocked"),
+        )
+        .outerjoin(orm.Patient, orm.Patient.pid == numbers.c.pid)
+        .order_by(numbers.c.pid)
+    )
+
+
+def match_feed(session: Session, patient_info: dict) -> FeedMatch:
+    """Look up the MRN and NI matches, the birth time of each matched patient
+    and whether they have open blocking issues in a single query. Separately
+    these take four round trips (match_mrn, match_ni, the investigation
+    check in identify_patient_feed and validate_demog). The same criteria
+    are used so the results are identical. Results are kept in the match
+    cache while it is enabled (see cache.py).
+
+    Args:
+        session (Session): ukrdc database session
+        patient_info (dict): demographic information from the patient record
+
+    Returns:
+        FeedMatch: matches for the decision logic in match_pid
+    """
+    key = match_key(patient_info)
+    match = match_cache.get(key)
+    if match is not None:
+        return match
+
+    generation = match_cache.generation
+    match = FeedMatch([], [], {}, set())
+    for row in session.execute(feed_match_query(patient_info)):
+        add_feed_match_row(match, row)
+    match_cache.put(key, match, generation)
+
+    return match
+
+
+def add_feed_match_row(match: FeedMatch, row: Any) -> None:
+    """Add a row of feed_match_query (or feed_matches_query) to the matches"""
+    patient = (row.pid, row.ukrdcid)
+    if row.mrn:
+        match.mrn.append(patient)
+    if row.ni:
+        match.ni.append(patient)
+    match.birth_times[row.pid] = [] if row.patient_pid is None else [row.birthtime]
+    if row.blocked:
+        match.blocked.add(row.pid)
+
+
+def feed_matches_query(patient_infos: List[dict]) -> Select:
+    """feed_match_query for many files at once. The feed and patient numbers
+    of the files are sent as arrays and unnested, each row is labelled with
+    the position of its file in patient_infos.
+    """
+    files, facilities, extracts = [], [], []
+    number_files, numbertypes, patientids, organizations = [], [], [], []
+    for file_no, patient_info in enumerate(patient_infos):
+        files.append(file_no)
+        facilities.append(patient_info["sending_facility"])
+        extracts.append(patient_info["sending_extract"])
+        numbers = [("MRN", patient_info["MRN"])]
+        numbers.extend(("NI", ni) for ni in patient_info["NI"])
+        for numbertype, (patientid, organization) in numbers:
+            number_files.append(file_no)
+            numbertypes.append(numbertype)
+            patientids.append(patientid)
+            organizations.append(organization)
+
+    feeds = (
+        func.unnest(
+            bindparam("files", files, type_=ARRAY(Integer)),
+            bindparam("facilities", facilities, type_=ARRAY(String)),
+            bindparam("extracts", extracts, type_=ARRAY(String)),
+        )
+        .table_valued("file", "sendingfacility", "sendingextract")
+        .render_derived(name="feeds")
+    )
+    wanted = (
+        func.unnest(
+            bindparam("number_files", number_files, type_=ARRAY(Integer)),
+            bindparam("numbertypes", numbertypes, type_=ARRAY(String)),
+            bindparam("patientids", patientids, type_=ARRAY(String)),
+            bindparam("organizations", organizations, type_=ARRAY(String)),
+        )
+        .table_valued("file", "numbertype", "patientid", "organization")
+        .render_derived(name="wanted")
+    )
+
+    numbers = (
+        select(
+            wanted.c.file,
+            orm.PatientRecord.pid,
+            orm.PatientRecord.ukrdcid,
+            func.bool_or(wanted.c.numbertype == "MRN").label("mrn"),
+            func.bool_or(wanted.c.numbertype == "NI").label("ni"),
+        )
+        .select_from(wanted)
+        .join(
+            orm.PatientNumber,
+            and_(
+                orm.PatientNumber.patientid == wanted.c.patientid,
+                orm.PatientNumber.organization == wanted.c.organization,
+                orm.PatientNumber.numbertype == wanted.c.numbertype,
+            ),
+        )
+        .join(orm.PatientRecord, orm.PatientRecord.pid == orm.PatientNumber.pid)
+        .join(
+            feeds,
+            and_(
+                feeds.c.file == wanted.c.file,
+                feeds.c.sendingfacility == orm.PatientRecord.sendingfacility,
+                feeds.c.sendingextract == orm.PatientRecord.sendingextract,
+            ),
+        )
+        .group_by(wanted.c.file, orm.PatientRecord.pid, orm.PatientRecord.ukrdcid)
+        .cte("numbers")
+    )
+
+    blocking_issue = (
+        select(PatientID.id)
+        .join(LinkPatientToIssue, PatientID.id == LinkPatientToIssue.c.patient_id)
+        .join(Issue, Issue.id == LinkPatientToIssue.c.issue_id)
+        .where(blocking_issue_criteria(numbers.c.pid))
+    )
+
+    return (
+        select(
+            numbers.c.file,
+            numbers.c.pid,
+            numbers.c.ukrdcid,
+            numbers.c.mrn,
+            numbers.c.ni,
+            orm.Patient.pid.label("patient_pid"),
+            orm.Patient.birthtime,
+            blocking_issue.exists().label("blocked"),
+        )
+        .outerjoin(orm.Patient, orm.Patient.pid == numbers.c.pid)
+        .order_by(numbers.c.file, numbers.c.pid)
+    )
+
+
+def match_feeds(session: Session, patient_infos: List[dict]) -> List[FeedMatch]:
+    """match_feed for many files in a single query.
+
+    Args:
+        session (Session): ukrdc database session
+        patient_infos (List[dict]): demographic information from each file
+
+    Returns:
+        List[FeedMatch]: matches for each file in the same order
+    """
+    matches = [FeedMatch([], [], {}, set()) for _ in patient_infos]
+    if patient_infos:
+        for row in session.execute(feed_matches_query(patient_infos)):
+            add_feed_match_row(matches[row.file], row)
+
+    return matches
+
+
+def match_pid(
+    ukrdc_session: Session, patient_info: dict, feed_match: FeedMatch = None
+) -> Any:
     """See documentation for overview of how this is working:
     https://renalregistry.atlassian.net/wiki/x/BQAfkw
 
@@ -211,14 +472,18 @@ def match_pid(ukrdc_session: Session, patient_info: dict) -> Any:
     Args:
         ukrdc_session (Session): _description_
         patient_info (dict): _description_
+        feed_match (FeedMatch, optional): result of match_feed, looked up if
+        not given
 
     Returns:
         Any: _description_
     """
 
     # match patients on mrn and NI
-    matched_patients_mrn = match_mrn(ukrdc_session, patient_info)
-    matched_patients_ni = match_ni(ukrdc_session, patient_info)
+    if feed_match is None:
+        feed_match = match_feed(ukrdc_session, patient_info)
+    matched_patients_mrn = feed_match.mrn
+    matched_patients_ni = feed_match.ni
     matched_mrn_no = len(matched_patients_mrn)
     matched_ni_no = len(matched_patients_ni)
 
@@ -244,8 +509,8 @@ def match_pid(ukrdc_session: Session, patient_info: dict) -> Any:
     # alternatively this could easily be done by a separate process maybe
     # the one that issue the UKRR_UID in the first place.
     is_anon = patient_info["MRN"][1] == "UKRR_UID"
-    is_valid = validate_demog(
-        ukrdc_session, patient_info["birth_time"], pid, is_anon=is_anon
+    is_valid = check_demog(
+        feed_match.birth_times[pid], patient_info["birth_time"], is_anon=is_anon
     )
 
     if not is_valid:
@@ -282,7 +547,9 @@ def match_pid(ukrdc_session: Session, patient_info: dict) -> Any:
             return pid, ukrdcid, None
 
 
-def identify_patient_feed(ukrdc_session: Session, patient_info: dict) -> Any:
+def identify_patient_feed(
+    ukrdc_session: Session, patient_info: dict, feed_match: FeedMatch = None
+) -> Any:
     """
     Function matches xml file to patient feed and checks for open
     investigations against that patient. If a successful match is made
@@ -293,31 +560,20 @@ def identify_patient_feed(ukrdc_session: Session, patient_info: dict) -> Any:
     Args:
         ukrdc_session (Session): _description_
         patient_info (dict): _description_
+        feed_match (FeedMatch, optional): result of match_feed, looked up if
+        not given
 
     Returns:
         Any: _description_
     """
-    pid, ukrdcid, investigation = match_pid(ukrdc_session, patient_info)
+    if feed_match is None:
+        feed_match = match_feed(ukrdc_session, patient_info)
+    pid, ukrdcid, investigation = match_pid(ukrdc_session, patient_info, feed_match)
 
     # if pid has been found but there were previously problems we generate a
     # new investigation
     if pid is not None:
-        query = (
-            select(PatientID)
-            .join(LinkPatientToIssue, PatientID.id == LinkPatientToIssue.c.patient_id)
-            .join(Issue, Issue.id == LinkPatientToIssue.c.issue_id)
-            .where(
-                and_(
-                    PatientID.pid == pid,
-                    Issue.is_blocking is True,
-                    Issue.is_resolved is False,
-                )
-            )
-            .limit(1)
-        )
-        open_investigation = ukrdc_session.execute(query).scalar_one_or_none()
-
-        if open_investigation is not None:
+        if pid in feed_match.blocked:
             investigation = Investigation(ukrdc_session, [(pid, ukrdcid)], 7)
             pid = None
             ukrdcid = None
@@ -325,6 +581,44 @@ def identify_patient_feed(ukrdc_session: Session, patient_info: dict) -> Any:
     return pid, ukrdcid, investigation
 
 
+def match_many(
+    ukrdc_session: Session,
+    patient_infos: List[dict],
+    batch_size: int = MATCH_BATCH_SIZE,
+) -> List[Tuple[Optional[str], Optional[str], Optional[Investigation]]]:
+    """identify_patient_feed for a backlog of files. The database is queried
+    once per batch of files (see match_feeds) rather than for each file, the
+    decisions are made with the same rules. Files are matched against the
+    database as it stands so files for a new patient aren't matched to each
+    other. Investigations are raised as they would be for a single file.
+
+    This makes it unsuitable for storing a backlog in one go, the matches of
+    later files would miss the patients and numbers written by earlier ones.
+    process_xml_directory.py and force_quarantined match each file as it is
+    stored for this reason. It is meant for reporting on a backlog, e.g.
+    which files would raise investigations, before any of it is stored.
+
+    Args:
+        ukrdc_session (Session): ukrdc database session
+        patient_infos (List[dict]): demographic information from each file,
+        see read_patient_metadata
+        batch_size (int, optional): files matched by each query
+
+    Returns:
+        List[Tuple[Optional[str], Optional[str], Optional[Investigation]]]:
+        pid, ukrdcid and investigation for each file in the same order
+    """
+    results = []
+    for start in range(0, len(patient_infos), batch_size):
+        batch = patient_infos[start : start + batch_size]
+        for patient_info, feed_match in zip(batch, match_feeds(ukrdc_session, batch)):
+            results.append(
+                identify_patient_feed(ukrdc_session, patient_info, feed_match)
+            )
+
+    return results
+
+
 '''
 def identify_patient_feed(ukrdc_session: Session, patient_info: dict) -> Any:
     """Identify patient based on patient numbers. It uses a combination of
@@ -421,6 +715,57 @@ def match_ukrdc(session: Session, patient_ids: List[List[str]]) -> Any:
     return session.execute(ukrdc_query).fetchall()
 
 
+def match_ukrdc_demog(
+    session: Session, patient_ids: List[List[str]]
+) -> Dict[str, Tuple[List[str], List[Optional[datetime]]]]:
+    """match_ukrdc and the birth times validate_demog_ukrdc looks up for each
+    matched ukrdcid in a single query.
+
+    Args:
+        session (Session): ukrdc database session
+        patient_ids (List[List[str]]): patient numbers and organisations
+
+    Returns:
+        Dict[str, Tuple[List[str], List[Optional[datetime]]]]: matched pids
+        and the birth times of every record of each matched ukrdcid
+    """
+    matched = (
+        select(orm.PatientRecord.pid, orm.PatientRecord.ukrdcid)
+        .join(orm.PatientNumber, orm.PatientNumber.pid == orm.PatientRecord.pid)
+        .where(
+            tuple_(orm.PatientNumber.patientid, orm.PatientNumber.organization).in_(
+                patient_ids
+            )
+        )
+        .group_by(orm.PatientRecord.pid, orm.PatientRecord.ukrdcid)
+        .cte("matched")
+    )
+
+    # birth times of all the records of the ukrdcid, not just the matched ones
+    group_record = aliased(orm.PatientRecord)
+    birth_times = (
+        select(func.array_agg(distinct(orm.Patient.birthtime)))
+        .join(group_record, group_record.pid == orm.Patient.pid)
+        .where(group_record.ukrdcid == matched.c.ukrdcid)
+        .scalar_subquery()
+    )
+
+    query = (
+        select(
+            matched.c.ukrdcid,
+            func.array_agg(aggregate_order_by(matched.c.pid, matched.c.pid)),
+            birth_times,
+        )
+        .group_by(matched.c.ukrdcid)
+        .order_by(func.min(matched.c.pid))
+    )
+
+    return {
+        ukrdcid: (pids, dobs or [])
+        for ukrdcid, pids, dobs in session.execute(query)
+    }
+
+
 def identify_across_ukrdc(ukrdc_session: Session, patient_info: dict) -> Any:
     """Since merging and unmerging patients with ukrdc is easier in the case where a problem arises we just create a new patient and load the file.
 
@@ -434,13 +779,14 @@ def identify_across_ukrdc(ukrdc_session: Session, patient_info: dict) -> Any:
 
     # certain types of MRN can also be used for matching
     if patient_info["MRN"][1] in ["CHI", "HSC", "NHS"]:
-        ids = ids + patient_info
+        ids = ids + [patient_info["MRN"]]
 
-    matched_ids = match_ukrdc(ukrdc_session, ids)
-    matched_ukrdcids = []
-    for _, ukrdcid in matched_ids:
-        if ukrdcid not in matched_ukrdcids:
-            matched_ukrdcids.append(ukrdcid)
+    matched_ukrdcids = match_ukrdc_demog(ukrdc_session, ids)
+    matched_ids = [
+        (pid, ukrdcid)
+        for ukrdcid, (pids, _) in matched_ukrdcids.items()
+        for pid in pids
+    ]
 
     # handle results of ukrdc matches
     if len(matched_ukrdcids) == 0:
@@ -448,10 +794,8 @@ def identify_across_ukrdc(ukrdc_session: Session, patient_info: dict) -> Any:
 
     elif len(matched_ukrdcids) == 1:
         # verify dem0graphics
-        ukrdcid = matched_ukrdcids[0]
-        is_valid = validate_demog_ukrdc(
-            ukrdc_session, patient_info["birth_time"], ukrdcid
-        )
+        ((ukrdcid, (_, dob_ukrdc)),) = matched_ukrdcids.items()
+        is_valid = check_demog_ukrdc(dob_ukrdc, patient_info["birth_time"])
         if is_valid:
             return ukrdcid, None
         else:
@@ -5,6 +5,7 @@ merge on pid.
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 from ukrdc_sqla.ukrdc import PatientRecord
+from ukrdc_cupid.core.match.cache import notify_match_change
 from ukrdc_cupid.core.store.keygen import mint_new_ukrdcid, mint_new_pid
 from ukrdc_cupid.core.investigate.models import (
     Issue,
@@ -12,7 +13,7 @@ from ukrdc_cupid.core.investigate.models import (
     PatientID,
     LinkPatientToIssue,
 )
-from ukrdc_cupid.core.parse.utils import load_xml_from_str
+from ukrdc_cupid.core.parse.utils import XmlPipeline
 from ukrdc_cupid.core.store.insert import insert_incoming_data, process_file
 
 from typing import List
@@ -34,6 +35,7 @@ def ukrdcid_split_merge(session: Session, pid: str, ukrdcid: str = None):
         ukrdcid = mint_new_ukrdcid(session=session)
 
     patientrecord.ukrdcid = ukrdcid
+    notify_match_change(session, pids=[pid])
     session.commit()
 
     return
@@ -86,18 +88,32 @@ def force_quarantined(
 
     xml_file_id = issue_to_merge.xml_file_id
     file_orm = session.get(XmlFile, xml_file_id)
-    xml_file = load_xml_from_str(file_orm.file)
+    pipeline = XmlPipeline(file_orm.file)
+    file_hash = pipeline.content_hash
+    xml_file = pipeline.decode()
 
-    # write to record with the specific pid
+    # write to record with the specific pid, with the hash of the raw file
+    # like process_file does so the next copy of the file is recognised
     # does exception need to be handled here?
-    insert_incoming_data(session, pid, ukrdcid, xml_file, is_new)
+    insert_incoming_data(
+        session,
+        pid,
+        ukrdcid,
+        xml_file,
+        is_new,
+        file_hash=file_hash,
+        xml_body=file_orm.file,
+    )
     file_orm.is_reprocessed = True
 
     # auto resolve all blocking issues associated with the same file
     # (it's difficult to see how they could be resolved once it has been merged)
     if auto_resolve:
+        resolved_pids = []
         for issue in file_orm.issues:
             issue.is_resolved = True
+            resolved_pids.extend(patient.pid for patient in issue.patients)
+        notify_match_change(session, pids=resolved_pids)
 
     # merge any files which have been held up this investigation
     if process_blocked:
@@ -1,12 +1,13 @@
 import hashlib
 import copy
 
-from typing import Dict
+from typing import Dict, Optional, Tuple, Union
 from lxml import etree  # nosec B410
 from xsdata.formats.dataclass.parsers import XmlParser
+from xsdata.formats.dataclass.parsers.handlers import LxmlEventHandler
 from ukrdc_xsdata.ukrdc import PatientRecord  # type:ignore
 from ukrdc_cupid.core.parse.xml_validate import (
-    validate_rda_xml_string,
+    validate_rda_xml_tree,
     SUPPORTED_VERSIONS,
 )
 from ukrdc_cupid.core.parse.exceptions import SchemaInvalidError
@@ -18,20 +19,52 @@ CURRENT_SCHEMA = max(SUPPORTED_VERSIONS)
 
 serializer = XmlSerializer()
 
+# Attributes which change every time a file is sent without the content of
+# the file changing. They are left out of the file hash.
+VOLATILE_ATTRIBUTES = {
+    "SendingFacility": ("batchNo", "time"),
+    "LabOrders": ("start", "stop"),
+    "Observations": ("start", "stop"),
+    "DialysisSessions": ("start", "stop"),
+}
 
-def get_file_metadata(xml_str: str) -> Dict[str, str]:
-    """Get file meta data without assuming it conforms to xsdata schema
+# Hashes are stored in patientrecord.channelid (50 characters). The prefix
+# distinguishes canonical hashes of raw files from canonical hashes of
+# decoded files rendered back to xml (see hash_xml), which aren't comparable,
+# and from those generated by hash_xml_legacy.
+HASH_PREFIX = "c1:"
+RENDERED_HASH_PREFIX = "r1:"
+HASH_LENGTH = 50
+
+
+def parse_xml_tree(xml: Union[str, bytes]) -> etree._Element:
+    """Parse an xml file into an lxml tree. Comments are dropped and entities
+    are not resolved.
 
     Args:
-        xml_str (str): XML file as a string.
+        xml (Union[str, bytes]): XML file as a utf-8 string or bytes.
 
     Returns:
-        Dict[str, str]: Dictionary of metadata from the file heade.
+        etree._Element: Root element of the document.
     """
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
 
-    xml_doc = etree.fromstring(  # nosec
-        xml_str, parser=etree.XMLParser(encoding="utf-8")
+    parser = etree.XMLParser(
+        encoding="utf-8", remove_comments=True, resolve_entities=False
     )
+    return etree.fromstring(xml, parser=parser)  # nosec
+
+
+def get_tree_metadata(xml_doc: etree._Element) -> Dict[str, str]:
+    """Get file meta data from an already parsed xml file.
+
+    Args:
+        xml_doc (etree._Element): Root element of the parsed file.
+
+    Returns:
+        Dict[str, str]: Dictionary of metadata from the file header.
+    """
     sending_facility = xml_doc.find(".//SendingFacility")
     metadata = {
         "batch_no": sending_facility.get("batchNo"),
@@ -45,6 +78,109 @@ def get_file_metadata(xml_str: str) -> Dict[str, str]:
     return metadata
 
 
+def get_file_metadata(xml_str: str) -> Dict[str, str]:
+    """Get file meta data without assuming it conforms to xsdata schema
+
+    Args:
+        xml_str (str): XML file as a string.
+
+    Returns:
+        Dict[str, str]: Dictionary of metadata from the file heade.
+    """
+
+    return get_tree_metadata(parse_xml_tree(xml_str))
+
+
+class XmlPipeline:
+    """Parses an incoming file into an lxml tree exactly once. Validation,
+    metadata and decoding into the xsdata model all then work from the same
+    tree rather than each parsing the raw text again.
+
+    Note that decoding clears the tree as it goes to keep memory down so it
+    has to be the last step.
+
+    Args:
+        xml (Union[str, bytes]): xml file as a utf-8 string or bytes
+    """
+
+    def __init__(self, xml: Union[str, bytes]):
+        self.tree: Optional[etree._Element] = parse_xml_tree(xml)
+        self._metadata: Optional[Dict[str, str]] = None
+        self._content_hash: Optional[str] = None
+        self._section_hashes: Optional[Dict[str, str]] = None
+
+    def _get_tree(self) -> etree._Element:
+        if self.tree is None:
+            raise RuntimeError("XML tree has already been decoded")
+        return self.tree
+
+    @property
+    def metadata(self) -> Dict[str, str]:
+        if self._metadata is None:
+            self._metadata = get_tree_metadata(self._get_tree())
+        return self._metadata
+
+    @property
+    def content_hash(self) -> str:
+        if self._content_hash is None:
+            self._content_hash = hash_xml_tree(self._get_tree())
+        return self._content_hash
+
+    @property
+    def section_hashes(self) -> Dict[str, str]:
+        # the file hash comes for free so if both are needed ask for these
+        # first
+        if self._section_hashes is None:
+            tree = self._get_tree()
+            self._content_hash, self._section_hashes = hash_xml_tree_sections(tree)
+        return self._section_hashes
+
+    def check_current_schema(self) -> None:
+        """Check schema version matches the current xsdata version
+
+        Raises:
+            SchemaVersionError: if the schema version is not supported
+        """
+        schema_version = self.metadata["schema_version"]
+        if schema_version < CURRENT_SCHEMA:
+            msg = f"XML request on version {schema_version} but cupid requires version {CURRENT_SCHEMA}"
+            raise SchemaVersionError(msg)
+
+    def validate(self, schema_version: str = CURRENT_SCHEMA) -> None:
+        """Check the tree is valid against the schema
+
+        Raises:
+            SchemaInvalidError: if the file is not valid against the schema
+        """
+        errors = validate_rda_xml_tree(self._get_tree(), schema_version)
+        if not errors:
+            print("file successfully validated")
+        else:
+            error_table = "\n".join(
+                f"Line {line}: {error}" for line, error in errors.items()
+            )
+            raise SchemaInvalidError(
+                f"File failed validation with errors:\n{error_table}"
+            )
+
+    def decode(self) -> PatientRecord:
+        """Feed the tree to the xsdata decoder. The tree is consumed in the
+        process.
+
+        Returns:
+            PatientRecord: xsdata model of the xml
+        """
+        tree = self._get_tree()
+
+        # keep hold of the metadata since the tree won't be usable afterwards
+        # the hashes on the other hand have to be asked for before decoding
+        self._metadata = self.metadata
+        self.tree = None
+
+        parser = XmlParser(handler=LxmlEventHandler)
+        return parser.parse(tree, PatientRecord)
+
+
 def load_xml_from_str(
     xml_str: str, check_current_schema: bool = False, validate: bool = False
 ) -> PatientRecord:
@@ -66,27 +202,15 @@ def load_xml_from_str(
         PatientRecord: xsdata model of the xml
     """
 
+    pipeline = XmlPipeline(xml_str)
+
     if check_current_schema:
-        # Check schema version matches the current xsdata version
-        metadata = get_file_metadata(xml_str)
-        if metadata["schema_version"] < CURRENT_SCHEMA:
-            msg = f"XML request on version {metadata['schema_version']} but cupid requires version {CURRENT_SCHEMA}"
-            raise SchemaVersionError(msg)
+        pipeline.check_current_schema()
 
     if validate:
-        # Check string is valid against xsdata schema
-        errors = validate_rda_xml_string(xml_str)
-        if not errors:
-            print("file successfully validated")
-        else:
-            error_table = "\n".join(
-                f"Line {line}: {error}" for line, error in errors.items()
-            )
-            raise SchemaInvalidError(
-                f"File failed validation with errors:\n{error_table}"
-            )
+        pipeline.validate()
 
-    return XmlParser().from_string(xml_str, PatientRecord)
+    return pipeline.decode()
 
 
 def load_xml_from_path(
@@ -104,11 +228,142 @@ def load_xml_from_path(
         raise Exception(f"Failed to load XML from path {filepath}") from e
 
 
+def _canonical_element(element: etree._Element, volatile: Tuple[str, ...]) -> bytes:
+    # attributes and text are marked so an attribute can't be mistaken for
+    # text which reads the same
+    parts = [element.tag]
+    for key in sorted(element.attrib.keys()):
+        if key not in volatile:
+            parts.append(f"@{key}={element.attrib[key]}")
+
+    # whitespace only text is formatting, the same as no text at all
+    text = element.text.strip() if element.text is not None else ""
+    if text:
+        parts.append(f"#{text}")
+
+    return ("\x00".join(parts) + "\x01").encode("utf-8")
+
+
+def hash_xml_tree_sections(
+    xml_doc: etree._Element, prefix: str = HASH_PREFIX
+) -> Tuple[str, Dict[str, str]]:
+    """
+    Produce the canonical hash of a parsed file (see hash_xml_tree) along with
+    a digest of each of its top level sections (Patient, LabOrders,
+    Medications...) keyed by tag, all in the same walk of the tree. Unlike
+    the file hash the section digests include the start/stop of the windowed
+    sections since they decide which records of the section get removed.
+
+    Args:
+        xml_doc (etree._Element): Root element of the parsed file.
+        prefix (str, optional): Defaults to HASH_PREFIX.
+
+    Returns:
+        Tuple[str, Dict[str, str]]: file hash and section digests
+    """
+    digest = hashlib.sha256()
+    sections: Dict[str, str] = {}
+    section_digest = None
+    depth = 0
+    for event, element in etree.iterwalk(xml_doc, events=("start", "end")):
+        tag = element.tag
+        if not isinstance(tag, str):
+            continue
+
+        if event == "end":
+            digest.update(b"\x00/\x00")
+            depth -= 1
+            if section_digest is not None:
+                section_digest.update(b"\x00/\x00")
+                if depth == 1:
+                    sections[tag] = section_digest.hexdigest()
+                    section_digest = None
+            continue
+
+        depth += 1
+        if depth == 2:
+            section_digest = hashlib.sha256()
+
+        volatile = VOLATILE_ATTRIBUTES.get(tag, ())
+        canonical = _canonical_element(element, volatile)
+        digest.update(canonical)
+        if section_digest is not None:
+            if volatile:
+                canonical = _canonical_element(element, ())
+            section_digest.update(canonical)
+
+    file_hash = (prefix + digest.hexdigest())[:HASH_LENGTH]
+    return file_hash, sections
+
+
+def hash_xml_tree(xml_doc: etree._Element, prefix: str = HASH_PREFIX) -> str:
+    """
+    Produce a canonical hash of a parsed file. The tree is walked once and fed
+    into sha256 element by element so no copy of the file is ever made. Tags,
+    attributes (in sorted order) and stripped text go into the hash while
+    comments, whitespace, namespace prefixes and the volatile attributes in
+    VOLATILE_ATTRIBUTES are left out.
+
+    Args:
+        xml_doc (etree._Element): Root element of the parsed file.
+        prefix (str, optional): Defaults to HASH_PREFIX.
+
+    Returns:
+        str: prefixed hash which fits in patientrecord.channelid
+    """
+    digest = hashlib.sha256()
+    for event, element in etree.iterwalk(xml_doc, events=("start", "end")):
+        tag = element.tag
+        if not isinstance(tag, str):
+            continue
+
+        if event == "end":
+            digest.update(b"\x00/\x00")
+            continue
+
+        digest.update(_canonical_element(element, VOLATILE_ATTRIBUTES.get(tag, ())))
+
+    return (prefix + digest.hexdigest())[:HASH_LENGTH]
+
+
+def render_xml_tree(xml: PatientRecord) -> etree._Element:
+    """Render a decoded file back into an lxml tree so it can be hashed"""
+    return parse_xml_tree(serializer.render(xml))
+
+
 def hash_xml(xml: PatientRecord) -> str:
+    """
+    Canonical hash of a decoded file rendered back to xml, for callers which
+    don't have the raw file. xsdata doesn't render values exactly as they
+    were sent (e.g. "18:13:51.0" comes back as "18:13:51") so this is not
+    the hash of the raw file and has its own prefix. Where the raw file is
+    available use XmlPipeline.content_hash.
+    """
+    return hash_xml_tree(render_xml_tree(xml), RENDERED_HASH_PREFIX)
+
+
+def is_rendered_hash(file_hash: Optional[str]) -> bool:
+    """Check whether a stored hash was generated by hash_xml"""
+    return file_hash is not None and file_hash.startswith(RENDERED_HASH_PREFIX)
+
+
+def is_legacy_hash(file_hash: Optional[str]) -> bool:
+    """Check whether a stored hash was generated by hash_xml_legacy"""
+    return (
+        file_hash is not None
+        and not file_hash.startswith(HASH_PREFIX)
+        and not is_rendered_hash(file_hash)
+    )
+
+
+def hash_xml_legacy(xml: PatientRecord) -> str:
     """
     Take file strip dates etc and produce a hashed version of it. This is
     pretty quick overall but there becomes a point where this sort of thing
     will probably stop saving time.
+
+    This was superseded by hash_xml_tree. It is only kept so that hashes
+    stored before the switch can still be checked (and upgraded).
     """
     xml_copy = copy.deepcopy(xml)
 
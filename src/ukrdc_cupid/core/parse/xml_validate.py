@@ -8,10 +8,11 @@ Note that the RDA schema versioning is one behind that of the UKRR Dataset
 
 import os
 import shutil
+import threading
 from git import Repo
 from lxml import etree  # nosec B410
 from pydantic import Field
-from typing import Tuple, Union
+from typing import Dict, Iterable, Tuple, Union
 from platformdirs import user_data_dir
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -63,11 +64,28 @@ class Settings(BaseSettings):
         validation_alias="V4_2_0_COMMIT",
     )
 
+    # compile every supported schema when the api starts up rather than on
+    # the first request for each version
+    warm_schema_cache: bool = Field(
+        default=False,
+        validation_alias="CUPID_WARM_SCHEMA_CACHE",
+    )
+
 
 env_variables = Settings()
 
 SUPPORTED_VERSIONS = ["3.3.0", "3.3.1", "3.4.5", "4.0.0", "4.1.0", "4.2.0"]
 
+# Compiling the schema (with all its includes) costs far more than validating
+# a typical file so compiled schemas are cached for the life of the process.
+# They are keyed on version and commit so changing the pinned commit picks up
+# a fresh schema. lxml schema objects keep their error log on the instance so
+# each one gets its own lock to stop concurrent validations mixing errors.
+_schema_cache: Dict[
+    Tuple[str, str], Tuple[etree.XMLSchema, str, threading.Lock]
+] = {}
+_schema_cache_lock = threading.Lock()
+
 
 def download_ukrdc_schema(filepath: str, schema_version: str) -> None:
     """
@@ -100,9 +118,24 @@ def download_ukrdc_schema(filepath: str, schema_version: str) -> None:
     shutil.rmtree(repo_dir, ignore_errors=True)
 
 
-def load_schema(schema_version: str) -> Tuple[etree.XMLSchema, str]:
+def get_schema_commit(schema_version: str) -> str:
+    """Look up the commit of the resources repo a schema version is pinned to.
+
+    Raises:
+        ValueError: If an unsupported schema version is provided.
     """
-    Locate the schema locally and load it into lxml so it can be used for validation.
+    if schema_version in SUPPORTED_VERSIONS:
+        formatted_ver = schema_version.replace(".", "_")
+        return getattr(env_variables, f"v{formatted_ver}_commit")
+    else:
+        raise ValueError(f"Unsupported schema version {schema_version}")
+
+
+def compile_schema(schema_version: str) -> Tuple[etree.XMLSchema, str]:
+    """
+    Locate the schema locally and compile it with lxml, downloading it first if
+    it isn't available. Use load_schema instead unless you specifically need a
+    fresh copy.
 
     Args:
         schema_version (int): Major release version of the schema being loaded.
@@ -115,11 +148,8 @@ def load_schema(schema_version: str) -> Tuple[etree.XMLSchema, str]:
     """
 
     # assemble the information required to load locally stored xsd schema and complain if unsupported version is used
-    if schema_version in SUPPORTED_VERSIONS:
-        formatted_ver = schema_version.replace(".", "_")
-        commit = getattr(env_variables, f"v{formatted_ver}_commit")
-    else:
-        raise ValueError(f"Unsupported schema version {schema_version}")
+    commit = get_schema_commit(schema_version)
+    formatted_ver = schema_version.replace(".", "_")
 
     xsd_file_path = os.path.join(
         env_variables.appdata_dir,
@@ -138,6 +168,60 @@ def load_schema(schema_version: str) -> Tuple[etree.XMLSchema, str]:
     return etree.XMLSchema(xsd_doc), xsd_file_path
 
 
+def _get_cached_schema(
+    schema_version: str,
+) -> Tuple[etree.XMLSchema, str, threading.Lock]:
+    key = (schema_version, get_schema_commit(schema_version))
+
+    cached = _schema_cache.get(key)
+    if cached is None:
+        # only one thread compiles (or downloads) a given schema
+        with _schema_cache_lock:
+            cached = _schema_cache.get(key)
+            if cached is None:
+                xml_schema, xsd_file_path = compile_schema(schema_version)
+                cached = (xml_schema, xsd_file_path, threading.Lock())
+                _schema_cache[key] = cached
+
+    return cached
+
+
+def load_schema(schema_version: str) -> Tuple[etree.XMLSchema, str]:
+    """
+    Load the compiled schema for a version. Schemas are compiled the first time
+    they are requested and then cached for the life of the process.
+
+    Args:
+        schema_version (int): Major release version of the schema being loaded.
+
+    Returns:
+        tuple: Tuple containing the XSD schema and the file path where it's located.
+
+    Raises:
+        ValueError: If an unsupported schema version is provided.
+    """
+
+    xml_schema, xsd_file_path, _ = _get_cached_schema(schema_version)
+    return xml_schema, xsd_file_path
+
+
+def warm_schema_cache(versions: Iterable[str] = SUPPORTED_VERSIONS) -> None:
+    """Compile schemas ahead of time so the first validation against each
+    version doesn't pay for it.
+
+    Args:
+        versions (Iterable[str], optional): Versions to compile. Defaults to
+        all supported versions.
+    """
+    for schema_version in versions:
+        _get_cached_schema(schema_version)
+
+
+def clear_schema_cache() -> None:
+    with _schema_cache_lock:
+        _schema_cache.clear()
+
+
 def validate_rda_xml_string(
     rda_xml: str, schema_version: str = max(SUPPORTED_VERSIONS)
 ) -> Union[dict, None]:
@@ -155,19 +239,39 @@ def validate_rda_xml_string(
     # Load the XML file
     xml_doc = etree.XML(rda_xml.encode())
 
-    # Load the schema
-    xml_schema, _ = load_schema(schema_version)
+    return validate_rda_xml_tree(xml_doc, schema_version)
 
-    # Initially catch errors to allow more specific processing of errors
-    try:
-        xml_schema.assertValid(xml_doc)
-        return None
 
-    except etree.DocumentInvalid:
-        # return errors as dictionary
-        errors = {}
-        ## what reason is there for not just returning the error log
-        for error in xml_schema.error_log:  # type:ignore
-            errors[f"line {error.line}"] = error.message
+def validate_rda_xml_tree(
+    xml_doc: etree._Element, schema_version: str = max(SUPPORTED_VERSIONS)
+) -> Union[dict, None]:
+    """
+    Validate an already parsed RDA XML document against the UKRDC schema. This
+    allows a file which has been parsed once to be validated without parsing
+    the string again.
+
+    Args:
+        xml_doc (etree._Element): Root element of the parsed XML file.
+        schema_version (str): Version of the dataset to check the XML against.
+
+    Returns:
+        dict or None: If validation fails, returns a dictionary of errors (None if validation passes).
+    """
 
-        return errors
+    # Load the schema
+    xml_schema, _, schema_lock = _get_cached_schema(schema_version)
+
+    # Initially catch errors to allow more specific processing of errors
+    with schema_lock:
+        try:
+            xml_schema.assertValid(xml_doc)
+            return None
+
+        except etree.DocumentInvalid:
+            # return errors as dictionary
+            errors = {}
+            ## what reason is there for not just returning the error log
+            for error in xml_schema.error_log:  # type:ignore
+                errors[f"line {error.line}"] = error.message
+
+            return errors
@@ -0,0 +1,147 @@
+"""
+Fast paths for writing records without the session unit of work.
+
+New patients: there is nothing in the database to compare a new patient
+against so the records don't need to go through the session unit of work
+(change tracking, identity map and a single row INSERT per object at flush).
+Instead the mapped orm objects are turned into plain rows and written with a
+multi-row INSERT per table:
+
+    INSERT INTO observation (id, pid, ...) VALUES (...), (...), ...
+
+Existing patients (bulk write mode): the new and modified records are
+written with one upsert per table and set of columns rather than an INSERT
+or UPDATE per object at flush:
+
+    INSERT INTO resultitem (...) VALUES (...), (...), ...
+    ON CONFLICT (id) DO UPDATE SET resultvalue = excluded.resultvalue, ...
+
+Tables are written parents first so foreign keys are always satisfied.
+"""
+
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Tuple
+
+from sqlalchemy import inspect, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from ukrdc_cupid.core.store.delete import primary_key
+from ukrdc_cupid.core.store.exceptions import DataInsertionError
+
+
+def orm_to_row(orm_object: Any) -> Dict[str, Any]:
+    """Column values which have been set on an orm object. Anything not set
+    is left out so the column defaults apply as they would at flush.
+    """
+    state = inspect(orm_object)
+    return {
+        attr.key: state.dict[attr.key]
+        for attr in state.mapper.column_attrs
+        if attr.key in state.dict
+    }
+
+
+def dependency_order(orm_model: Any) -> int:
+    # position of the table in the metadata sorted by foreign key dependency
+    table = inspect(orm_model).local_table
+    return table.metadata.sorted_tables.index(table)
+
+
+def mark_written(orm_object: Any) -> None:
+    """Clear the pending changes of a record which has been written outside
+    the session, otherwise the next flush would write them again.
+    """
+    state = inspect(orm_object)
+    if not state.persistent:
+        return
+
+    for attr in state.mapper.column_attrs:
+        if state.attrs[attr.key].history.has_changes():
+            set_committed_value(orm_object, attr.key, state.dict.get(attr.key))
+
+
+class InsertionStage:
+    """New records of a patient record grouped into rows by table."""
+
+    def __init__(self, orm_objects: List[Any]):
+        # the same record can be reached through more than one node
+        self.orm_objects = list({id(obj): obj for obj in orm_objects}.values())
+        self.rows: Dict[Any, List[Dict[str, Any]]] = defaultdict(list)
+        for orm_object in self.orm_objects:
+            self.rows[type(orm_object)].append(orm_to_row(orm_object))
+
+    def statements(self) -> List[Any]:
+        """Orm models in the order they have to be inserted"""
+        return sorted(self.rows, key=dependency_order)
+
+    def batches(self, orm_model: Any) -> Iterator[Tuple[Any, List[dict]]]:
+        """Insert statements for the rows of a table
+
+        Yields:
+            Tuple[Any, List[dict]]: statement and the rows to execute it with
+        """
+        yield insert(orm_model), self.rows[orm_model]
+
+    def execute(self, session: Session) -> int:
+        """Write the rows.
+
+        Raises:
+            DataInsertionError: if any of the statements fail
+
+        Returns:
+            int: number of records inserted
+        """
+        inserted = 0
+        try:
+            for orm_model in self.statements():
+                for statement, rows in self.batches(orm_model):
+                    session.execute(statement, rows)
+                    inserted += len(rows)
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DataInsertionError("Failed to write patient records") from e
+
+        return inserted
+
+
+class UpsertStage(InsertionStage):
+    """New and modified records of an existing patient. Modified records are
+    still attached to the session so they are marked as written before any
+    statement can trigger an autoflush.
+    """
+
+    def batches(self, orm_model: Any) -> Iterator[Tuple[Any, List[dict]]]:
+        # the columns to update are fixed per statement so rows are grouped by
+        # the columns they set, otherwise missing values would be nulled
+        grouped: Dict[Tuple[str, ...], List[dict]] = defaultdict(list)
+        for row in self.rows[orm_model]:
+            grouped[tuple(sorted(row))].append(row)
+
+        mapper = inspect(orm_model)
+        key_column = primary_key(orm_model)
+        for keys, rows in grouped.items():
+            statement = pg_insert(orm_model)
+            columns = [mapper.column_attrs[key].columns[0] for key in keys]
+            update = {
+                column.name: statement.excluded[column.name]
+                for column in columns
+                if column.name != key_column.name
+            }
+            if update:
+                statement = statement.on_conflict_do_update(
+                    index_elements=[key_column], set_=update
+                )
+            else:
+                statement = statement.on_conflict_do_nothing(
+                    index_elements=[key_column]
+                )
+            yield statement, rows
+
+    def execute(self, session: Session) -> int:
+        for orm_object in self.orm_objects:
+            mark_written(orm_object)
+
+        return super().execute(session)
@@ -0,0 +1,218 @@
+"""
+Removal of records which are no longer in the incoming file. Rather than
+loading every mapped record into the session just to call session.delete on
+it, the mapping stage records which records of each table were kept (see
+Node.add_deleted) and the rest are removed with one statement per table:
+
+    DELETE FROM observation WHERE pid = :pid AND id <> ALL(:kept_ids)
+
+Children of removed records (e.g. the result items of a lab order) are
+removed first using the same criteria as a subquery.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import String, all_, any_, bindparam, delete, inspect, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import RelationshipDirection, Session
+
+from ukrdc_cupid.core.store.exceptions import DataInsertionError
+
+# (column, start, stop) restricting deletion to the period covered by a file
+Window = Tuple[Any, datetime, datetime]
+
+
+class Deletion:
+    """Records of a single table, belonging to a single parent, which should
+    be removed unless they appear in the incoming file.
+
+    Args:
+        orm_model (Any): orm class of the records
+        parent_column (Any): column of orm_model referencing the parent
+        parent_id (str): key of the parent
+        kept_nodes (list): nodes mapped from the incoming file. Their ids are
+        only read when the statement is built since some get changed after
+        mapping (see PatientRecord.deduplicate_keys).
+        window (Window, optional): only remove records within this period
+    """
+
+    def __init__(
+        self,
+        orm_model: Any,
+        parent_column: Any,
+        parent_id: str,
+        kept_nodes: list,
+        window: Optional[Window] = None,
+    ):
+        self.orm_model = orm_model
+        self.parent_column = parent_column
+        self.parent_id = parent_id
+        self.kept_nodes = kept_nodes
+        self.window = window
+
+    @classmethod
+    def from_relationship(
+        cls,
+        parent_orm: Any,
+        sqla_mapped: str,
+        kept_nodes: list,
+        window: Optional[Window] = None,
+    ) -> "Deletion":
+        """Build a deletion from the name of a one to many relationship of the
+        parent orm model, e.g. PatientRecord.observations.
+        """
+        parent_mapper = inspect(type(parent_orm))
+        relationship = parent_mapper.relationships[sqla_mapped]
+        local_column, remote_column = relationship.local_remote_pairs[0]
+
+        orm_model = relationship.mapper.class_
+        parent_key = parent_mapper.get_property_by_column(local_column).key
+        child_key = relationship.mapper.get_property_by_column(remote_column).key
+
+        return cls(
+            orm_model=orm_model,
+            parent_column=getattr(orm_model, child_key),
+            parent_id=getattr(parent_orm, parent_key),
+            kept_nodes=kept_nodes,
+            window=window,
+        )
+
+    @property
+    def kept_ids(self) -> List[str]:
+        return [node.orm_object.id for node in self.kept_nodes]
+
+    @property
+    def group_key(self) -> tuple:
+        # deletions with the same key can be merged into a single statement
+        window = None
+        if self.window is not None:
+            column, start, stop = self.window
+            window = (column.key, start, stop)
+        return (self.orm_model, self.parent_column.key, window)
+
+
+def primary_key(orm_model: Any) -> Any:
+    return inspect(orm_model).primary_key[0]
+
+
+def cascade_targets(orm_model: Any) -> Iterator[Tuple[Any, Any, Any]]:
+    """Children which the orm would delete along with a record of orm_model.
+
+    Yields:
+        Tuple[Any, Any, Any]: child model, child column referencing the
+        parent, parent column it references
+    """
+    for relationship in inspect(orm_model).relationships:
+        if (
+            relationship.direction == RelationshipDirection.ONETOMANY
+            and relationship.cascade.delete
+        ):
+            local_column, remote_column = relationship.local_remote_pairs[0]
+            yield relationship.mapper.class_, remote_column, local_column
+
+
+class DeletionStage:
+    """All the deletions staged while mapping a patient record. Deletions of
+    the same table are merged so, for example, the result items of every
+    lab order in the file are handled by a single statement.
+    """
+
+    def __init__(self, deletions: List[Deletion]):
+        self.groups: Dict[tuple, List[Deletion]] = defaultdict(list)
+        # records removed from each table by execute
+        self.deleted: Dict[Any, int] = defaultdict(int)
+        for deletion in deletions:
+            self.groups[deletion.group_key].append(deletion)
+
+    def criteria(self, deletions: List[Deletion]) -> list:
+        """Where clauses selecting the records of a group of deletions"""
+        first = deletions[0]
+        parent_ids = list({deletion.parent_id for deletion in deletions})
+        kept_ids = [id for deletion in deletions for id in deletion.kept_ids]
+
+        if len(parent_ids) == 1:
+            clauses = [first.parent_column == parent_ids[0]]
+        else:
+            clauses = [
+                first.parent_column
+                == any_(bindparam(None, parent_ids, type_=ARRAY(String)))
+            ]
+
+        if kept_ids:
+            clauses.append(
+                primary_key(first.orm_model)
+                != all_(bindparam(None, kept_ids, type_=ARRAY(String)))
+            )
+
+        if first.window is not None:
+            column, start, stop = first.window
+            clauses.append(column >= start)
+            clauses.append(column <= stop)
+
+        return clauses
+
+    def _with_cascade(
+        self, orm_model: Any, clauses: list
+    ) -> Iterator[Tuple[Any, list]]:
+        # children have to go before their parents
+        for child_model, child_column, parent_column in cascade_targets(orm_model):
+            parent_ids = select(parent_column).where(*clauses)
+            yield from self._with_cascade(
+                child_model, [child_column.in_(parent_ids)]
+            )
+
+        yield orm_model, clauses
+
+    def statements(self) -> Iterator[Tuple[Any, list]]:
+        """Where clauses for each table in the order they have to be run
+
+        Yields:
+            Tuple[Any, list]: orm model and where clauses
+        """
+        for deletions in self.groups.values():
+            orm_model = deletions[0].orm_model
+            yield from self._with_cascade(orm_model, self.criteria(deletions))
+
+    def execute(self, session: Session) -> int:
+        """Remove the records.
+
+        Raises:
+            DataInsertionError: if any of the statements fail
+
+        Returns:
+            int: number of records removed
+        """
+        deleted = 0
+        try:
+            for orm_model, clauses in self.statements():
+                query = (
+                    delete(orm_model)
+                    .where(*clauses)
+                    .execution_options(synchronize_session=False)
+                )
+                rowcount = session.execute(query).rowcount
+                self.deleted[orm_model] += rowcount
+                deleted += rowcount
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DataInsertionError(
+                "Failed to remove records missing from incoming file"
+            ) from e
+
+        return deleted
+
+    def preview(self, session: Session) -> Dict[Any, List[str]]:
+        """Look up the records which would be removed without removing them.
+
+        Returns:
+            Dict[Any, List[str]]: ids to be removed grouped by orm model
+        """
+        ids: Dict[Any, List[str]] = defaultdict(list)
+        for orm_model, clauses in self.statements():
+            query = select(primary_key(orm_model)).where(*clauses)
+            ids[orm_model] += session.execute(query).scalars().all()
+
+        return ids
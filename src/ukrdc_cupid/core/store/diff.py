@@ -0,0 +1,209 @@
+"""
+Dry run of storing a file: the file is matched and mapped against the
+database exactly as it would be for a real upload but nothing is written.
+Instead the records which would be inserted, updated and deleted are counted
+per table, along with the keys and columns involved if asked for. This is
+used to size bulk resends before they are scheduled.
+
+The work is done in a read only transaction which is rolled back at the end,
+so anything which would write (including raising an investigation while
+matching) fails rather than being applied. No advisory lock is taken.
+"""
+
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import ukrdc_xsdata.ukrdc as xsd_ukrdc  # type: ignore
+from pydantic import BaseModel
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from ukrdc_cupid.core.match.identify import (
+    identify_patient_feed,
+    read_patient_metadata,
+)
+from ukrdc_cupid.core.store.delete import DeletionStage
+from ukrdc_cupid.core.store.models.structure import RecordStatus
+from ukrdc_cupid.core.store.models.ukrdc import PatientRecord
+
+# stands in for the pid of a patient which doesn't exist yet, nothing is
+# minted in a dry run
+NEW_PATIENT_PID = "new"
+
+# columns set on every mapped record whether or not it has changed
+BOOKKEEPING_COLUMNS = frozenset(("pid", "idx", "repositoryupdatedate", "update_date"))
+
+
+class TableDiff(BaseModel):
+    """What storing the file would do to a single table"""
+
+    new: int = 0
+    modified: int = 0
+    unchanged: int = 0
+    deleted: int = 0
+    # keys of the modified records and the columns which would change
+    modified_keys: Optional[Dict[str, List[str]]] = None
+    deleted_keys: Optional[List[str]] = None
+
+
+class DataDiffResponse(BaseModel):
+    """
+    Response model for dry runs
+    """
+
+    pid: Optional[str] = None
+    is_new: bool = False
+    identical_to_last: bool = False
+    blocked: bool = False
+    msg: str = ""
+    tables: Dict[str, TableDiff] = {}
+    # records in sections which are the same as the last file, by section
+    skipped_sections: Dict[str, int] = {}
+
+    @property
+    def writes(self) -> int:
+        """Rows which would be inserted, updated or deleted"""
+        return sum(
+            table.new + table.modified + table.deleted for table in self.tables.values()
+        )
+
+
+def start_read_only(ukrdc_session: Session) -> None:
+    """Make the current transaction of the session read only"""
+    ukrdc_session.execute(text("SET TRANSACTION READ ONLY"))
+
+
+def changed_columns(orm_object) -> List[str]:
+    """Columns of a loaded record which have been changed by the mapping"""
+    state = inspect(orm_object)
+    return sorted(
+        key
+        for key in state.committed_state
+        if key not in BOOKKEEPING_COLUMNS and state.attrs[key].history.has_changes()
+    )
+
+
+def diff_incoming_data(
+    ukrdc_session: Session,
+    pid: str,
+    ukrdcid: str,
+    incoming_xml_file: xsd_ukrdc.PatientRecord,
+    is_new: bool = False,
+    file_hash: str = None,
+    skip_unchanged_sections: bool = False,
+    section_hashes: Dict[str, str] = None,
+    content_keys: bool = False,
+    show_changes: bool = False,
+) -> DataDiffResponse:
+    """Map the file onto the patient as insert_incoming_data would and report
+    what would be written. The session should be in a read only transaction
+    (see start_read_only), it is rolled back before returning.
+
+    Args:
+        show_changes (bool, optional): list the keys of the modified and
+        deleted records and the columns which would change. Defaults to False.
+        See insert_incoming_data for the rest.
+    """
+    response = DataDiffResponse(pid=pid, is_new=is_new)
+
+    patient_record = PatientRecord(
+        xml=incoming_xml_file,
+        file_hash=file_hash,
+        keep_xml=False,
+        skip_unchanged=skip_unchanged_sections,
+        section_hashes=section_hashes,
+        content_keys=content_keys,
+    )
+
+    try:
+        # the existing records are loaded with the bulk prefetch as usual
+        different_file = patient_record.map_to_database(
+            session=ukrdc_session,
+            ukrdcid=ukrdcid,
+            pid=pid,
+            is_new=is_new,
+        )
+        if not different_file:
+            response.identical_to_last = True
+            response.msg = "Incoming file matched hash for last inserted file."
+            return response
+
+        tables: Dict[str, TableDiff] = defaultdict(TableDiff)
+        collection = patient_record.collect(
+            statuses=[RecordStatus.NEW, RecordStatus.MODIFIED, RecordStatus.UNCHANGED]
+        )
+        for status, orm_objects in collection.orm_objects.items():
+            for orm_object in orm_objects:
+                table = tables[orm_object.__tablename__]
+                if status == RecordStatus.NEW:
+                    table.new += 1
+                elif status == RecordStatus.UNCHANGED:
+                    table.unchanged += 1
+                else:
+                    table.modified += 1
+                    if show_changes:
+                        if table.modified_keys is None:
+                            table.modified_keys = {}
+                        key = ":".join(str(part) for part in inspect(orm_object).identity)
+                        table.modified_keys[key] = changed_columns(orm_object)
+
+        # the mapped records mustn't be flushed by the deletion queries
+        with ukrdc_session.no_autoflush:
+            deleted = DeletionStage(collection.deletions).preview(ukrdc_session)
+        for orm_model, ids in deleted.items():
+            table = tables[orm_model.__tablename__]
+            table.deleted += len(ids)
+            if show_changes:
+                table.deleted_keys = sorted(ids)
+
+        response.tables = dict(tables)
+        response.skipped_sections = patient_record.skipped_sections
+    finally:
+        ukrdc_session.rollback()
+
+    return response
+
+
+def diff_file(
+    ukrdc_session: Session,
+    xml_object: xsd_ukrdc.PatientRecord,
+    file_hash: str = None,
+    **kwargs,
+) -> DataDiffResponse:
+    """Match the file to a patient and diff it against their records. A file
+    which would be blocked by an investigation, or which would raise one, is
+    reported as blocked. The keyword arguments are passed to
+    diff_incoming_data.
+    """
+    patient_info = read_patient_metadata(xml_object)
+    try:
+        pid, ukrdcid, investigation = identify_patient_feed(
+            ukrdc_session=ukrdc_session,
+            patient_info=patient_info,
+        )
+    except SQLAlchemyError as e:
+        # raising an investigation writes to the database
+        ukrdc_session.rollback()
+        return DataDiffResponse(
+            blocked=True, msg=f"Matching would raise an investigation: {e}"
+        )
+
+    if investigation:
+        ukrdc_session.rollback()
+        return DataDiffResponse(
+            blocked=True, msg="Writing to patient blocked by outstanding investigation"
+        )
+
+    is_new = pid is None
+    if is_new:
+        pid, ukrdcid = NEW_PATIENT_PID, NEW_PATIENT_PID
+
+    return diff_incoming_data(
+        ukrdc_session=ukrdc_session,
+        pid=pid,
+        ukrdcid=ukrdcid,
+        incoming_xml_file=xml_object,
+        is_new=is_new,
+        file_hash=file_hash,
+        **kwargs,
+    )
@@ -0,0 +1,101 @@
+"""
+Digests of the top level sections (Patient, LabOrders, Medications, ...) of
+the last file written for each patient. Most files differ from the last one
+in a section or two, typically lab orders and observations. When a file
+arrives the digest of each section is compared with the stored one and only
+the sections which have changed are mapped and diffed, the rest are skipped
+entirely (see PatientRecord.skipped_sections).
+
+A stored digest is only trusted if it was written with the file hash still
+held in patientrecord.channelid. The digests of every section are rewritten
+against the new hash each time a file is stored, so anything which clears or
+changes channelid (e.g. to force a file through again) also invalidates them.
+
+Sections written in ex-missing mode may still hold records which aren't in
+the file so no digest is kept for them.
+"""
+
+import hashlib
+from typing import Dict, List
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, delete, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from ukrdc_cupid.core.store.exceptions import DataInsertionError
+
+metadata = MetaData()
+
+SectionDigest = Table(
+    "sectiondigest",
+    metadata,
+    Column("pid", String, primary_key=True),
+    Column("section", String(50), primary_key=True),
+    Column("digest", String(64), nullable=False),
+    # records mapped from the section, these are reported as unchanged when
+    # the section is skipped
+    Column("records", Integer, nullable=False),
+    Column("filehash", String(50), nullable=False),
+)
+
+# digest of a section which isn't in the file
+EMPTY_DIGEST = hashlib.sha256().hexdigest()
+
+
+def load_unchanged_sections(
+    session: Session, pid: str, file_hash: str, digests: Dict[str, str]
+) -> Dict[str, int]:
+    """Find the sections of an incoming file which are the same as in the
+    last file written for the patient.
+
+    Args:
+        session (Session): ukrdc database session
+        pid (str): patient the file belongs to
+        file_hash (str): hash of the last file written (patientrecord.channelid)
+        digests (Dict[str, str]): digests of the incoming sections by tag
+
+    Returns:
+        Dict[str, int]: number of records in each unchanged section by tag
+    """
+    query = select(
+        SectionDigest.c.section, SectionDigest.c.digest, SectionDigest.c.records
+    ).where(SectionDigest.c.pid == pid, SectionDigest.c.filehash == file_hash)
+
+    return {
+        section: records
+        for section, digest, records in session.execute(query)
+        if digests.get(section, EMPTY_DIGEST) == digest
+    }
+
+
+class DigestStage:
+    """Replace the stored section digests of a patient with those of the file
+    being written.
+
+    Args:
+        pid (str): patient the file belongs to
+        rows (List[dict]): a row for each section which should be kept
+    """
+
+    def __init__(self, pid: str, rows: List[dict]):
+        self.pid = pid
+        self.rows = rows
+
+    def execute(self, session: Session) -> int:
+        """Write the digests.
+
+        Raises:
+            DataInsertionError: if any of the statements fail
+
+        Returns:
+            int: number of digests written
+        """
+        try:
+            session.execute(delete(SectionDigest).where(SectionDigest.c.pid == self.pid))
+            if self.rows:
+                session.execute(insert(SectionDigest), self.rows)
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise DataInsertionError("Failed to write section digests") from e
+
+        return len(self.rows)
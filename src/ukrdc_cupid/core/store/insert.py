@@ -1,9 +1,9 @@
 import time
-from typing import Optional
+from typing import Dict, Optional
 
 import ukrdc_xsdata.ukrdc as xsd_ukrdc  # type: ignore
 from pydantic import BaseModel
-from sqlalchemy import text
+from sqlalchemy import select, text
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 from ukrdc_cupid.core.investigate.create_investigation import (
@@ -15,15 +15,24 @@ from ukrdc_cupid.core.match.identify import (
     identify_patient_feed,
     read_patient_metadata,
 )
-from ukrdc_cupid.core.parse.utils import load_xml_from_str
+from ukrdc_cupid.core.match.cache import notify_match_change
+from ukrdc_cupid.core.parse.utils import XmlPipeline
 from ukrdc_cupid.core.parse.xml_validate import SUPPORTED_VERSIONS
 from ukrdc_cupid.core.store.exceptions import (
     DataInsertionError,
     InsertionBlockedError,
 )
+from ukrdc_cupid.core.store.bulk import InsertionStage, UpsertStage
+from ukrdc_cupid.core.store.delete import DeletionStage
+from ukrdc_cupid.core.store.diff import DataDiffResponse, diff_file, start_read_only
+from ukrdc_cupid.core.store.digests import DigestStage
 from ukrdc_cupid.core.store.keygen import mint_new_pid, mint_new_ukrdcid
+from ukrdc_cupid.core.store.models.changes import ChangeLog
 from ukrdc_cupid.core.store.models.structure import RecordStatus
 from ukrdc_cupid.core.store.models.ukrdc import PatientRecord
+from ukrdc_sqla.ukrdc import PatientRecord as SQLAPatientRecord
+from ukrdc_sqla.ukrdc import Patient as SQLAPatient
+from ukrdc_sqla.ukrdc import PatientNumber as SQLAPatientNumber
 
 CURRENT_SCHEMA = max(SUPPORTED_VERSIONS)
 
@@ -40,6 +49,9 @@ class DataInsertionResponse(BaseModel):
     deleted_records: int = 0
     unchanged_records: int = 0
     modified_records: int = 0
+    # columns written to existing records, with the reasons in changes
+    modified_fields: int = 0
+    changes: Optional[ChangeLog] = None
     identical_to_last: bool = False
     msg: str = ""
     errormsg: Optional[str] = None
@@ -75,9 +87,16 @@ class DataInsertionResponse(BaseModel):
             f"Deleted Records: {self.deleted_records}\n"
             f"Unchanged Records: {self.unchanged_records}\n"
             f"Modified Records: {self.modified_records}\n"
+            f"Modified Fields: {self.modified_fields}\n"
             f"Total Records: {total_records}\n"
             f"Percentage New Records: {percentage_new:.2f}%\n"
         )
+        if self.changes is not None and self.changes.fields:
+            table += (
+                f"\nModified Fields Summary\n"
+                f"-----------------------\n"
+                f"{self.changes.summary()}\n"
+            )
         return table
 
 
@@ -139,6 +158,34 @@ def commit_changes(ukrdc_session: Session):
         raise DataInsertionError("Failed to insert patient data due to database error") from e
 
 
+def notify_matching_changes(
+    ukrdc_session: Session,
+    pid: str,
+    changed: list,
+    deletion_stage: DeletionStage,
+) -> None:
+    """Tell the match caches if the patient numbers or demographics files are
+    matched on have changed (see match/cache.py). This covers new patients
+    too since all their records are new.
+
+    Args:
+        ukrdc_session (Session): ukrdc4 database session
+        pid (str): patient being written
+        changed (list): new and modified orm objects
+        deletion_stage (DeletionStage): deletions, already executed
+    """
+    numbers = [
+        (orm_object.numbertype, orm_object.patientid, orm_object.organization)
+        for orm_object in changed
+        if isinstance(orm_object, SQLAPatientNumber)
+    ]
+    patient_changed = any(
+        isinstance(orm_object, SQLAPatient) for orm_object in changed
+    )
+    if numbers or patient_changed or deletion_stage.deleted.get(SQLAPatientNumber):
+        notify_match_change(ukrdc_session, pids=[pid], numbers=numbers)
+
+
 @advisory_lock
 def insert_incoming_data(
     ukrdc_session: Session,
@@ -147,6 +194,13 @@ def insert_incoming_data(
     incoming_xml_file: xsd_ukrdc.PatientRecord,
     is_new: bool = False,
     mode: str = "full",
+    file_hash: str = None,
+    bulk_write: bool = False,
+    retain_tree: bool = True,
+    skip_unchanged_sections: bool = False,
+    section_hashes: Dict[str, str] = None,
+    content_keys: bool = False,
+    xml_body: str = None,
 ) -> DataInsertionResponse:
     """Insert file into the database having matched to pid.
     do we need a no delete mode?
@@ -155,15 +209,41 @@ def insert_incoming_data(
         pid (str): _description_
         incoming_xml_file (xsd_ukrdc.PatientRecord): _description_
         no_delete (bool, optional): _description_. Defaults to False.
+        file_hash (str, optional): hash of the raw file (see
+        XmlPipeline.content_hash). Without it the decoded file is rendered
+        and hashed instead, which doesn't match the hash of the raw file
+        (see hash_xml). Defaults to None.
+        bulk_write (bool, optional): write new and modified records of an
+        existing patient with bulk upserts instead of through the session.
+        Defaults to False.
+        retain_tree (bool, optional): return the mapped patient record in the
+        response. Otherwise the response only carries counts and messages
+        and the tree doesn't hold on to the decoded file. Defaults to True.
+        skip_unchanged_sections (bool, optional): only map and diff the
+        sections of the file which have changed since the last file written
+        for the patient. Defaults to False.
+        section_hashes (Dict[str, str], optional): digests of the sections of
+        the raw file if they have already been calculated. Defaults to None.
+        content_keys (bool, optional): key medications, diagnoses, names and
+        similar records by their content rather than position in the file.
+        Only for databases migrated with scripts/migrate_content_keys.py.
+        Defaults to False.
+        xml_body (str, optional): the raw file, kept with any investigation
+        raised rather than a rendered copy. Defaults to None.
     """
 
     response = DataInsertionResponse()
 
     # load incoming xml file into cupid store models
-    if mode == "ex-missing":
-        patient_record = PatientRecord(xml=incoming_xml_file, ex_missing=True)
-    else:
-        patient_record = PatientRecord(xml=incoming_xml_file)
+    patient_record = PatientRecord(
+        xml=incoming_xml_file,
+        ex_missing=(mode == "ex-missing"),
+        file_hash=file_hash,
+        keep_xml=retain_tree,
+        skip_unchanged=skip_unchanged_sections,
+        section_hashes=section_hashes,
+        content_keys=content_keys,
+    )
 
     # Map xml to rows in the database using cupid models this will produce a
     # tree of cupid models. These contain ukrdc_sqla models which can be
@@ -178,29 +258,64 @@ def insert_incoming_data(
     if not different_file:
         response.msg = f"Incoming file matched hash for last inserted file for pid = {pid}. No further data insertion has occurred."
         response.identical_to_last = True
-        response.patient_record = patient_record
+        if retain_tree:
+            response.patient_record = patient_record
+        if patient_record.hash_upgraded:
+            commit_changes(ukrdc_session)
         return response
 
     # get the orm objects for the records that need to be created and add them
-    # to the session
-    orm_objects, counts = patient_record.get_orm_list()
+    # to the session. Everything in a new patient is new so the records are
+    # written directly in bulk rather than through the session. In bulk write
+    # mode the same goes for the new and modified records of existing patients.
+    # The records to delete are gathered in the same walk of the tree.
+    collection = patient_record.collect(
+        statuses=[RecordStatus.NEW, RecordStatus.MODIFIED]
+    )
+    orm_objects, counts = collection.orm_objects, collection.counts
     new = orm_objects[RecordStatus.NEW]
-    ukrdc_session.add_all(new)
+    if is_new:
+        insertion_stage = InsertionStage(new)
+    elif bulk_write:
+        insertion_stage = UpsertStage(new + orm_objects[RecordStatus.MODIFIED])
+    else:
+        ukrdc_session.add_all(new)
+        insertion_stage = InsertionStage([])
 
     response.new_records = counts[RecordStatus.NEW]
     response.modified_records = counts[RecordStatus.MODIFIED]
     response.unchanged_records = counts[RecordStatus.UNCHANGED]
+    response.modified_fields = patient_record.changes.modified_fields
+    response.changes = patient_record.changes
 
-    # get the orm objects for records not in the file
-    records_for_deletion = patient_record.get_orm_deleted()
-    for record in records_for_deletion:
-        ukrdc_session.delete(record)
+    # records not in the file are removed with a delete statement per table
+    # rather than being loaded and deleted one at a time
+    deletion_stage = DeletionStage(collection.deletions)
 
-    response.deleted_records = len(records_for_deletion)
-    response.patient_record = patient_record
+    # the section digests are stored so unchanged sections of the next file
+    # can be skipped
+    digest_stage = None
+    if skip_unchanged_sections:
+        digest_stage = DigestStage(pid, patient_record.section_digest_rows())
+
+    if retain_tree:
+        response.patient_record = patient_record
 
-    # attempt to commit session changes to the database 
+    # attempt to commit session changes to the database. The bulk statements
+    # would otherwise autoflush so the session changes are only flushed once,
+    # on commit.
     try:
+        with ukrdc_session.no_autoflush:
+            insertion_stage.execute(ukrdc_session)
+            response.deleted_records = deletion_stage.execute(ukrdc_session)
+            if digest_stage is not None:
+                digest_stage.execute(ukrdc_session)
+            notify_matching_changes(
+                ukrdc_session,
+                pid,
+                new + orm_objects[RecordStatus.MODIFIED],
+                deletion_stage,
+            )
         commit_changes(ukrdc_session)
     except DataInsertionError as e:
         if is_new:
@@ -215,7 +330,9 @@ def insert_incoming_data(
                 issue_type_id=8,
                 error_msg=str(error),
             )
-            investigation.append_extras(xml=incoming_xml_file)
+            investigation.append_extras(
+                xml=xml_body if xml_body is not None else incoming_xml_file
+            )
             response.errormsg = f"Patient could not be updated due to error:\n{error}\n"
             response.errormsg += (
                 f"See investigation id = {investigation.issue.id} for more details"
@@ -239,12 +356,50 @@ def insert_incoming_data(
     return response
 
 
+def find_identical_record(
+    ukrdc_session: Session, file_hash: str, metadata: Dict[str, str]
+) -> Optional[str]:
+    """Look for a patient record from the same feed whose last stored file
+    had the same hash as the incoming file. This uses the index on
+    patientrecord (channelid, sendingfacility, sendingextract).
+
+    Args:
+        ukrdc_session (Session): ukrdc4 database session
+        file_hash (str): canonical hash of the incoming file
+        metadata (Dict[str, str]): file metadata from the pipeline
+
+    Returns:
+        Optional[str]: pid of the matching record or None
+    """
+    query = (
+        select(SQLAPatientRecord.pid)
+        .where(
+            SQLAPatientRecord.channelid == file_hash,
+            SQLAPatientRecord.sendingfacility == metadata["sending_facility"],
+            SQLAPatientRecord.sendingextract == metadata["sending_extract"],
+        )
+        .limit(2)
+    )
+    pids = ukrdc_session.execute(query).scalars().all()
+
+    # this should never match more than one record but if it does let the
+    # matching sort it out
+    if len(pids) == 1:
+        return pids[0]
+
+    return None
+
+
 def process_file(
     xml_body: str,
     ukrdc_session: Session,
     mode: str = "full",
     validate: bool = False,
     check_current_schema: bool = False,
+    bulk_write: bool = False,
+    skip_unchanged_sections: bool = False,
+    content_keys: bool = False,
+    show_changes: bool = False,
 ) -> str:
     """Takes an xml file as a string and
     applies the cupid matching algorithm to attempt uploading it to the
@@ -253,18 +408,68 @@ def process_file(
     Args:
         xml_body (str): xml file as a string
         ukrdc_session (Session): ukrdc4 database session
+        mode (str, optional): "full", "ex-missing", "clear" or "diff". A diff
+        is a dry run which writes nothing and returns the changes storing the
+        file would make, per table, as json (see diff.py).
+        skip_unchanged_sections (bool, optional): skip sections of the file
+        which are the same as in the last file stored. This needs the
+        sectiondigest table (see create_cupid_tables). Defaults to False.
+        show_changes (bool, optional): in diff mode also list the keys and
+        columns which would change. Defaults to False.
     """
 
     # async def load_xml(mode: str, xml_body: str = Depends(_get_xml_body)):
     # Load XML and check it
     t0 = time.time()
 
-    xml_object = load_xml_from_str(
-        xml_body, validate=validate, check_current_schema=check_current_schema
-    )
+    if mode == "diff":
+        start_read_only(ukrdc_session)
+
+    pipeline = XmlPipeline(xml_body)
+    if check_current_schema:
+        pipeline.check_current_schema()
+
+    # Resent files are very common. If the file is identical to the last one
+    # stored for the feed there is nothing to do so we can skip validation,
+    # decoding and matching. The hash has to be taken before decoding
+    # consumes the tree. The section digests are taken in the same walk.
+    section_hashes = None
+    if skip_unchanged_sections:
+        section_hashes = pipeline.section_hashes
+    file_hash = pipeline.content_hash
+    if mode != "clear":
+        pid = find_identical_record(ukrdc_session, file_hash, pipeline.metadata)
+        if pid is not None:
+            msg = f"Incoming file matched hash for last inserted file for pid = {pid}. No further data insertion has occurred."
+            print(msg)
+            print(f"That took {time.time() - t0:.4f} secs")
+            if mode == "diff":
+                ukrdc_session.rollback()
+                response = DataDiffResponse(pid=pid, identical_to_last=True, msg=msg)
+                return response.model_dump_json()
+            return msg
+
+    if validate:
+        pipeline.validate()
+
+    xml_object = pipeline.decode()
 
     print(f"Time to load file {time.time()-t0}")
 
+    if mode == "diff":
+        diff = diff_file(
+            ukrdc_session,
+            xml_object,
+            file_hash=file_hash,
+            skip_unchanged_sections=skip_unchanged_sections,
+            section_hashes=section_hashes,
+            content_keys=content_keys,
+            show_changes=show_changes,
+        )
+        print(f"Diff would write {diff.writes} records")
+        print(f"That took {time.time() - t0:.2f} secs")
+        return diff.model_dump_json(exclude_none=True)
+
     # identify patient
     patient_info = read_patient_metadata(xml_object)
     pid, ukrdcid, investigation = identify_patient_feed(
@@ -311,6 +516,13 @@ def process_file(
         incoming_xml_file=xml_object,
         is_new=is_new,
         mode=mode,
+        file_hash=file_hash,
+        bulk_write=bulk_write,
+        retain_tree=False,
+        skip_unchanged_sections=skip_unchanged_sections,
+        section_hashes=section_hashes,
+        content_keys=content_keys,
+        xml_body=xml_body,
     )
 
     # Any investigation at this point will be associated with a merge to
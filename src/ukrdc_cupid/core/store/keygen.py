@@ -3,6 +3,8 @@ Primary keys for the records contained within the ukrdc. Hopefully we simplify
 this at some point in the future. However for continuity it aims to replicate 
 the data repository code unless the keys were an explicit cause of error.
 """
+import hashlib
+
 from sqlalchemy.orm import Session
 from sqlalchemy import Sequence
 import ukrdc_xsdata.ukrdc.lab_orders as xsd_lab_orders  # type:ignore
@@ -10,10 +12,13 @@ import ukrdc_xsdata.ukrdc.dialysis_sessions as xsd_dialysis_sessions  # type:ign
 import ukrdc_xsdata.ukrdc.observations as xsd_observations
 import ukrdc_xsdata.ukrdc.surveys as xsd_surveys
 
-from typing import Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 KEY_SEPARATOR = ":"
 
+# hex characters of the content digest used in content keys
+CONTENT_KEY_LENGTH = 16
+
 
 def mint_new_pid(session: Session) -> str:
     """
@@ -44,6 +49,141 @@ def generate_generic_key(parent: str, seq_no: Optional[int] = None) -> str:
     return f"{parent}{KEY_SEPARATOR}{seq_no}"
 
 
+def _digest(values: Iterable[Any]) -> str:
+    parts = ("" if value is None else str(value) for value in values)
+    digest = hashlib.sha256("\x00".join(parts).encode("utf-8"))
+    return digest.hexdigest()[:CONTENT_KEY_LENGTH]
+
+
+def content_digest(xml: Any, key_fields: Tuple[Any, ...]) -> str:
+    """Digest of the natural identifying fields of a record. The fields are
+    converted to the values they are stored as so the same digest can be
+    worked out from the database row (see row_content_digest). Key fields
+    on date columns must use to_date rather than to_datetime for this to
+    hold. Missing fields, or missing parents of them, count as empty.
+
+    Args:
+        xml (Any): xsdata object of the record
+        key_fields (Tuple[Item, ...]): column, dotted xml path and converter
+        of each identifying field
+
+    Returns:
+        str: hex digest
+    """
+    values = []
+    for field in key_fields:
+        value = xml
+        for attr in field.xml_path.split("."):
+            value = getattr(value, attr, None)
+
+        if field.converter is not None:
+            value = field.converter(value)
+        values.append(value)
+
+    return _digest(values)
+
+
+def row_content_digest(row: Any, key_fields: Tuple[Any, ...]) -> str:
+    """The content digest of a record already in the database. The key
+    field converters are applied to the stored values as well so both
+    digests see the same types.
+    """
+    values = []
+    for field in key_fields:
+        value = getattr(row, field.column)
+        if field.converter is not None:
+            value = field.converter(value)
+        values.append(value)
+
+    return _digest(values)
+
+
+def content_sequence(digests: Iterable[str]) -> List[int]:
+    """Number each record amongst those with the same content, records with
+    identical identifying fields are told apart by order of appearance.
+    """
+    seen: Dict[str, int] = {}
+    sequence = []
+    for digest in digests:
+        seq_no = seen.get(digest, 0)
+        seen[digest] = seq_no + 1
+        sequence.append(seq_no)
+    return sequence
+
+
+def generate_content_key(parent: str, digest: str, seq_no: int = 0) -> str:
+    """Key derived from what a record is rather than where it appears in the
+    file. Unlike generate_generic_key, removing or reordering records doesn't
+    change the keys of the others.
+    """
+    return f"{parent}{KEY_SEPARATOR}{digest}{KEY_SEPARATOR}{seq_no}"
+
+
+def content_rekey(
+    rows: Iterable[Any], key_fields: Tuple[Any, ...]
+) -> List[Tuple[str, str, int]]:
+    """Work out the content keys of records stored with positional keys, for
+    migrating a database over to content keys.
+
+    Args:
+        rows (Iterable[Any]): stored rows of a single table, grouped by pid and
+        in the order they appeared in the file within each patient
+        key_fields (Tuple[Item, ...]): key fields of the node the table maps to
+
+    Returns:
+        List[Tuple[str, str, int]]: old key, new key and sequence number
+        (the new idx) of each row which changes
+    """
+    rekeyed = []
+    pid = None
+    seen: Dict[str, int] = {}
+    for row in rows:
+        if row.pid != pid:
+            pid = row.pid
+            seen = {}
+        digest = row_content_digest(row, key_fields)
+        seq_no = seen.get(digest, 0)
+        seen[digest] = seq_no + 1
+
+        key = generate_content_key(pid, digest, seq_no)
+        if key != row.id:
+            rekeyed.append((row.id, key, seq_no))
+    return rekeyed
+
+
+def deduplicate_keys(keys: Iterable[str]) -> List[str]:
+    """Keys of records with start/stop share a sequence number (see
+    PatientRecord.deduplicate_keys). Where a key has already been taken the
+    number after the last separator is incremented until a free key is
+    found. For each duplicated key the number reached is remembered so the
+    next duplicate picks up from there rather than counting up from the
+    start again, keeping this linear when thousands of records collide.
+
+    Args:
+        keys (Iterable[str]): keys in the order the records appear
+
+    Returns:
+        List[str]: the keys with duplicates renumbered
+    """
+    taken = set()
+    counters: Dict[str, int] = {}
+    unique = []
+    for key in keys:
+        if key in taken:
+            prefix, _, seq_no = key.rpartition(KEY_SEPARATOR)
+            counter = counters.get(key, int(seq_no))
+            original = key
+            while key in taken:
+                counter += 1
+                key = f"{prefix}{KEY_SEPARATOR}{counter}"
+            counters[original] = counter
+
+        taken.add(key)
+        unique.append(key)
+
+    return unique
+
+
 def generate_key_laborder(laborder_xml: xsd_lab_orders, pid: str) -> str:
     # generate lab_order consitant with: https://github.com/renalreg/Data-Repository/blob/44d0b9af3eb73705de800fd52fe5a6b847219b31/src/main/java/org/ukrdc/repository/RepositoryManager.java#L679
     return f"{pid}{KEY_SEPARATOR}{laborder_xml.placer_id}"
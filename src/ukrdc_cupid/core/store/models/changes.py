@@ -0,0 +1,206 @@
+"""
+Change detection for mapped columns. Values come out of the xml as strings,
+xsdata types or python types which don't always match what the orm loads for
+the same column, e.g. "1.0" against Decimal("1.00"), an aware datetime
+against a naive one or "" against None. Comparing them as they are flags
+records as modified when nothing has changed, each one being a pointless
+UPDATE. Instead the incoming value is brought into line with the type of the
+stored one before they are compared.
+
+While a ChangeLog is being recorded (see recording_changes) every column
+written to an existing record is counted along with the reason, as are the
+differences which were normalised away, so the sources of updates on resent
+files can be seen.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from typing import Any, Iterator, NamedTuple, Optional
+
+# reasons a column is written
+SET = "set"
+CLEARED = "cleared"
+CHANGED = "changed"
+
+# differences which don't count as a change
+EMPTY = "empty"
+TIMEZONE = "timezone"
+DATE = "date"
+DECIMAL = "decimal"
+BOOLEAN = "boolean"
+TYPE = "type"
+
+TRUE_STRINGS = frozenset(("true", "t", "yes", "y", "1"))
+FALSE_STRINGS = frozenset(("false", "f", "no", "n", "0"))
+
+
+class Comparison(NamedTuple):
+    """Outcome of comparing an incoming value with the stored one.
+
+    Args:
+        changed (bool): whether the column needs writing
+        value (Any): value to write, coerced to the stored type
+        reason (str, optional): why it changed or, if it didn't, the
+        normalisation which made the two values equal. None if they were
+        plainly equal.
+    """
+
+    changed: bool
+    value: Any
+    reason: Optional[str] = None
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and value == "")
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _to_bool(value: Any) -> Any:
+    # strings which aren't recognised are returned as they are so they
+    # compare as a change rather than as whichever bool they are truthy as
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in TRUE_STRINGS:
+            return True
+        if lowered in FALSE_STRINGS:
+            return False
+        return value
+    return bool(value)
+
+
+def _to_decimal(value: Any) -> Decimal:
+    # going through str keeps the decimal places of floats as written
+    return Decimal(str(value))
+
+
+def _coerce(value: Any, persisted: Any) -> Any:
+    """Convert the incoming value to the type of the stored one"""
+    if isinstance(persisted, bool):
+        return _to_bool(value)
+    if isinstance(persisted, Decimal):
+        return _to_decimal(value)
+    if isinstance(persisted, datetime):
+        return value
+    if isinstance(persisted, date) and isinstance(value, datetime):
+        return value.date() if value.time() == datetime.min.time() else value
+    return type(persisted)(value)
+
+
+def _kind(value: Any, persisted: Any) -> str:
+    """Name the normalisation needed to compare two values of different
+    types (or datetimes in different zones)
+    """
+    if isinstance(persisted, bool):
+        return BOOLEAN
+    if isinstance(persisted, Decimal):
+        return DECIMAL
+    if isinstance(persisted, datetime):
+        return TIMEZONE
+    if isinstance(persisted, date):
+        return DATE
+    return TYPE
+
+
+def compare(value: Any, persisted: Any) -> Comparison:
+    """Compare an incoming value with the value stored in the column.
+
+    Args:
+        value (Any): value from the xml, already stripped of xsdata wrappers
+        persisted (Any): value currently held by the orm object
+
+    Returns:
+        Comparison: whether the column needs writing and with what
+    """
+    if value is persisted or (type(value) is type(persisted) and value == persisted):
+        return Comparison(False, persisted)
+
+    if _is_empty(value):
+        if _is_empty(persisted):
+            return Comparison(False, persisted, EMPTY)
+        return Comparison(True, value, CLEARED)
+
+    if _is_empty(persisted):
+        return Comparison(True, value, SET)
+
+    if isinstance(value, datetime):
+        value = _naive_utc(value)
+        if isinstance(persisted, datetime):
+            persisted = _naive_utc(persisted)
+
+    kind = _kind(value, persisted)
+    if type(value) is not type(persisted):
+        value = _coerce(value, persisted)
+
+    if type(value) is type(persisted) and value == persisted:
+        return Comparison(False, persisted, kind)
+    return Comparison(True, value, CHANGED)
+
+
+class ChangeLog:
+    """Counts of the columns and rows of existing records which were written
+    while mapping, and of the differences which were ignored.
+    """
+
+    def __init__(self) -> None:
+        # (table, column, reason) for columns written
+        self.fields: Counter = Counter()
+        # table for rows which went from unchanged to modified
+        self.rows: Counter = Counter()
+        # (table, column, kind) for differences normalised away
+        self.normalised: Counter = Counter()
+
+    def record(self, table: str, column: str, comparison: Comparison) -> None:
+        if comparison.changed:
+            self.fields[table, column, comparison.reason] += 1
+        elif comparison.reason is not None:
+            self.normalised[table, column, comparison.reason] += 1
+
+    def record_row(self, table: str) -> None:
+        self.rows[table] += 1
+
+    @property
+    def modified_fields(self) -> int:
+        return sum(self.fields.values())
+
+    @property
+    def modified_rows(self) -> int:
+        return sum(self.rows.values())
+
+    def summary(self) -> str:
+        """The columns written, most frequent first, one per line"""
+        lines = [
+            f"{table}.{column} {reason}: {count}"
+            for (table, column, reason), count in self.fields.most_common()
+        ]
+        lines.extend(
+            f"{table}.{column} {kind} (ignored): {count}"
+            for (table, column, kind), count in self.normalised.most_common()
+        )
+        return "\n".join(lines)
+
+
+_change_log: ContextVar[Optional[ChangeLog]] = ContextVar(
+    "cupid_change_log", default=None
+)
+
+
+def current_change_log() -> Optional[ChangeLog]:
+    return _change_log.get()
+
+
+@contextmanager
+def recording_changes(change_log: ChangeLog) -> Iterator[ChangeLog]:
+    """Count the changes made while mapping for the duration of the block"""
+    token = _change_log.set(change_log)
+    try:
+        yield change_log
+    finally:
+        _change_log.reset(token)
@@ -0,0 +1,125 @@
+"""
+Declarative mapping of xml items onto orm columns. Most nodes map a long list
+of items straight from the xml, doing that with a call to add_item/add_code
+per column means working out how to convert each value every time. Instead a
+node lists its columns in `fields`:
+
+    fields = (
+        Item("observationtime", "observation_time", to_datetime, optional=False),
+        Code("observationcode", "observationcodestd", "observationdesc", "observation_code"),
+        Item("observationvalue", "observation_value"),
+    )
+
+These are compiled once, when the node class is created, into a getter and a
+converter per column which Node.map_fields runs for each record.
+"""
+
+from datetime import date, datetime, timezone
+from operator import attrgetter
+from typing import Any, Callable, NamedTuple, Optional, Tuple, Union
+
+from xsdata.models.datatype import XmlDate, XmlDateTime
+
+
+def to_value(value: Any) -> Any:
+    """Step down to the bottom of xsdata wrappers such as enums"""
+    while hasattr(value, "value"):
+        value = value.value
+    return value
+
+
+def to_datetime(value: Any) -> Optional[datetime]:
+    """Xml can contain the timezone info which we don't store this requires
+    us to convert it to a naive datetime under the assumption all domain
+    datetimes are utc.
+    """
+    if isinstance(value, XmlDateTime):
+        value = value.to_datetime()
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    elif isinstance(value, XmlDate):
+        value = value.to_datetime()
+    return value
+
+
+def to_date(value: Any) -> Optional[date]:
+    """As to_datetime for date columns, which drop the time"""
+    value = to_datetime(value)
+    if isinstance(value, datetime):
+        value = value.date()
+    return value
+
+
+class Item(NamedTuple):
+    """A column set from a single item of the xml.
+
+    Args:
+        column (str): orm column
+        xml_path (str): attribute of the xml holding the value
+        converter (Callable, optional): applied to the value, leave as None
+        for plain strings and numbers
+        optional (bool, optional): if not, a missing value is an error
+    """
+
+    column: str
+    xml_path: str
+    converter: Optional[Callable[[Any], Any]] = None
+    optional: bool = True
+
+
+class Code(NamedTuple):
+    """The code, coding standard and description columns set from a coded
+    field of the xml. If it is missing all three are blanked.
+    """
+
+    code: str
+    std: str
+    desc: str
+    xml_path: str
+    optional: bool = True
+
+
+class CompiledField(NamedTuple):
+    column: str
+    get: Callable[[Any], Any]
+    convert: Optional[Callable[[Any], Any]]
+    optional: bool
+
+
+def _code_part(coded_field: Callable, attr: str, optional: bool) -> Callable:
+    if optional:
+
+        def get(xml):
+            return getattr(coded_field(xml), attr, None)
+
+    else:
+        # as with add_code a required coded field must be present
+        def get(xml):
+            return getattr(coded_field(xml), attr)
+
+    return get
+
+
+def compile_fields(fields: Tuple[Union[Item, Code], ...]) -> Tuple[CompiledField, ...]:
+    compiled = []
+    for field in fields:
+        if isinstance(field, Code):
+            coded_field = attrgetter(field.xml_path)
+            for column, attr in (
+                (field.code, "code"),
+                (field.desc, "description"),
+                (field.std, "coding_standard"),
+            ):
+                get = _code_part(coded_field, attr, field.optional)
+                compiled.append(CompiledField(column, get, to_value, True))
+        else:
+            compiled.append(
+                CompiledField(
+                    field.column,
+                    attrgetter(field.xml_path),
+                    field.converter,
+                    field.optional,
+                )
+            )
+
+    return tuple(compiled)
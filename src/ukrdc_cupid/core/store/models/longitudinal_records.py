@@ -13,6 +13,8 @@ from sqlalchemy.orm import Session
 
 import ukrdc_sqla.ukrdc as sqla
 from ukrdc_cupid.core.store.models.structure import Node, RecordStatus
+from ukrdc_cupid.core.store.models.fields import Code, Item, to_datetime, to_value
+from ukrdc_cupid.core.store.prefetch import KeyPrefetch, get_orm
 import ukrdc_cupid.core.store.keygen as key_gen  # type: ignore
 
 import ukrdc_xsdata.ukrdc.observations as xsd_observations  # type: ignore
@@ -25,6 +27,24 @@ import ukrdc_xsdata.ukrdc.transplants as xsd_transplants  # type: ignore
 
 
 class Observation(Node):
+    __slots__ = ()
+    deduplicate = True
+
+    # fmt: off
+    fields = (
+        Item("observationtime", "observation_time", to_datetime, optional=False),
+        Code("observationcode", "observationcodestd", "observationdesc", "observation_code"),
+        Item("observationvalue", "observation_value"),
+        Item("observationunits", "observation_units"),
+        Item("prepost", "pre_post", to_value),
+        Item("commenttext", "comments"),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Code("enteringorganizationcode", "enteringorganizationcodestd", "enteringorganizationdesc", "entering_organization"),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_observations.Observation):
         super().__init__(xml, sqla.Observation)
 
@@ -36,23 +56,30 @@ class Observation(Node):
         return key_gen.generate_key_observations(self.xml, self.pid, seq_no)
 
     def map_xml_to_orm(self, _) -> None:
-
-        # fmt: off
-        self.add_item("observationtime", self.xml.observation_time, optional=False)
-        self.add_code("observationcode", "observationcodestd", "observationdesc", self.xml.observation_code, optional=True)
-        self.add_item("observationvalue", self.xml.observation_value, optional=True)
-        self.add_item("observationunits", self.xml.observation_units, optional=True)
-        self.add_item("prepost", self.xml.pre_post, optional=True)
-        self.add_item("commenttext", self.xml.comments, optional=True)
-
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at, optional=True)
-        self.add_code("enteringorganizationcode", "enteringorganizationcodestd", "enteringorganizationdesc", self.xml.entering_organization, optional=True)
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-        # fmt: on
+        self.map_fields()
 
 
 class ResultItem(Node):
+    __slots__ = ("is_new_record",)
+
+    # fmt: off
+    fields = (
+        Item("resulttype", "result_type"),
+        Code("serviceidcode", "serviceidcodestd", "serviceiddesc", "service_id"),
+        Item("subid", "sub_id"),
+        Item("resultvalue", "result_value"),
+        Item("resultvalueunits", "result_value_units"),
+        Item("referencerange", "reference_range"),
+        Item("interpretationcodes", "interpretation_codes", to_value),
+        Item("prepost", "pre_post", to_value),
+        Item("enteredon", "entered_on", to_datetime),
+        Item("status", "status", to_value),
+        Item("observationtime", "observation_time", to_datetime),
+        Item("commenttext", "comments"),
+        Item("referencecomment", "reference_comment"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_lab_orders.ResultItem):
         super().__init__(xml, sqla.ResultItem)
 
@@ -66,7 +93,7 @@ class ResultItem(Node):
     def map_to_database(self, session: Session, seq_no: int, order_id: str) -> str:
         # look up key in database and make new orm if it doesn't exist
         id = self.generate_id(seq_no, order_id)
-        self.orm_object = session.get(self.orm_model, id)
+        self.orm_object = get_orm(session, self.orm_model, id)
 
         if self.orm_object is None:
             self.orm_object = self.orm_model(id=id)  # type:ignore
@@ -78,25 +105,35 @@ class ResultItem(Node):
         return id
 
     def map_xml_to_orm(self):
-
-        # fmt: off
-        self.add_item("resulttype", self.xml.result_type)
-        self.add_code("serviceidcode", "serviceidcodestd", "serviceiddesc", self.xml.service_id)
-        self.add_item("subid", self.xml.sub_id)
-        self.add_item("resultvalue", self.xml.result_value)
-        self.add_item("resultvalueunits", self.xml.result_value_units)
-        self.add_item("referencerange", self.xml.reference_range)
-        self.add_item("interpretationcodes", self.xml.interpretation_codes)
-        self.add_item("prepost", self.xml.pre_post)
-        self.add_item("enteredon", self.xml.entered_on)
-        self.add_item("status", self.xml.status)
-        self.add_item("observationtime", self.xml.observation_time)
-        self.add_item("commenttext", self.xml.comments)
-        self.add_item("referencecomment", self.xml.reference_comment)
-        # fmt: on
+        self.map_fields()
 
 
 class LabOrder(Node):
+    __slots__ = ("parent_data",)
+
+    # fmt: off
+    fields = (
+        Item("placerid", "placer_id", None, optional=False),
+        Item("fillerid", "filler_id"),
+        Item("specimencollectedtime", "specimen_collected_time", to_datetime),
+        Item("status", "status"),
+        Item("specimenreceivedtime", "specimen_received_time", to_datetime),
+        Item("specimensource", "specimen_source"),
+        Item("duration", "duration"),
+        Item("enteredon", "entered_on", to_datetime),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+        Code("receivinglocationcode", "receivinglocationcodestd", "receivinglocationdesc", "receiving_location"),
+        Code("orderedbycode", "orderedbycodestd", "orderedbydesc", "ordered_by"),
+        Code("orderitemcode", "orderitemcodestd", "orderitemdesc", "order_item"),
+        Code("ordercategorycode", "ordercategorycodestd", "ordercategorydesc", "order_category"),
+        Code("prioritycode", "prioritycodestd", "prioritydesc", "priority"),
+        Code("patientclasscode", "patientclassdesc", "patientclasscodestd", "patient_class"),
+        Code("enteredatcode", "enteredatdesc", "enteredatcodestd", "entered_at"),
+        Code("enteringorganizationcode", "enteringorganizationcodestd", "enteringorganizationdesc", "entering_organization"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_lab_orders.LabOrder):
         super().__init__(xml, sqla.LabOrder)
         # we will need this for generating resultitem keys
@@ -108,21 +145,29 @@ class LabOrder(Node):
     def generate_id(self, _) -> str:
         return key_gen.generate_key_laborder(self.xml, self.pid)
 
+    def collect_keys(self, prefetch: KeyPrefetch) -> None:
+        # result items are keyed on the order rather than the pid
+        if self.xml.result_items:
+            order_id = self.generate_id(None)
+            for seq_no, result_item in enumerate(self.xml.result_items.result_item):
+                result_obj = ResultItem(xml=result_item)
+                prefetch.add(result_obj.orm_model, result_obj.generate_id(seq_no, order_id))
+
     def add_children(self, session: Session) -> None:
 
         # unpack the xml_items:
         if self.xml.result_items:
             result_items = self.xml.result_items.result_item
 
-        result_item_ids = []
+        result_item_nodes = []
         for seq_no, result_item in enumerate(result_items):
             # initialize result item
             order_id = self.orm_object.id
             result_obj = ResultItem(xml=result_item)
 
             # map to database
-            id = result_obj.map_to_database(session, seq_no, order_id)
-            result_item_ids.append(id)
+            result_obj.map_to_database(session, seq_no, order_id)
+            result_item_nodes.append(result_obj)
 
             # Map the rest of the fields
             result_obj.map_xml_to_orm()
@@ -132,37 +177,30 @@ class LabOrder(Node):
             # append to parent
             self.mapped_classes.append(result_obj)
 
-        self.add_deleted(ResultItem.sqla_mapped(), result_item_ids)
+        self.add_deleted(ResultItem.sqla_mapped(), result_item_nodes)
 
     def map_xml_to_orm(self, session: Session) -> None:
-        # fmt: off
-        self.add_item("placerid", self.xml.placer_id, optional=False)
-        self.add_item("fillerid", self.xml.filler_id, optional=True)
-        self.add_item("specimencollectedtime", self.xml.specimen_collected_time, optional=True)
-        self.add_item("status", self.xml.status, optional=True)
-        self.add_item("specimenreceivedtime", self.xml.specimen_received_time, optional=True)
-
-        self.add_item("specimensource", self.xml.specimen_source, optional=True)
-        self.add_item("duration", self.xml.duration, optional=True)
-        self.add_item("enteredon", self.xml.entered_on, optional=True)
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-
-        self.add_code("receivinglocationcode","receivinglocationcodestd","receivinglocationdesc",self.xml.receiving_location,optional=True)
-        self.add_code("orderedbycode","orderedbycodestd","orderedbydesc",self.xml.ordered_by,optional=True)
-        self.add_code("orderitemcode","orderitemcodestd","orderitemdesc",self.xml.order_item,optional=True)
-        self.add_code("ordercategorycode","ordercategorycodestd","ordercategorydesc",self.xml.order_category,optional=True)
-        self.add_code("prioritycode","prioritycodestd","prioritydesc",self.xml.priority,optional=True)
-        # self.add_patient_class(self.xml.patient_class)
-        self.add_code("patientclasscode", "patientclassdesc", "patientclasscodestd", self.xml.patient_class, optional=True)
-        self.add_code("enteredatcode","enteredatdesc","enteredatcodestd",self.xml.entered_at,optional=True)
-        self.add_code("enteringorganizationcode","enteringorganizationcodestd","enteringorganizationdesc",self.xml.entering_organization,optional=True)
-        
+        self.map_fields()
         self.add_children(session)
-        # fmt: on
 
 
 class DialysisSession(Node):
+    __slots__ = ()
+    deduplicate = True
+
+    # fmt: off
+    fields = (
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Code("enteredbycode", "enteredbycodestd", "enteredbydesc", "entered_at"),
+        Code("proceduretypecode", "proceduretypecodestd", "proceduretypedesc", "procedure_type"),
+        Item("proceduretime", "procedure_time", to_datetime),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+        Item("qhd19", "symtomatic_hypotension"),
+        Item("qhd31", "time_dialysed"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_dialysis_sessions.DialysisSession):
         super().__init__(xml, sqla.DialysisSession)
 
@@ -177,29 +215,19 @@ class DialysisSession(Node):
 
     def map_xml_to_orm(self, _) -> None:
         # fmt: off
-        # codes
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at)
-        self.add_code("enteredbycode", "enteredbycodestd", "enteredbydesc", self.xml.entered_at)
-        self.add_code("proceduretypecode", "proceduretypecodestd", "proceduretypedesc", self.xml.procedure_type)
-        
-        # times
-        self.add_item("proceduretime", self.xml.procedure_time)
-        self.add_item("updatedon", self.xml.updated_on)
-
-        # ids
-        self.add_item("externalid", self.xml.external_id)
-        
+        self.map_fields()
+
         # values
-        self.add_item("qhd19", self.xml.symtomatic_hypotension)
         if self.xml.vascular_access:
             self.add_item("qhd20", self.xml.vascular_access.code)
         if self.xml.vascular_access_site:
             self.add_item("qhd21", self.xml.vascular_access_site.code)
-        self.add_item("qhd31", self.xml.time_dialysed)
         # fmt: on
 
 
 class Procedure(Node):
+    __slots__ = ()
+
     def __init__(self, xml: xsd_procedures.Procedure):
         super().__init__(xml, sqla.Procedure)
 
@@ -213,6 +241,18 @@ class Procedure(Node):
 
 
 class VascularAccess(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Code("proceduretypecode", "proceduretypecodestd", "proceduretypedesc", "procedure_type", optional=False),
+        Item("proceduretime", "procedure_time", to_datetime, optional=False),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_vascular_accesses.VascularAccess):
         super().__init__(xml, sqla.VascularAccess)
 
@@ -231,18 +271,32 @@ class VascularAccess(Node):
 
     def map_xml_to_orm(self, _) -> None:
         # Map values from XML to ORM object
-        self.add_code("proceduretypecode", "proceduretypecodestd", "proceduretypedesc",self.xml.procedure_type,optional=False,)
-        self.add_item("proceduretime", self.xml.procedure_time, optional=False)
+        self.map_fields()
         #self.add_code("enteredbycode", "enteredbycodestd", "enteredbydesc", self.xml.entered_by, optional=True,)
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at, optional=True,)
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
         self.add_acc()
         # fmt: on
         pass
 
 
 class Transplant(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Code("proceduretypecode", "proceduretypecodestd", "proceduretypedesc", "procedure_type", optional=False),
+        Item("proceduretime", "procedure_time", to_datetime, optional=False),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+        Item("tra77", "donor_type", to_value),
+        Item("tra64", "failure_date", to_datetime),
+        Item("tra91", "cold_ischaemic_time"),
+        Item("tra83", "hlamismatch_a"),
+        Item("tra84", "hlamismatch_b"),
+        Item("tra85", "hlamismatch_c"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_transplants.TransplantProcedure):
         super().__init__(xml, sqla.Transplant)
 
@@ -250,27 +304,35 @@ class Transplant(Node):
         return "transplants"
 
     def map_xml_to_orm(self, _) -> None:
-        # fmt: off
-        self.add_code("proceduretypecode", "proceduretypecodestd", "proceduretypedesc", self.xml.procedure_type, optional=False)
-        self.add_item("proceduretime", self.xml.procedure_time, optional=False)
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at)
-
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-
-        # former attributes
-        self.add_item("tra77", self.xml.donor_type)
-        # this may need adding to the sqla models
-        #self.add_item("tra72", self.xml.date_registered)
-        self.add_item("tra64", self.xml.failure_date)
-        self.add_item("tra91", self.xml.cold_ischaemic_time)
-        self.add_item("tra83", self.xml.hlamismatch_a)
-        self.add_item("tra84", self.xml.hlamismatch_b)
-        self.add_item("tra85", self.xml.hlamismatch_c)
-        # fmt: on
+        self.map_fields()
 
 
 class Treatment(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("encounternumber", "encounter_number"),
+        Item("fromtime", "from_time", to_datetime, optional=False),
+        Item("totime", "to_time", to_datetime),
+        Code("admittingcliniciancode", "admittingcliniciancodestd", "admittingcliniciandesc", "admitting_clinician"),
+        Code("healthcarefacilitycode", "healthcarefacilitycodestd", "healthcarefacilitydesc", "health_care_facility"),
+        Code("admitreasoncode", "admitreasoncodestd", "admitreasondesc", "admit_reason"),
+        Code("admissionsourcecode", "admissionsourcecodestd", "admissionsourcedesc", "admission_source"),
+        Code("dischargereasoncode", "dischargereasoncodestd", "dischargereasondesc", "discharge_reason"),
+        Code("dischargelocationcode", "dischargelocationcodestd", "dischargelocationdesc", "discharge_location"),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Item("visitdescription", "visit_description"),
+        Item("update_date", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    key_fields = (
+        Item("fromtime", "from_time", to_datetime),
+        Item("healthcarefacilitycode", "health_care_facility.code", to_value),
+        Item("admitreasoncode", "admit_reason.code", to_value),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_encounters.Treatment):
         super().__init__(xml, sqla.Treatment)
 
@@ -278,30 +340,38 @@ class Treatment(Node):
         return "treatments"
 
     def map_xml_to_orm(self, _) -> None:
-        # fmt: off
-        self.add_item("encounternumber", self.xml.encounter_number, optional=True)
-        self.add_item("fromtime", self.xml.from_time, optional=False)
-        self.add_item("totime", self.xml.to_time, optional=True)
-        self.add_code("admittingcliniciancode", "admittingcliniciancodestd", "admittingcliniciandesc", self.xml.admitting_clinician, optional=True)
-        self.add_code("healthcarefacilitycode", "healthcarefacilitycodestd", "healthcarefacilitydesc", self.xml.health_care_facility, optional=True)
-        self.add_code( "admitreasoncode", "admitreasoncodestd", "admitreasondesc", self.xml.admit_reason, optional=True)
-        self.add_code("admissionsourcecode", "admissionsourcecodestd", "admissionsourcedesc", self.xml.admission_source,optional=True)
-        self.add_code("dischargereasoncode", "dischargereasoncodestd","dischargereasondesc",self.xml.discharge_reason,optional=True,)
-        self.add_code("dischargelocationcode","dischargelocationcodestd","dischargelocationdesc",self.xml.discharge_location,optional=True,)
-        self.add_code("enteredatcode","enteredatcodestd","enteredatdesc",self.xml.entered_at,optional=True)
-
-        self.add_item("visitdescription", self.xml.visit_description, optional=True)
-        
+        self.map_fields()
+
         if self.xml.attributes:
             self.add_item("qbl05", self.xml.attributes.qbl05, optional=True)
 
-        # common metadata
-        self.add_item("update_date", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-        # fmt: on
-
 
 class Medication(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("prescriptionnumber", "prescription_number"),
+        Item("fromtime", "from_time", to_datetime),
+        Item("totime", "to_time", to_datetime),
+        Code("enteringorganizationcode", "enteringorganizationcodestd", "enteringorganizationdesc", "entering_organization"),
+        Code("routecode", "routecodestd", "routedesc", "route"),
+        Item("frequency", "frequency"),
+        Item("commenttext", "comments"),
+        Item("dosequantity", "dose_quantity"),
+        Code("doseuomcode", "doseuomcodestd", "doseuomdesc", "dose_uo_m"),
+        Item("indication", "indication"),
+        Item("encounternumber", "encounter_number"),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    key_fields = (
+        Item("fromtime", "from_time", to_datetime),
+        Item("drugproductidcode", "drug_product.id.code", to_value),
+        Item("drugproductgeneric", "drug_product.generic"),
+    )
+    # fmt: on
+
     def __init__(self, xml):
         super().__init__(xml, sqla.Medication)
 
@@ -318,27 +388,33 @@ class Medication(Node):
         # fmt: on
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_item("prescriptionnumber", self.xml.prescription_number)
-        self.add_item("fromtime", self.xml.from_time)
-        self.add_item("totime", self.xml.to_time)
-        self.add_code("enteringorganizationcode", "enteringorganizationcodestd", "enteringorganizationdesc", self.xml.entering_organization)
-        self.add_code( "routecode", "routecodestd", "routedesc", self.xml.route)
+        self.map_fields()
         if self.xml.drug_product:
             self.add_drug_product()
-        
-        self.add_item("frequency", self.xml.frequency)
-        self.add_item("commenttext", self.xml.comments)
-        self.add_item("dosequantity", self.xml.dose_quantity)
-        self.add_code("doseuomcode", "doseuomcodestd", "doseuomdesc",self.xml.dose_uo_m)
-        self.add_item("indication", self.xml.indication)
-        self.add_item("encounternumber", self.xml.encounter_number)
-        self.add_item("updatedon", self.xml.updated_on)
-        self.add_item("externalid", self.xml.external_id)
-        # fmt: on
 
 
 class TransplantList(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("encounternumber", "encounter_number", None, optional=False),
+        Item("encountertype", "encounter_type", to_value),
+        Item("fromtime", "from_time", to_datetime, optional=False),
+        Item("totime", "to_time", to_datetime),
+        Code("admittingcliniciancode", "admittingcliniciancodestd", "admittingcliniciandesc", "admitting_clinician"),
+        Code("healthcarefacilitycode", "healthcarefacilitycodestd", "healthcarefacilitydesc", "health_care_facility"),
+        Code("admitreasoncode", "admitreasoncodestd", "admitreasondesc", "admit_reason"),
+        Code("admissionsourcecode", "admissionsourcecodestd", "admissionsourcedesc", "admission_source"),
+        Code("dischargereasoncode", "dischargereasoncodestd", "dischargereasondesc", "discharge_reason"),
+        Code("dischargelocationcode", "dischargelocationcodestd", "dischargelocationdesc", "discharge_location"),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Item("visitdescription", "visit_description"),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_encounters.TransplantList):
         super().__init__(xml, sqla.TransplantList)
 
@@ -346,25 +422,31 @@ class TransplantList(Node):
         return "transplantlists"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_item("encounternumber", self.xml.encounter_number, optional=False)
-        self.add_item("encountertype", self.xml.encounter_type, optional=True)
-        self.add_item("fromtime", self.xml.from_time, optional=False)
-        self.add_item("totime", self.xml.to_time, optional=True)
-        self.add_code("admittingcliniciancode", "admittingcliniciancodestd", "admittingcliniciandesc", self.xml.admitting_clinician, optional=True)
-        self.add_code("healthcarefacilitycode", "healthcarefacilitycodestd", "healthcarefacilitydesc", self.xml.health_care_facility, optional=True,)
-        self.add_code("admitreasoncode", "admitreasoncodestd", "admitreasondesc", self.xml.admit_reason, optional=True,)
-        self.add_code("admissionsourcecode", "admissionsourcecodestd", "admissionsourcedesc", self.xml.admission_source, optional=True)
-        self.add_code("dischargereasoncode", "dischargereasoncodestd", "dischargereasondesc", self.xml.discharge_reason, optional=True,)
-        self.add_code("dischargelocationcode", "dischargelocationcodestd", "dischargelocationdesc", self.xml.discharge_location, optional=True,)
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at, optional=True,)
-        self.add_item("visitdescription", self.xml.visit_description, optional=True)
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-        # fmt: on
+        self.map_fields()
 
 
 class Encounter(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("encounternumber", "encounter_number"),
+        Item("encountertype", "encounter_type", to_value, optional=False),
+        Item("fromtime", "from_time", to_datetime, optional=False),
+        Item("totime", "to_time", to_datetime),
+        Code("admittingcliniciancode", "admittingcliniciancodestd", "admittingcliniciandesc", "admitting_clinician"),
+        Code("healthcarefacilitycode", "healthcarefacilitycodestd", "healthcarefacilitydesc", "health_care_facility"),
+        Code("admitreasoncode", "admitreasoncodestd", "admitreasondesc", "admit_reason"),
+        Code("admissionsourcecode", "admissionsourcecodestd", "admissionsourcedesc", "admission_source"),
+        Code("dischargereasoncode", "dischargereasoncodestd", "dischargereasondesc", "discharge_reason"),
+        Code("dischargelocationcode", "dischargelocationcodestd", "dischargelocationdesc", "discharge_location"),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Item("visitdescription", "visit_description"),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_encounters.Encounter):
         super().__init__(xml, sqla.Encounter)
 
@@ -372,20 +454,5 @@ class Encounter(Node):
         return "encounters"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_item("encounternumber", self.xml.encounter_number, optional=True)
-        self.add_item("encountertype", self.xml.encounter_type, optional=False)
-        self.add_item("fromtime", self.xml.from_time, optional=False)
-        self.add_item("totime", self.xml.to_time, optional=True)
-        self.add_code("admittingcliniciancode", "admittingcliniciancodestd", "admittingcliniciandesc", self.xml.admitting_clinician, optional=True)
-        self.add_code("healthcarefacilitycode", "healthcarefacilitycodestd", "healthcarefacilitydesc", self.xml.health_care_facility, optional=True)
-        self.add_code("admitreasoncode", "admitreasoncodestd", "admitreasondesc", self.xml.admit_reason, optional=True)
-        self.add_code("admissionsourcecode", "admissionsourcecodestd", "admissionsourcedesc", self.xml.admission_source, optional=True)
-        self.add_code("dischargereasoncode", "dischargereasoncodestd", "dischargereasondesc", self.xml.discharge_reason, optional=True)
-        self.add_code("dischargelocationcode", "dischargelocationcodestd", "dischargelocationdesc", self.xml.discharge_location, optional=True)
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at, optional=True)
-        self.add_item("visitdescription", self.xml.visit_description, optional=True)
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-        # fmt: on
+        self.map_fields()
         return
@@ -11,6 +11,13 @@ import ukrdc_cupid.core.store.keygen as key_gen
 from sqlalchemy.orm import Session
 
 from ukrdc_cupid.core.store.models.structure import Node, RecordStatus
+from ukrdc_cupid.core.store.models.fields import (
+    Code,
+    Item,
+    to_date,
+    to_datetime,
+    to_value,
+)
 
 import ukrdc_xsdata.ukrdc as xsd_ukrdc  # type: ignore
 import ukrdc_xsdata.ukrdc.types as xsd_types  # type: ignore
@@ -38,6 +45,21 @@ def add_address(node: Node, address_xml: xsd_types.Address):
 
 
 class PatientNumber(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("patientid", "number"),
+        Item("organization", "organization", to_value),
+        Item("numbertype", "number_type", to_value),
+    )
+    key_fields = (
+        Item("patientid", "number"),
+        Item("organization", "organization", to_value),
+        Item("numbertype", "number_type", to_value),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_types.PatientNumber):
         super().__init__(xml, sqla.PatientNumber)
 
@@ -45,12 +67,28 @@ class PatientNumber(Node):
         return "numbers"
 
     def map_xml_to_orm(self, _) -> None:
-        self.add_item("patientid", self.xml.number)
-        self.add_item("organization", self.xml.organization)
-        self.add_item("numbertype", self.xml.number_type)
+        self.map_fields()
 
 
 class Name(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("nameuse", "use", to_value),
+        Item("prefix", "prefix"),
+        Item("family", "family"),
+        Item("given", "given"),
+        Item("othergivennames", "other_given_names"),
+        Item("suffix", "suffix"),
+    )
+    key_fields = (
+        Item("nameuse", "use", to_value),
+        Item("family", "family"),
+        Item("given", "given"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_types.Name):
         super().__init__(xml, sqla.Name)
 
@@ -58,15 +96,24 @@ class Name(Node):
         return "names"
 
     def map_xml_to_orm(self, _) -> None:
-        self.add_item("nameuse", self.xml.use)
-        self.add_item("prefix", self.xml.prefix)
-        self.add_item("family", self.xml.family)
-        self.add_item("given", self.xml.given)
-        self.add_item("othergivennames", self.xml.other_given_names)
-        self.add_item("suffix", self.xml.suffix)
+        self.map_fields()
 
 
 class ContactDetail(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("contactuse", "use", to_value),
+        Item("contactvalue", "value"),
+        Item("commenttext", "comments"),
+    )
+    key_fields = (
+        Item("contactuse", "use", to_value),
+        Item("contactvalue", "value"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_types.ContactDetail):
         super().__init__(xml, sqla.ContactDetail)
 
@@ -74,12 +121,20 @@ class ContactDetail(Node):
         return "contact_details"
 
     def map_xml_to_orm(self, _) -> None:
-        self.add_item("contactuse", self.xml.use)
-        self.add_item("contactvalue", self.xml.value)
-        self.add_item("commenttext", self.xml.comments)
+        self.map_fields()
 
 
 class Address(Node):
+    __slots__ = ()
+
+    # fmt: off
+    key_fields = (
+        Item("fromtime", "from_time", to_date),
+        Item("street", "street"),
+        Item("postcode", "postcode"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_types.Address):
         super().__init__(xml, sqla.Address)
 
@@ -92,6 +147,8 @@ class Address(Node):
 
 
 class FamilyDoctor(Node):
+    __slots__ = ()
+
     def __init__(self, xml: xsd_types.FamilyDoctor):
         super().__init__(xml, sqla.FamilyDoctor)
 
@@ -121,6 +178,16 @@ class FamilyDoctor(Node):
 
 
 class Patient(Node):
+    __slots__ = ()
+
+    sections = (
+        (PatientNumber, "patient_numbers.patient_number"),
+        (Name, "names.name"),
+        (ContactDetail, "contact_details.contact_detail"),
+        (Address, "addresses.address"),
+        (FamilyDoctor, "family_doctor"),
+    )
+
     def __init__(self, xml: xsd_ukrdc.Patient):
         super().__init__(xml, sqla.Patient)
 
@@ -186,15 +253,25 @@ class Patient(Node):
         self.add_item("updated_on", self.xml.updated_on)
 
         # relationships these are all sequential
-        self.add_children(PatientNumber, "patient_numbers.patient_number", session)
-        self.add_children(Name, "names.name", session)
-        self.add_children(ContactDetail, "contact_details.contact_detail", session)
-        self.add_children(Address, "addresses.address", session)
-        self.add_children(FamilyDoctor, "family_doctor", session)
+        for child_node, xml_attr in self.sections:
+            self.add_children(child_node, xml_attr, session)
         # fmt: on
 
 
 class SocialHistory(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Code("socialhabitcode", "socialhabitcodestd", "socialhabitdesc", "social_habit", optional=False),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    key_fields = (
+        Item("socialhabitcode", "social_habit.code", to_value),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_ukrdc.Patient):
         super().__init__(xml, sqla.SocialHistory)
 
@@ -202,14 +279,29 @@ class SocialHistory(Node):
         return "social_histories"
 
     def map_xml_to_orm(self, _):
-        # fmt:off
-        self.add_code("socialhabitcode", "socialhabitcodestd", "socialhabitdesc", self.xml.social_habit, optional=False)
-        self.add_item("updatedon", self.xml.updated_on)
-        self.add_item("externalid", self.xml.external_id)
-        # fmt:on
+        self.map_fields()
 
 
 class FamilyHistory(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Code("familymembercode", "familymembercodestd", "familymemberdesc", "family_member"),
+        Code("diagnosiscode", "diagnosiscodestd", "diagnosisdesc", "diagnosis"),
+        Item("notetext", "note_text"),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Item("fromtime", "from_time", to_datetime),
+        Item("totime", "to_time", to_datetime),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    key_fields = (
+        Item("familymembercode", "family_member.code", to_value),
+        Item("diagnosiscode", "diagnosis.code", to_value),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_family_histories):
         super().__init__(xml, sqla.FamilyHistory)
 
@@ -217,19 +309,34 @@ class FamilyHistory(Node):
         return "family_histories"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_code("familymembercode", "familymembercodestd", "familymemberdesc", self.xml.family_member, optional=True)
-        self.add_code("diagnosiscode", "diagnosiscodestd", "diagnosisdesc", self.xml.diagnosis, optional=True)
-        self.add_item("notetext", self.xml.note_text, optional=True)
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at, optional=True)
-        self.add_item("fromtime", self.xml.from_time, optional=True)
-        self.add_item("totime", self.xml.to_time, optional=True)
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)        
-        # fmt: on
+        self.map_fields()
 
 
 class Allergy(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Code("allergycode", "allergycodestd", "allergydesc", "allergy"),
+        Code("allergycategorycode", "allergycategorycodestd", "allergycategorydesc", "allergy_category"),
+        Code("severitycode", "severitycodestd", "severitydesc", "severity"),
+        Code("cliniciancode", "cliniciancodestd", "cliniciandesc", "clinician"),
+        Item("discoverytime", "discovery_time", to_datetime),
+        Item("confirmedtime", "confirmed_time", to_datetime),
+        Item("commenttext", "comments"),
+        Item("inactivetime", "inactive_time", to_datetime),
+        Item("freetextallergy", "free_text_allergy"),
+        Item("qualifyingdetails", "qualifying_details"),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    key_fields = (
+        Item("allergycode", "allergy.code", to_value),
+        Item("freetextallergy", "free_text_allergy"),
+        Item("discoverytime", "discovery_time", to_datetime),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_allergy.Allergy):
         super().__init__(xml, sqla.Allergy)
 
@@ -237,27 +344,33 @@ class Allergy(Node):
         return "allergies"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_code("allergycode","allergycodestd","allergydesc", self.xml.allergy)
-        self.add_code("allergycategorycode","allergycategorycodestd","allergycategorydesc", self.xml.allergy_category)
-        self.add_code("severitycode","severitycodestd","severitydesc", self.xml.severity)
-        self.add_code("cliniciancode","cliniciancodestd","cliniciandesc",self.xml.clinician)
-        self.add_item("discoverytime", self.xml.discovery_time, optional=True)
-        self.add_item("confirmedtime", self.xml.confirmed_time, optional=True)
-        self.add_item("commenttext", self.xml.comments, optional=True)
-        self.add_item("inactivetime", self.xml.inactive_time, optional=True)
-        self.add_item("freetextallergy", self.xml.free_text_allergy, optional=True)
-        self.add_item("qualifyingdetails", self.xml.qualifying_details, optional=True)
-
-        # common metadata
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-
         # there is an update_date, actioncode here not sure what it does
-        self.add_item("externalid", self.xml.external_id, optional=True)
-        # fmt: on
+        self.map_fields()
 
 
 class Diagnosis(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Code("diagnosingcliniciancode", "diagnosingcliniciancodestd", "diagnosingcliniciandesc", "diagnosing_clinician"),
+        Code("diagnosiscode", "diagnosiscodestd", "diagnosisdesc", "diagnosis"),
+        Item("diagnosistype", "diagnosis_type"),
+        Item("comments", "comments"),
+        Item("identificationtime", "identification_time", to_datetime),
+        Item("onsettime", "onset_time", to_datetime),
+        Item("enteredon", "entered_on", to_datetime),
+        Item("encounternumber", "encounter_number"),
+        Item("verificationstatus", "verification_status", to_value),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    key_fields = (
+        Item("diagnosiscode", "diagnosis.code", to_value),
+        Item("identificationtime", "identification_time", to_datetime),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_diagnosis.Diagnosis):
         super().__init__(xml, sqla.Diagnosis)
 
@@ -265,27 +378,27 @@ class Diagnosis(Node):
         return "diagnoses"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_code("diagnosingcliniciancode", "diagnosingcliniciancodestd", "diagnosingcliniciandesc", self.xml.diagnosing_clinician)
-
-        self.add_code("diagnosiscode", "diagnosiscodestd", "diagnosisdesc", self.xml.diagnosis)
-
         # TODO: Add biopsy performed when supported by the database.
-        self.add_item("diagnosistype", self.xml.diagnosis_type)
-        self.add_item("comments", self.xml.comments)
-        self.add_item("identificationtime", self.xml.identification_time)
-        self.add_item("onsettime", self.xml.onset_time)
-        self.add_item("enteredon", self.xml.entered_on)
-        self.add_item("encounternumber", self.xml.encounter_number)
-        self.add_item("verificationstatus", self.xml.verification_status)
-
-        # common metadata
-        self.add_item("updatedon", self.xml.updated_on)
-        self.add_item("externalid", self.xml.external_id)
-        # fmt: on
+        self.map_fields()
 
 
 class RenalDiagnosis(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("diagnosistype", "diagnosis_type", to_value),
+        Code("diagnosingcliniciancode", "diagnosingcliniciancodestd", "diagnosingcliniciandesc", "diagnosing_clinician"),
+        Code("diagnosiscode", "diagnosiscodestd", "diagnosisdesc", "diagnosis"),
+        Item("comments", "comments"),
+        Item("identificationtime", "identification_time", to_datetime),
+        Item("onsettime", "onset_time", to_datetime),
+        Item("enteredon", "entered_on", to_datetime),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_diagnosis.RenalDiagnosis):
         super().__init__(xml, sqla.RenalDiagnosis)
 
@@ -293,28 +406,27 @@ class RenalDiagnosis(Node):
         return "renaldiagnoses"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_item("diagnosistype", self.xml.diagnosis_type)
-        self.add_code( "diagnosingcliniciancode", "diagnosingcliniciancodestd", "diagnosingcliniciandesc", self.xml.diagnosing_clinician)
-        self.add_code("diagnosiscode", "diagnosiscodestd","diagnosisdesc", self.xml.diagnosis)
-        self.add_item("comments", self.xml.comments)
-        self.add_item("identificationtime", self.xml.identification_time)
-        self.add_item("onsettime", self.xml.onset_time)
-        self.add_item("enteredon", self.xml.entered_on)
-
-        # common metadata
-        self.add_item("updatedon", self.xml.updated_on)
-        self.add_item("externalid", self.xml.external_id)
+        self.map_fields()
 
         if self.xml.verification_status:
             print("Cause of Death verification status not currently supported")
 
         if self.xml.biopsy_performed:
             print("Biopsy performed status not currently supported")
-        # fmt: on
 
 
 class Assessment(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("assessmentstart", "assessment_start", to_datetime),
+        Item("assessmentend", "assessment_end", to_datetime),
+        Code("assessmenttypecode", "assessmenttypecodestd", "assessmenttypedesc", "assessment_type"),
+        Code("assessmentoutcomecode", "assessmentoutcomecodestd", "assessmentoutcomedesc", "assessment_outcome"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_diagnosis.Assessment):
         super().__init__(xml, sqla.Assessment)
 
@@ -322,16 +434,23 @@ class Assessment(Node):
         return "assessments"
 
     def map_xml_to_orm(self, _):
-
-        # fmt: off
-        self.add_item("assessmentstart", self.xml.assessment_start)
-        self.add_item("assessmentend", self.xml.assessment_end)
-        self.add_code("assessmenttypecode", "assessmenttypecodestd", "assessmenttypedesc", self.xml.assessment_type)
-        self.add_code("assessmentoutcomecode", "assessmentoutcomecodestd", "assessmentoutcomedesc", self.xml.assessment_outcome)
-        # fmt: on
+        self.map_fields()
 
 
 class CauseOfDeath(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("diagnosistype", "diagnosis_type", to_value),
+        Code("diagnosiscode", "diagnosiscodestd", "diagnosisdesc", "diagnosis"),
+        Item("comments", "comments"),
+        Item("enteredon", "entered_on", to_datetime),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_diagnosis.CauseOfDeath):
         super().__init__(xml, sqla.CauseOfDeath)
 
@@ -339,21 +458,35 @@ class CauseOfDeath(Node):
         return "cause_of_death"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_item("diagnosistype", self.xml.diagnosis_type)
-        self.add_code("diagnosiscode", "diagnosiscodestd", "diagnosisdesc", self.xml.diagnosis)
+        self.map_fields()
 
-        self.add_item("comments", self.xml.comments, optional=True)
-        #self.add_item()
-        self.add_item("enteredon", self.xml.entered_on, optional=True)
 
-        # common metadata
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-        # fmt: on
+class Document(Node):
+    __slots__ = ()
 
+    # fmt: off
+    fields = (
+        Code("cliniciancode", "cliniciancodestd", "cliniciandesc", "clinician"),
+        Item("documentname", "document_name"),
+        Item("documenttime", "document_time", to_datetime),
+        Code("documenttypecode", "documenttypecodestd", "documenttypedesc", "document_type"),
+        Item("documenturl", "document_url"),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Code("enteredbycode", "enteredbycodestd", "enteredbydesc", "entered_by"),
+        Item("externalid", "external_id"),
+        Item("filename", "file_name"),
+        Item("filetype", "file_type"),
+        Item("notetext", "note_text"),
+        Code("statuscode", "statuscodestd", "statusdesc", "status"),
+        Item("updatedon", "updated_on", to_datetime),
+    )
+    key_fields = (
+        Item("documentname", "document_name"),
+        Item("documenttime", "document_time", to_datetime),
+        Item("filename", "file_name"),
+    )
+    # fmt: on
 
-class Document(Node):
     def __init__(self, xml: xsd_diagnosis.Diagnosis):
         super().__init__(xml, sqla.Document)
 
@@ -361,19 +494,8 @@ class Document(Node):
         return "documents"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_code("cliniciancode", "cliniciancodestd", "cliniciandesc", self.xml.clinician)
-        self.add_item("documentname", self.xml.document_name)
-        self.add_item("documenttime", self.xml.document_time)
-        self.add_code("documenttypecode","documenttypecodestd","documenttypedesc",self.xml.document_type)
-        self.add_item("documenturl", self.xml.document_url)
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at)
-        self.add_code("enteredbycode", "enteredbycodestd", "enteredbydesc", self.xml.entered_by)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-        self.add_item("filename", self.xml.file_name)
-        self.add_item("filetype", self.xml.file_type)
-        self.add_item("notetext", self.xml.note_text)
-        self.add_code("statuscode", "statuscodestd", "statusdesc", self.xml.status)
+        self.map_fields()
+
         # not sure exactly what's going on here. I think the purpose of this
         # field is to store the document as binary. The xsdata models seem to
         # decode it automatically. Probably it then gets encoded again
@@ -381,10 +503,11 @@ class Document(Node):
             self.orm_object.stream = self.xml.stream
 
         # self.add_item("stream", int(self.xml.stream))
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        # fmt: on
+
 
 class Survey(Node):
+    __slots__ = ()
+
     def __init__(self, xml: xsd_surveys.Survey):
         super().__init__(xml, sqla.Survey)
 
@@ -406,15 +529,13 @@ class Survey(Node):
         """
         xml_items = getattr(self.xml, xml_attr)
         if xml_items:
-            child_ids = []
+            child_nodes = []
             for child_xml, seq_no in enumerate(xml_items):
                 # generate the id for the child and map it to the database
                 survey_id = self.orm_model.id
                 child_node_instance = child_node(xml=child_xml)
-                child_id = child_node_instance.map_to_database(
-                    session, survey_id, seq_no
-                )
-                child_ids.append(child_id)
+                child_node_instance.map_to_database(session, survey_id, seq_no)
+                child_nodes.append(child_node_instance)
 
                 # map information in xml
                 child_node_instance.map_xml_to_orm()
@@ -425,7 +546,7 @@ class Survey(Node):
                 # map child class to parent
                 self.mapped_classes.append(child_node_instance)
 
-            self.add_deleted(child_node.sqla_mapped(), child_ids)
+            self.add_deleted(child_node.sqla_mapped(), child_nodes)
 
     def map_xml_to_orm(self, _):
         # fmt: off
@@ -448,6 +569,8 @@ class Survey(Node):
 
 
 class Score(Node):
+    __slots__ = ()
+
     def __init__(self, xml: xsd_surveys.Score):
         super().__init__(xml, sqla.Score)
 
@@ -463,6 +586,8 @@ class Score(Node):
 
 
 class Question(Node):
+    __slots__ = ()
+
     def __init__(self, xml: xsd_surveys.Question):
         super().__init__(xml, sqla.Question)
 
@@ -480,6 +605,8 @@ class Question(Node):
 
 
 class Level(Node):
+    __slots__ = ()
+
     def __init__(self, xml: xsd_surveys.Level):
         super().__init__(xml, sqla.Level)
 
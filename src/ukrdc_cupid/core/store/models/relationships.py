@@ -1,4 +1,5 @@
 from ukrdc_cupid.core.store.models.structure import Node
+from ukrdc_cupid.core.store.models.fields import Code, Item, to_date, to_datetime
 import ukrdc_sqla.ukrdc as sqla
 import ukrdc_xsdata.ukrdc.program_memberships as xsd_program_memberships  # type: ignore
 import ukrdc_xsdata.ukrdc.opt_outs as xsd_opt_outs  # type: ignore
@@ -6,6 +7,25 @@ import ukrdc_xsdata.ukrdc.clinical_relationships as xsd_clinical_relationships
 
 
 class ProgramMembership(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Code("enteredbycode", "enteredbycodestd", "enteredbydesc", "entered_by"),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Item("programname", "program_name"),
+        Item("programdescription", "program_description"),
+        Item("fromtime", "from_time", to_datetime, optional=False),
+        Item("totime", "to_time", to_datetime),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    key_fields = (
+        Item("programname", "program_name"),
+        Item("fromtime", "from_time", to_date),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_program_memberships.ProgramMembership):
         super().__init__(xml, sqla.ProgramMembership)
 
@@ -13,19 +33,29 @@ class ProgramMembership(Node):
         return "program_memberships"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_code("enteredbycode", "enteredbycodestd","enteredbydesc",self.xml.entered_by)
-        self.add_code("enteredatcode", "enteredatcodestd", "enteredatdesc", self.xml.entered_at)
-        self.add_item("programname", self.xml.program_name, optional=True)
-        self.add_item("programdescription", self.xml.program_description, optional=True)
-        self.add_item("fromtime", self.xml.from_time, optional=False)
-        self.add_item("totime", self.xml.to_time, optional=True)
-        self.add_item("updatedon", self.xml.updated_on, optional=True)
-        self.add_item("externalid", self.xml.external_id, optional=True)
-        # fmt: on
+        self.map_fields()
 
 
 class OptOut(Node):
+    __slots__ = ()
+
+    # fmt: off
+    fields = (
+        Item("programname", "program_name"),
+        Item("programdescription", "program_description"),
+        Code("enteredbycode", "enteredbycodestd", "enteredbydesc", "entered_by"),
+        Code("enteredatcode", "enteredatcodestd", "enteredatdesc", "entered_at"),
+        Item("fromtime", "from_time", to_datetime, optional=False),
+        Item("totime", "to_time", to_datetime),
+        Item("updatedon", "updated_on", to_datetime),
+        Item("externalid", "external_id"),
+    )
+    key_fields = (
+        Item("programname", "program_name"),
+        Item("fromtime", "from_time", to_date),
+    )
+    # fmt: on
+
     def __init__(self, xml: xsd_opt_outs.OptOut):
         super().__init__(xml, sqla.OptOut)
 
@@ -33,19 +63,12 @@ class OptOut(Node):
         return "opt_outs"
 
     def map_xml_to_orm(self, _):
-        # fmt: off
-        self.add_item("program_name", self.xml.program_name)
-        self.add_item("program_description", self.xml.program_description)
-        self.add_code("entered_by_code", "entered_by_code_std", "entered_by_desc", self.xml.entered_by)
-        self.add_code("entered_at_code", "entered_at_code_std", "entered_at_desc", self.xml.entered_at)
-        self.add_item("from_time", self.xml.from_time, optional=False)
-        self.add_item("to_time", self.xml.to_time, optional=True)
-        self.add_item("updated_on", self.xml.updated_on, optional=True)
-        self.add_item("external_id", self.xml.external_id, optional=True)
-        # fmt: on
+        self.map_fields()
 
 
 class ClinicalRelationship(Node):
+    __slots__ = ()
+
     def __init__(self, xml: xsd_clinical_relationships.ClinicalRelationship):
         super().__init__(xml, sqla.ClinicalRelationship)
 
@@ -5,7 +5,7 @@ from abc import ABC, abstractmethod
 from datetime import datetime
 from decimal import Decimal
 from enum import Enum, auto
-from typing import Dict, List, Optional, Tuple, Type, Union
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union
 
 import ukrdc_cupid.core.store.keygen as key_gen
 import ukrdc_sqla.ukrdc as sqla
@@ -14,6 +14,16 @@ import ukrdc_xsdata.ukrdc.types as xsd_types  # type: ignore
 from zoneinfo import ZoneInfo
 from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import instance_state
+from ukrdc_cupid.core.store.delete import Deletion
+from ukrdc_cupid.core.store.models.changes import compare, current_change_log
+from ukrdc_cupid.core.store.models.fields import (
+    Code,
+    CompiledField,
+    Item,
+    compile_fields,
+)
+from ukrdc_cupid.core.store.prefetch import KeyPrefetch, get_orm
 from xsdata.models.datatype import XmlDate, XmlDateTime
 
 
@@ -23,6 +33,55 @@ class RecordStatus(Enum):
     UNCHANGED = auto()
 
 
+class NodeCollection:
+    """Everything gathered from a mapped tree by Node.collect"""
+
+    def __init__(self, statuses: Sequence[RecordStatus]):
+        self.orm_objects: Dict[RecordStatus, List] = {status: [] for status in statuses}
+        self.counts: Dict[RecordStatus, int] = {status: 0 for status in RecordStatus}
+        self.deletions: List[Deletion] = []
+
+
+def extract_xml_items(xml: xsd_all, xml_attr: str) -> list:
+    """Step into the xml following a dotted path of xsdata attributes and
+    return the items found there as a list.
+
+    Args:
+        xml (xsd_all): xsdata object to start from
+        xml_attr (str): dotted path e.g. "procedures.dialysis_sessions.dialysis_session"
+
+    Returns:
+        list: xml items, empty if nothing was found
+    """
+
+    xml_items = xml
+    for attr in xml_attr.split("."):
+        # This pattern is used where the xml looks something like
+        # <Procedures>
+        #    <Treatment>
+        #    </Treatment>
+        # </Procedures>
+        # with the ultimate goal of just creating a list of bits of xml
+        # whose attributes correspond specifically to attributes of a
+        # ukrdc_sqla model
+        if isinstance(xml_items, list):
+            # this is necessary because of the weirdness of xsdata
+            if xml_items:
+                xml_items = xml_items[0]
+
+        if xml_items:
+            xml_items = getattr(xml_items, attr, None)
+
+    if not xml_items:
+        return []
+
+    if not isinstance(xml_items, list):
+        # for convenience treat singular items as a list
+        return [xml_items]
+
+    return xml_items
+
+
 class Node(ABC):
     """
     This class is basically designed to be a wrapper around the sqla classes which allows
@@ -36,6 +95,43 @@ class Node(ABC):
     so. This means in places they will have to be overidden.
     """
 
+    # Child nodes mapped by add_children in the form (node class, xml path).
+    # These are also walked ahead of mapping to prefetch existing records.
+    sections: Tuple[Tuple[Type[Node], str], ...] = ()
+
+    # Columns mapped straight from the xml by map_fields, see fields.py. They
+    # are compiled once per class when it is created.
+    fields: Tuple[Union[Item, Code], ...] = ()
+    _compiled_fields: Tuple[CompiledField, ...] = ()
+
+    # Set on nodes whose keys can clash within a file, duplicates are
+    # renumbered once the patient record is mapped (see keygen).
+    deduplicate: bool = False
+
+    # Natural identifying fields of nodes which can be keyed by content
+    # rather than position when content keys are switched on. These are
+    # field specs, like `fields`, so the same key can be worked out from
+    # the stored row (see keygen.generate_content_key).
+    key_fields: Tuple[Item, ...] = ()
+
+    # A large file maps to tens of thousands of nodes so they are slotted
+    # rather than each carrying a __dict__. Subclasses must declare their own
+    # __slots__ (empty unless they add attributes) to keep this.
+    __slots__ = (
+        "xml",
+        "mapped_classes",
+        "deletions",
+        "orm_model",
+        "orm_object",
+        "pid",
+        "status",
+        "content_keys",
+    )
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._compiled_fields = compile_fields(cls.fields)
+
     def __init__(
         self,
         xml: xsd_all,
@@ -43,21 +139,39 @@ class Node(ABC):
     ):
         self.xml = xml  # xml file corresponding to a given
         self.mapped_classes: List[Node] = []  # classes which depend on this one
-        self.deleted_orm: List[sqla.Base] = []  # type:ignore
+        self.deletions: List[Deletion] = []  # records to remove if not in file
         self.orm_model = orm_model  # orm class
         self.pid: Optional[str] = None  # placeholder for pid
         self.status: RecordStatus = RecordStatus.UNCHANGED
+        self.content_keys = False  # key children by content, set by parent
 
     def generate_id(self, seq_no: int) -> str:
         # Each database record has a natural key formed from compounding bits of information
         # the most common key appears to be pid (or parent record id) + enumeration of appearence in xml
 
         if self.pid is not None:
-            id = key_gen.generate_generic_key(self.pid, seq_no)
+            if self.content_keys and self.key_fields:
+                digest = key_gen.content_digest(self.xml, self.key_fields)
+                id = key_gen.generate_content_key(self.pid, digest, seq_no)
+            else:
+                id = key_gen.generate_generic_key(self.pid, seq_no)
         else:
             id = str(seq_no)
         return id
 
+    def key_sequence(self, child_node: Type[Node], xml_items: list) -> Sequence[int]:
+        """The sequence numbers the keys (and idx) of the children are
+        generated with. Usually this is their position in the file but
+        children keyed by content are numbered amongst those with the same
+        content.
+        """
+        if self.content_keys and child_node.key_fields:
+            return key_gen.content_sequence(
+                key_gen.content_digest(xml_item, child_node.key_fields)
+                for xml_item in xml_items
+            )
+        return range(len(xml_items))
+
     def map_to_database(
         self, session: Session, pid: Union[str, None], seq_no: int
     ) -> str:
@@ -66,7 +180,7 @@ class Node(ABC):
         id = self.generate_id(seq_no)
 
         # Use primary key to fetch record
-        self.orm_object = session.get(self.orm_model, id)
+        self.orm_object = get_orm(session, self.orm_model, id)
 
         # If it doesn't exit create it and flag that it's new
         if self.orm_object is None:
@@ -75,6 +189,30 @@ class Node(ABC):
 
         return id
 
+    def sections_to_map(self) -> Iterator[Tuple[Type[Node], str]]:
+        """The sections which collect_keys and mapping step into, by default
+        all of them.
+        """
+        return iter(self.sections)
+
+    def collect_keys(self, prefetch: KeyPrefetch) -> None:
+        """Walk the child sections of the xml generating the primary key of
+        every record that add_children will look up. This must mirror the
+        way ids are generated during mapping.
+
+        Args:
+            prefetch (KeyPrefetch): collection of keys to load in bulk
+        """
+        for child_node, xml_attr in self.sections_to_map():
+            xml_items = extract_xml_items(self.xml, xml_attr)
+            key_sequence = self.key_sequence(child_node, xml_items)
+            for xml_item, key_seq_no in zip(xml_items, key_sequence):
+                child = child_node(xml=xml_item)  # type:ignore
+                child.pid = self.pid
+                child.content_keys = self.content_keys
+                prefetch.add(child.orm_model, child.generate_id(key_seq_no))
+                child.collect_keys(prefetch)
+
     def add_code(
         self,
         property_code: str,
@@ -137,16 +275,92 @@ class Node(ABC):
             if isinstance(attr_value, XmlDate):
                 attr_value = attr_value.to_datetime()
 
-        # coerce type to ensure integer can be compared to strings etc
-        if attr_value and attr_persist and type(attr_value) != type(attr_persist):
-            the_type = type(attr_persist)
-            attr_value = the_type(attr_value)
+        # a new record takes the value as it is, "" included, so only
+        # existing records go through the comparators
+        if self.status == RecordStatus.NEW and attr_persist is None:
+            if attr_value is not None:
+                setattr(self.orm_object, sqla_property, attr_value)
+            return
+
+        # compare to the persistent attribute allowing for differences in
+        # type and representation (see changes.py)
+        comparison = compare(attr_value, attr_persist)
+        if comparison.changed:
+            setattr(self.orm_object, sqla_property, comparison.value)
+
+        if self.status != RecordStatus.NEW:
+            change_log = current_change_log()
+            if change_log is not None:
+                change_log.record(self.orm_model.__tablename__, sqla_property, comparison)
+            if comparison.changed:
+                self.mark_modified()
+
+    def mark_modified(self) -> None:
+        """Flag an existing record as modified by the incoming file"""
+        if self.status == RecordStatus.UNCHANGED:
+            self.status = RecordStatus.MODIFIED
+            change_log = current_change_log()
+            if change_log is not None:
+                change_log.record_row(self.orm_model.__tablename__)
+
+    def map_fields(self) -> None:
+        """Map the columns listed in fields. This does the same as calling
+        add_item (or add_code) for each of them but with the getter and
+        converter for each column worked out in advance.
+        """
+        xml = self.xml
+        orm_object = self.orm_object
+
+        # Reading the persisted values through the orm attributes is most of
+        # the cost of mapping, so they are taken from the loaded state where
+        # possible. An unset column of an object not yet in the database is
+        # None, anything else (e.g. expired) is left to the orm to load.
+        state = instance_state(orm_object)
+        loaded = state.dict
+        persisted = state.has_identity
+
+        change_log = None
+        if self.status != RecordStatus.NEW:
+            change_log = current_change_log()
+        table = self.orm_model.__tablename__
+
+        modified = False
+        for column, get, convert, optional in self._compiled_fields:
+            attr_value = get(xml)
+            if convert is not None:
+                attr_value = convert(attr_value)
+
+            if not optional and not attr_value:
+                raise ValueError(f"Value is required for {column}")
+
+            if column in loaded:
+                attr_persist = loaded[column]
+            elif persisted:
+                attr_persist = getattr(orm_object, column)
+            else:
+                attr_persist = None
+
+            # most values are unchanged and of the same type so are checked
+            # here before going through the comparators in changes.py
+            if attr_value is attr_persist or (
+                type(attr_value) is type(attr_persist) and attr_value == attr_persist
+            ):
+                continue
 
-        # get persistent attribute and compare to incoming
-        if attr_value != attr_persist:
-            setattr(self.orm_object, sqla_property, attr_value)
-            if self.status != RecordStatus.NEW:
-                self.status = RecordStatus.MODIFIED
+            if attr_persist is None and self.status == RecordStatus.NEW:
+                # nothing stored yet, written as it is ("" included)
+                setattr(orm_object, column, attr_value)
+                continue
+
+            comparison = compare(attr_value, attr_persist)
+            if change_log is not None:
+                change_log.record(table, column, comparison)
+            if comparison.changed:
+                setattr(orm_object, column, comparison.value)
+                modified = True
+
+        if modified and self.status != RecordStatus.NEW:
+            self.mark_modified()
 
     def add_children(
         self, child_node: Type[Node], xml_attr: str, session: Session
@@ -166,45 +380,26 @@ class Node(ABC):
             sequential (bool, optional): _description_. Defaults to False.
         """
 
-        # Blank xml
-        # is_empty = len(xml_items)
-
         # Step into the xml_file and extract the xml containing incoming data
-        xml_items = self.xml
-        for attr in xml_attr.split("."):
-            # This pattern is used where the xml looks something like
-            # <Procedures>
-            #    <Treatment>
-            #    </Treatment>
-            # </Procedures>
-            # with the ultimate goal of just creating a list of bits of xml
-            # whose attributes correspond specifically to attributes of a
-            # ukrdc_sqla model
-            if isinstance(xml_items, list):
-                # this is necessary because of the weirdness of xsdata
-                if xml_items:
-                    xml_items = xml_items[0]
-
-            if xml_items:
-                xml_items = getattr(xml_items, attr, None)
+        xml_items = extract_xml_items(self.xml, xml_attr)
 
-        mapped_ids = []
+        mapped_nodes = []
         if xml_items:
-            if not isinstance(xml_items, list):
-                # for convenience treat singular items as a list
-                xml_items = [xml_items]
-
-            for seq_no, xml_item in enumerate(xml_items):
+            key_sequence = self.key_sequence(child_node, xml_items)
+            for seq_no, xml_item in zip(key_sequence, xml_items):
                 # Some item are sent in sequential order this order implicitly sets the keys
-                # there is a possibility here to sort the items before enumerating them
+                # there is a possibility here to sort the items before enumerating them.
+                # Records keyed by content are numbered amongst those with the same content
+                # instead so idx doesn't shift when the list is reordered either.
                 node_object = child_node(xml=xml_item)  # type:ignore
+                node_object.content_keys = self.content_keys
 
                 # Generate parent data also required for setting primary keys
                 parent_data = self.generate_parent_data(seq_no)
 
                 # map to existing object or create new
-                id = node_object.map_to_database(session, self.pid, seq_no)
-                mapped_ids.append(id)
+                node_object.map_to_database(session, self.pid, seq_no)
+                mapped_nodes.append(node_object)
 
                 # add parent info
                 # add any foreign keys, enumerations or data which doesn't come
@@ -227,20 +422,67 @@ class Node(ABC):
         # self.sqla_relationship to None.
         sqla_relationship = child_node.sqla_mapped()  # type : ignore
         if sqla_relationship:
-            self.add_deleted(sqla_relationship, mapped_ids)
+            self.add_deleted(sqla_relationship, mapped_nodes)
 
-    def add_deleted(self, sqla_mapped: str, mapped_ids: List[str]) -> None:
-        # stage records for deletion using the lazy mapping and a list of ids of records in the file
+    def add_deleted(self, sqla_mapped: str, mapped_nodes: List[Node]) -> None:
+        # stage for deletion records which are mapped to this one but don't appear in incoming file
         # this is only needed if the is a one to many relationship between parent and child
-        # this function stages for deletion objects which appear mapped but don't appear in incoming file
+        # the records aren't loaded, instead the ids in the file are used to build a delete statement
         # This highlights a problem with the idx method creating keys. What if an item in the middle of the
-        # order gets deleted then everything below gets bumped up one.
+        # order gets deleted then everything below gets bumped up one. Nodes with key_fields avoid this
+        # when content keys are switched on.
+
+        # a new record can't have anything mapped to it yet
+        if self.status == RecordStatus.NEW:
+            return
+
+        self.deletions.append(
+            Deletion.from_relationship(self.orm_object, sqla_mapped, mapped_nodes)
+        )
+
+    def collect(
+        self, statuses: Sequence[RecordStatus] = (RecordStatus.NEW,)
+    ) -> NodeCollection:
+        """Walk the tree once gathering the orm objects with the requested
+        statuses, the counts of every status and the staged deletions. The
+        walk uses an explicit stack so large trees don't build up lists at
+        every level (or hit the recursion limit).
 
-        mapped_orms = [orm for orm in getattr(self.orm_object, sqla_mapped)]
+        Args:
+            statuses: Statuses of the orm objects to gather. Defaults to NEW.
 
-        self.deleted_orm = self.deleted_orm + [
-            record for record in mapped_orms if record.id not in mapped_ids
-        ]
+        Returns:
+            NodeCollection: orm objects in the order the nodes were mapped
+        """
+        collection = NodeCollection(statuses)
+        orm_objects = collection.orm_objects
+        counts = collection.counts
+        deletions = collection.deletions
+
+        stack: List[Node] = [self]
+        while stack:
+            node = stack.pop()
+            counts[node.status] += 1
+            if node.status in orm_objects:
+                orm_objects[node.status].append(node.orm_object)
+            deletions.extend(node.deletions)
+
+            # reversed so children are visited in the order they were mapped
+            stack.extend(reversed(node.mapped_classes))
+
+        return collection
+
+    def release_xml(self) -> None:
+        """Drop the references to the xsdata objects from this node and all
+        of its children once mapping is complete. The tree only needs the orm
+        objects from then on so this lets the decoded file be freed while
+        the tree is still in use.
+        """
+        stack: List[Node] = [self]
+        while stack:
+            node = stack.pop()
+            node.xml = None
+            stack.extend(node.mapped_classes)
 
     def get_orm_list(
         self, statuses: List[RecordStatus] = [RecordStatus.NEW], count_all: bool = True
@@ -255,56 +497,17 @@ class Node(ABC):
             Tuple of (objects_by_status, counts_by_status).
             objects_by_status will only contain keys for requested statuses.
         """
-        # Initialize results
-        orm_objects = {status: [] for status in statuses}
-        counts = {
-            RecordStatus.NEW: 0,
-            RecordStatus.MODIFIED: 0,
-            RecordStatus.UNCHANGED: 0,
-        }
-
-        # Get current record's status
-        current_state = self.status
-
-        # Add to counts
-        counts[current_state] += 1
-
-        # Add to objects dict if status matches requested statuses
-        if current_state in statuses:
-            orm_objects[current_state].append(self.orm_object)
-
-        # Process children
-        if self.mapped_classes:
-            for child_class in self.mapped_classes:
-                child_objects, child_counts = child_class.get_orm_list(
-                    statuses, count_all
-                )
-
-                # Merge child objects for each status
-                for status in statuses:
-                    if status in child_objects:
-                        orm_objects[status].extend(child_objects[status])
-
-                # Add child counts
-                for s in RecordStatus:
-                    counts[s] += child_counts[s]
-
-        return orm_objects, counts
+        collection = self.collect(statuses)
+        return collection.orm_objects, collection.counts
 
     def get_new_records(self):
         orm_objects, _ = self.get_orm_list()
         return orm_objects[RecordStatus.NEW]
 
-    def get_orm_deleted(self) -> list:
+    def get_deletions(self) -> List[Deletion]:
         # function to walk through the patient record structure an retrieve
         # records staged for deletion
-        if self.mapped_classes:
-            orm_objects = self.deleted_orm
-            for child_class in self.mapped_classes:
-                orm_objects = orm_objects + child_class.get_orm_deleted()
-            return orm_objects
-        else:
-            return self.deleted_orm
+        return self.collect(statuses=()).deletions
 
     def updated_status(self) -> None:
         # function to update things like dates if object is changed
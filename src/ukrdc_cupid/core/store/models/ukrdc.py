@@ -24,10 +24,12 @@ we are doing this kind of thing.
 
 from __future__ import annotations  # allows typehint of node class
 
-from typing import Union, Type
-from ukrdc_cupid.core.store.keygen import KEY_SEPARATOR
+from dataclasses import fields
+from typing import Dict, Iterator, Sequence, Tuple, Union, Type
+import ukrdc_cupid.core.store.keygen as key_gen
 from ukrdc_cupid.core.store.models.utils import cull_singlet_lists
-from ukrdc_cupid.core.store.models.structure import Node, RecordStatus
+from ukrdc_cupid.core.store.models.changes import ChangeLog, recording_changes
+from ukrdc_cupid.core.store.models.structure import Node, NodeCollection, RecordStatus
 from ukrdc_cupid.core.store.models.patient import (
     Patient,
     SocialHistory,
@@ -56,7 +58,18 @@ from ukrdc_cupid.core.store.models.relationships import (
     OptOut,
     ProgramMembership,
 )
-from ukrdc_cupid.core.parse.utils import hash_xml
+from ukrdc_cupid.core.parse.utils import (
+    RENDERED_HASH_PREFIX,
+    hash_xml,
+    hash_xml_legacy,
+    hash_xml_tree_sections,
+    is_legacy_hash,
+    is_rendered_hash,
+    render_xml_tree,
+)
+from ukrdc_cupid.core.store.digests import EMPTY_DIGEST, load_unchanged_sections
+from ukrdc_cupid.core.store.delete import Deletion
+from ukrdc_cupid.core.store.prefetch import KeyPrefetch, prefetched
 
 import ukrdc_xsdata.ukrdc as xsd_ukrdc  # type: ignore
 import ukrdc_xsdata.ukrdc.lab_orders as xsd_lab_orders
@@ -64,11 +77,29 @@ import ukrdc_xsdata.ukrdc.observations as xsd_observations
 import ukrdc_xsdata.ukrdc.dialysis_sessions as xsd_dialysis_sessions
 import ukrdc_sqla.ukrdc as sqla
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
 import datetime as dt
 
 from typing import List
 
+# tag of each top level section of the file by its attribute in the xsdata
+SECTION_TAGS = {
+    field.name: field.metadata["name"] for field in fields(xsd_ukrdc.PatientRecord)
+}
+
+
+def section_tag(xml_attr: str) -> str:
+    return SECTION_TAGS[xml_attr.split(".")[0]]
+
+
+def count_nodes(nodes: List[Node]) -> int:
+    count = 0
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.mapped_classes)
+    return count
+
 
 def set_start_stop(
     xml: Union[xsd_lab_orders, xsd_observations, xsd_dialysis_sessions], property: str
@@ -93,9 +124,87 @@ def set_start_stop(
 
 
 class PatientRecord(Node):
-    def __init__(self, xml: xsd_ukrdc.PatientRecord, ex_missing=False):
+    __slots__ = (
+        "file_hash",
+        "hash_upgraded",
+        "repository_updated_date",
+        "lab_order_range",
+        "observation_range",
+        "dialysis_session_range",
+        "is_ex_missing",
+        "keep_xml",
+        "session",
+        "skip_unchanged",
+        "section_hashes",
+        "section_records",
+        "skipped_sections",
+        "changes",
+    )
+
+    # fmt: off
+    sections = (
+        (Patient, "patient"),
+        (SocialHistory, "social_histories.social_history"),
+        (FamilyHistory, "family_histories.family_history"),
+        (Allergy, "allergies.allergy"),
+        (Medication, "medications.medication"),
+        (Diagnosis, "diagnoses.diagnosis"),
+        (RenalDiagnosis, "diagnoses.renal_diagnosis"),
+        (CauseOfDeath, "diagnoses.cause_of_death"),
+        (Observation, "observations.observation"),
+        (LabOrder, "lab_orders.lab_order"),
+        (Procedure, "procedures.procedure"),
+        (DialysisSession, "procedures.dialysis_sessions.dialysis_session"),
+        (VascularAccess, "procedures.vascular_access"),
+        (Transplant, "procedures.transplant"),
+        (Treatment, "encounters.treatment"),
+        (ProgramMembership, "program_memberships.program_membership"),
+        (OptOut, "opt_outs.opt_out"),
+        (ClinicalRelationship, "clinical_relationships.clinical_relationship"),
+        (Document, "documents.document"),
+        (Encounter, "encounters.encounter"),
+        (TransplantList, "encounters.transplant_list"),
+        (Survey, "surveys.survey"),
+    )
+    # fmt: on
+
+    def __init__(
+        self,
+        xml: xsd_ukrdc.PatientRecord,
+        ex_missing=False,
+        file_hash: str = None,
+        keep_xml: bool = True,
+        skip_unchanged: bool = False,
+        section_hashes: Dict[str, str] = None,
+        content_keys: bool = False,
+    ):
         super().__init__(xml, sqla.PatientRecord)
 
+        # key records with key_fields by their content rather than position
+        # in the file. The keys differ between the two so this has to be
+        # used for every file written to a database once it has been
+        # migrated (see scripts/migrate_content_keys.py).
+        self.content_keys = content_keys
+
+        # hash of the raw incoming file (see XmlPipeline.content_hash). Without
+        # it the decoded file is rendered and hashed instead (see hash_xml).
+        self.file_hash = file_hash
+        self.hash_upgraded = False
+
+        # sections which are the same as in the last file written are skipped
+        # rather than mapped (see digests.py). The digests come from
+        # XmlPipeline.section_hashes in the same way as the file hash.
+        self.skip_unchanged = skip_unchanged
+        self.section_hashes = section_hashes
+        self.section_records: Dict[str, int] = {}
+        self.skipped_sections: Dict[str, int] = {}
+
+        # columns and rows of existing records written by the file and why
+        self.changes = ChangeLog()
+
+        # whether the nodes hold on to their xsdata once mapped
+        self.keep_xml = keep_xml
+
         # some records have an additional date (aside from the usual ones update by db triggers)
         # we will now use this to host the date that gets sent on the sending facility
         self.repository_updated_date = xml.sending_facility.time.to_datetime()
@@ -159,37 +268,18 @@ class PatientRecord(Node):
             if number.number_type.value == "MRN":
                 self.orm_object.localpatientid = number.number  # type :ignore
 
-        # fmt: off
-        self.add_children(Patient, "patient", session)
-        self.add_children(SocialHistory, "social_histories.social_history", session)
-        self.add_children(FamilyHistory, "family_histories.family_history", session)
-        self.add_children(Allergy, "allergies.allergy", session)
-        self.add_children(Medication, "medications.medication", session)
-
-        #self.add_children()
-        self.add_children(Diagnosis, "diagnoses.diagnosis", session)
-        self.add_children(RenalDiagnosis, "diagnoses.renal_diagnosis", session)
-        self.add_children(CauseOfDeath, "diagnoses.cause_of_death", session)
-        self.add_children(Observation, "observations.observation", session)
-        self.add_children(LabOrder, "lab_orders.lab_order", session)
-        self.add_children(Procedure, "procedures.procedure", session)
-
-        self.add_children(DialysisSession, "procedures.dialysis_sessions.dialysis_session", session)
-        self.add_children(VascularAccess, "procedures.vascular_access", session)
-        self.add_children(Transplant, "procedures.transplant", session)
-        self.add_children(Treatment, "encounters.treatment", session)
-        self.add_children(ProgramMembership, "program_memberships.program_membership", session)
-        self.add_children(OptOut, "opt_outs.opt_out", session)
-        self.add_children(ClinicalRelationship, "clinical_relationships.clinical_relationship", session)
-
-        self.add_children(Document, "documents.document", session)
-        self.add_children(Encounter, "encounters.encounter", session)
-        self.add_children(TransplantList,"encounters.transplant_list", session)
-        self.add_children(Survey, "surveys.survey", session)
-        # fmt: on
-
-        self.deduplicate_keys(Observation)
-        self.deduplicate_keys(DialysisSession)
+        for child_node, xml_attr in self.sections_to_map():
+            mapped = len(self.mapped_classes)
+            self.add_children(child_node, xml_attr, session)
+
+            if self.skip_unchanged:
+                tag = section_tag(xml_attr)
+                records = count_nodes(self.mapped_classes[mapped:])
+                self.section_records[tag] = self.section_records.get(tag, 0) + records
+
+        for child_node in dict.fromkeys(node for node, _ in self.sections):
+            if child_node.deduplicate:
+                self.deduplicate_keys(child_node)
 
     def deduplicate_keys(self, node_type: Type[Node]):
         """
@@ -203,18 +293,13 @@ class PatientRecord(Node):
 
         TODO: figure out if this belongs better in the structure class
         """
-        # definition of the keys
-        ids = []
-        for child in self.mapped_classes:
-            if isinstance(child, node_type):
-                id = child.orm_object.id
-                while id in ids:
-                    id_components = id.split(KEY_SEPARATOR)
-                    id_components[-1] = str(int(id_components[-1]) + 1)
-                    id = KEY_SEPARATOR.join(id_components)
-
+        children = [
+            child for child in self.mapped_classes if isinstance(child, node_type)
+        ]
+        ids = key_gen.deduplicate_keys(child.orm_object.id for child in children)
+        for child, id in zip(children, ids):
+            if child.orm_object.id != id:
                 child.orm_object.id = id
-                ids.append(id)
 
     def map_to_database(
         self, pid: str, ukrdcid: str, session: Session, is_new=True
@@ -234,7 +319,15 @@ class PatientRecord(Node):
             self.status = RecordStatus.NEW
 
         # load or create the orm
-        file_hash = hash_xml(self.xml)
+        if self.skip_unchanged and self.section_hashes is None:
+            rendered_hash, self.section_hashes = hash_xml_tree_sections(
+                render_xml_tree(self.xml), RENDERED_HASH_PREFIX
+            )
+            if self.file_hash is None:
+                self.file_hash = rendered_hash
+        elif self.file_hash is None:
+            self.file_hash = hash_xml(self.xml)
+        file_hash = self.file_hash
 
         if is_new:
             self.orm_object = self.orm_model(
@@ -249,79 +342,134 @@ class PatientRecord(Node):
             if self.orm_object.channelid == file_hash:
                 return False
 
+            # hashes stored before the canonical hash was introduced are
+            # checked the old way, if the file is identical the stored hash is
+            # upgraded so next time the cheap comparison above succeeds
+            if is_legacy_hash(self.orm_object.channelid):
+                if self.orm_object.channelid == hash_xml_legacy(self.xml):
+                    self.orm_object.channelid = file_hash
+                    self.hash_upgraded = True
+                    return False
+
+            # the same goes for files written without the raw file, e.g. by
+            # calling insert_incoming_data directly, once it arrives raw
+            rendered = is_rendered_hash(self.orm_object.channelid)
+            if rendered and not is_rendered_hash(file_hash):
+                if self.orm_object.channelid == hash_xml(self.xml):
+                    self.orm_object.channelid = file_hash
+                    self.hash_upgraded = True
+                    return False
+
+            if self.skip_unchanged and self.orm_object.channelid is not None:
+                self.skipped_sections = load_unchanged_sections(
+                    session, self.pid, self.orm_object.channelid, self.section_hashes
+                )
+
             self.orm_object.channelid = file_hash
 
-        self.map_xml_to_orm(session)
+        # Generate the keys of every record in the file and load any that
+        # exist in bulk so the nodes don't each have to query for their own.
+        prefetch = KeyPrefetch()
+        self.collect_keys(prefetch)
+
+        # Queries made while mapping would otherwise flush the changes made so
+        # far, spreading the writes across the whole walk. Instead everything
+        # is flushed once when the changes are committed.
+        with session.no_autoflush:
+            if is_new:
+                prefetch.mark_missing()
+            else:
+                prefetch.load(session)
+
+            with prefetched(session, prefetch), recording_changes(self.changes):
+                self.map_xml_to_orm(session)
+
         self.updated_status()
 
+        if not self.keep_xml:
+            self.release_xml()
+
         return True
 
-    def add_deleted(self, sqla_mapped: str, mapped_ids: List[str]) -> None:
-        # we only delete within a time window for observations and lab orders
-        # don't like this solution very much. Think may sqla needs to become
-        # a function which returns the mapped_orms.
-        if sqla_mapped == "observations":
-            if self.observation_range is not None and not self.is_ex_missing:
-                mapped_orms = (
-                    self.session.query(sqla.Observation)
-                    .filter(
-                        and_(
-                            sqla.Observation.observation_time
-                            >= self.observation_range[0],
-                            sqla.Observation.observation_time
-                            <= self.observation_range[1],
-                        )
-                    )
-                    .all()
-                )
-            else:
-                mapped_orms = []
-
-        elif sqla_mapped == "lab_orders":
-            if self.lab_order_range is not None and not self.is_ex_missing:
-                mapped_orms = (
-                    self.session.query(sqla.LabOrder)
-                    .filter(
-                        and_(
-                            sqla.LabOrder.specimen_collected_time
-                            >= self.lab_order_range[0],
-                            sqla.LabOrder.specimen_collected_time
-                            <= self.lab_order_range[1],
-                        )
-                    )
-                    .all()
-                )
-            else:
-                mapped_orms = []
-
-        elif sqla_mapped == "dialysis_sessions":
-            if self.dialysis_session_range is not None and not self.is_ex_missing:
-                mapped_orms = (
-                    self.session.query(sqla.DialysisSession)
-                    .filter(
-                        and_(
-                            sqla.DialysisSession.proceduretime
-                            >= self.dialysis_session_range[0],
-                            sqla.DialysisSession.proceduretime
-                            <= self.dialysis_session_range[1],
-                        )
-                    )
-                    .all()
-                )
+    def sections_to_map(self) -> Iterator[Tuple[Type[Node], str]]:
+        for child_node, xml_attr in self.sections:
+            if section_tag(xml_attr) not in self.skipped_sections:
+                yield child_node, xml_attr
+
+    def section_digest_rows(self) -> List[dict]:
+        """Digests of the sections of the file to store once it is written.
+        Skipped sections keep the digest and record count they had, now
+        against the hash of this file.
+        """
+        rows = []
+        for tag in dict.fromkeys(section_tag(xml_attr) for _, xml_attr in self.sections):
+            if tag in self.skipped_sections:
+                records = self.skipped_sections[tag]
+            elif self.is_ex_missing:
+                continue
             else:
-                mapped_orms = []
-        else:
-            # In most cases we can just use the lazy mapping from the sqla models
-            mapped_orms = getattr(self.orm_object, sqla_mapped)
-
-        # stage records for deletion
-        for record in mapped_orms:
-            if record.id not in mapped_ids:
-                self.deleted_orm.append(record)
-                # we need to nuke result items too
-                if sqla_mapped == "lab_orders":
-                    for result_item in record.result_items:
-                        self.deleted_orm.append(result_item)
+                records = self.section_records.get(tag, 0)
+
+            rows.append(
+                {
+                    "pid": self.pid,
+                    "section": tag,
+                    "digest": self.section_hashes.get(tag, EMPTY_DIGEST),
+                    "records": records,
+                    "filehash": self.file_hash,
+                }
+            )
+
+        return rows
+
+    def collect(
+        self, statuses: Sequence[RecordStatus] = (RecordStatus.NEW,)
+    ) -> NodeCollection:
+        collection = super().collect(statuses)
+
+        # records in skipped sections are unchanged without being mapped
+        collection.counts[RecordStatus.UNCHANGED] += sum(self.skipped_sections.values())
+        return collection
+
+    def add_deleted(self, sqla_mapped: str, mapped_nodes: List[Node]) -> None:
+        # we only delete within a time window for observations, lab orders
+        # and dialysis sessions. Outside the window (or in ex-missing mode)
+        # records are left alone.
+        windowed = {
+            "observations": (
+                sqla.Observation.observation_time,
+                self.observation_range,
+            ),
+            "lab_orders": (
+                sqla.LabOrder.specimen_collected_time,
+                self.lab_order_range,
+            ),
+            "dialysis_sessions": (
+                sqla.DialysisSession.proceduretime,
+                self.dialysis_session_range,
+            ),
+        }
+
+        if sqla_mapped not in windowed:
+            super().add_deleted(sqla_mapped, mapped_nodes)
+            return
+
+        column, time_range = windowed[sqla_mapped]
+        if time_range is None or self.is_ex_missing:
+            return
+
+        if self.status == RecordStatus.NEW:
+            return
+
+        # removing a lab order also removes its result items
+        self.deletions.append(
+            Deletion.from_relationship(
+                self.orm_object,
+                sqla_mapped,
+                mapped_nodes,
+                window=(column, time_range[0], time_range[1]),
+            )
+        )
 
     def generate_parent_data(self, seq_no: int):
         parent_data = super().generate_parent_data(seq_no=seq_no)
@@ -0,0 +1,94 @@
+"""
+Bulk loading of existing records ahead of mapping a patient record. Every
+node in the tree looks up its record by primary key, for a large file that
+is thousands of single row round trips. Instead we generate all the keys
+from the xml up front (see Node.collect_keys) and load each table with a
+single query. Nodes then find their record in memory.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Set, Tuple
+
+from sqlalchemy import String, any_, bindparam, inspect, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import Session
+
+# key used to attach the prefetch to the session while the tree is mapped
+PREFETCH_INFO_KEY = "cupid_prefetch"
+
+
+class KeyPrefetch:
+    """Primary keys, grouped by orm model, of the records in an incoming
+    file together with any rows already in the database for those keys.
+    """
+
+    def __init__(self) -> None:
+        self.keys: Dict[Any, Set[str]] = defaultdict(set)
+        self.rows: Dict[Any, Dict[str, Any]] = {}
+
+    def add(self, orm_model: Any, id: str) -> None:
+        self.keys[orm_model].add(id)
+
+    def load(self, session: Session) -> None:
+        """Load the existing rows with one query per table. Loading them
+        also places them in the session identity map.
+        """
+        for orm_model, ids in self.keys.items():
+            primary_key = inspect(orm_model).primary_key[0]
+            query = select(orm_model).where(
+                primary_key == any_(bindparam("ids", list(ids), type_=ARRAY(String)))
+            )
+            self.rows[orm_model] = {
+                getattr(row, primary_key.key): row
+                for row in session.execute(query).scalars()
+            }
+
+    def mark_missing(self) -> None:
+        """For a brand new patient nothing can exist yet so there is no need
+        to query the database at all.
+        """
+        for orm_model in self.keys:
+            self.rows[orm_model] = {}
+
+    def lookup(self, orm_model: Any, id: str) -> Tuple[bool, Any]:
+        """Look up a record by key.
+
+        Returns:
+            Tuple[bool, Any]: whether the key was prefetched and the record
+            (None if it doesn't exist in the database)
+        """
+        rows = self.rows.get(orm_model)
+        if rows is None or id not in self.keys[orm_model]:
+            return False, None
+
+        return True, rows.get(id)
+
+    @property
+    def key_count(self) -> int:
+        return sum(len(ids) for ids in self.keys.values())
+
+
+def get_orm(session: Session, orm_model: Any, id: str) -> Any:
+    """Drop in replacement for session.get which uses the prefetched records
+    attached to the session where possible.
+    """
+    prefetch = session.info.get(PREFETCH_INFO_KEY)
+    if prefetch is not None:
+        found, orm_object = prefetch.lookup(orm_model, id)
+        if found:
+            return orm_object
+
+    return session.get(orm_model, id)
+
+
+@contextmanager
+def prefetched(session: Session, prefetch: KeyPrefetch) -> Iterator[KeyPrefetch]:
+    """Attach prefetched records to the session for the duration of the
+    block.
+    """
+    session.info[PREFETCH_INFO_KEY] = prefetch
+    try:
+        yield prefetch
+    finally:
+        session.info.pop(PREFETCH_INFO_KEY, None)
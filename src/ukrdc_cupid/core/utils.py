@@ -1,9 +1,13 @@
 import os
+import threading
+import time
+from typing import Dict, Optional
 from dotenv import dotenv_values
 from urllib.parse import urlparse
 
 from sqlalchemy.pool import QueuePool
 from sqlalchemy import Engine, create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker, Session, declarative_base
 from sqlalchemy_utils import (
     database_exists,
@@ -13,6 +17,7 @@ from ukrdc_sqla.ukrdc import Base as UKRDC3Base
 
 from ukrdc_cupid.core.investigate.models import Base as InvestiBase
 from ukrdc_cupid.core.investigate.utils import update_picklists
+from ukrdc_cupid.core.store.digests import metadata as digests_metadata
 from ukrdc_cupid.core.store.models.lookup_tables import GPInfoType
 
 # Load environment varibles from wither they are found
@@ -51,6 +56,110 @@ ID_SEQUENCES = {
         """,
 }
 
+# Indexes cupid relies on which aren't part of the ukrdc_sqla models
+CUPID_INDEXES = {
+    # looks up files identical to the last one stored before matching
+    "ix_patientrecord_channelid": """
+        CREATE INDEX IF NOT EXISTS ix_patientrecord_channelid
+            ON patientrecord (channelid, sendingfacility, sendingextract);
+        """,
+    # matches the MRN and NIs of a file to patient numbers, see match_feed
+    "ix_patientnumber_patientid_organization_numbertype": """
+        CREATE INDEX IF NOT EXISTS ix_patientnumber_patientid_organization_numbertype
+            ON patientnumber (patientid, organization, numbertype);
+        """,
+    # the investigations models declare these but databases which predate
+    # them may not have them
+    "ix_investigations_patientid_pid": """
+        CREATE INDEX IF NOT EXISTS ix_investigations_patientid_pid
+            ON investigations.patientid (pid);
+        """,
+    "ix_investigations_patientid_ukrdcid": """
+        CREATE INDEX IF NOT EXISTS ix_investigations_patientid_ukrdcid
+            ON investigations.patientid (ukrdcid);
+        """,
+    # issues of a patient and patients of an issue
+    "ix_investigations_patientidtoissue_patient_id": """
+        CREATE INDEX IF NOT EXISTS ix_investigations_patientidtoissue_patient_id
+            ON investigations.patientidtoissue (patient_id);
+        """,
+    "ix_investigations_patientidtoissue_issue_id": """
+        CREATE INDEX IF NOT EXISTS ix_investigations_patientidtoissue_issue_id
+            ON investigations.patientidtoissue (issue_id);
+        """,
+    # records of a patient within the start/stop window of an incoming file
+    "ix_observation_pid_observationtime": """
+        CREATE INDEX IF NOT EXISTS ix_observation_pid_observationtime
+            ON observation (pid, observationtime);
+        """,
+    "ix_laborder_pid_specimencollectedtime": """
+        CREATE INDEX IF NOT EXISTS ix_laborder_pid_specimencollectedtime
+            ON laborder (pid, specimencollectedtime);
+        """,
+    "ix_dialysissession_pid_proceduretime": """
+        CREATE INDEX IF NOT EXISTS ix_dialysissession_pid_proceduretime
+            ON dialysissession (pid, proceduretime);
+        """,
+    # result items are removed by the order they belong to
+    "ix_resultitem_orderid": """
+        CREATE INDEX IF NOT EXISTS ix_resultitem_orderid
+            ON resultitem (orderid);
+        """,
+}
+
+
+class MonitoredQueuePool(QueuePool):
+    """QueuePool which keeps a running tally of how often callers have had to
+    wait for a connection. A checkout waits when every pooled connection is in
+    use and the overflow allowance is exhausted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # checkouts happen on several executor threads at once
+        self._counter_lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        must_wait = (
+            self._max_overflow > -1
+            and self.checkedin() == 0
+            and self.overflow() >= self._max_overflow
+        )
+        with self._counter_lock:
+            self.checkouts += 1
+            if must_wait:
+                self.waits += 1
+        if not must_wait:
+            return super()._do_get()
+
+        t0 = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - t0
+            with self._counter_lock:
+                self.wait_time += waited
+                if timed_out:
+                    self.timeouts += 1
+
+    def counters(self) -> dict:
+        """Consistent snapshot of the wait counters."""
+        with self._counter_lock:
+            return {
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": round(self.wait_time, 3),
+                "timeouts": self.timeouts,
+            }
+
 
 class DatabaseConnection:
     def __init__(self, env_prefix: str = "UKRDC", url=None):
@@ -116,10 +225,40 @@ class DatabaseConnection:
 
         return db_sessionmaker
 
+    def pool_statistics(self) -> dict:
+        """Snapshot of the connection pool backing the engine. Counters which
+        the pool class doesn't track are left out.
+
+        Returns:
+            dict: pool size, connections checked in/out, overflow and waits
+        """
+        if self.engine is None:
+            return {}
+
+        pool = self.engine.pool
+        stats = {"status": pool.status()}
+        if isinstance(pool, QueuePool):
+            stats.update(
+                {
+                    "size": pool.size(),
+                    "checked_in": pool.checkedin(),
+                    "checked_out": pool.checkedout(),
+                    "overflow": pool.overflow(),
+                }
+            )
+        if isinstance(pool, MonitoredQueuePool):
+            stats.update(pool.counters())
+
+        return stats
+
+    def dispose(self) -> None:
+        if self.engine is not None:
+            self.engine.dispose()
+
 
 class UKRDCConnection(DatabaseConnection):
     def __init__(self, url=None):
-        self.pool_size = ENV.get("UKRDC_POOL_SIZE", 10)
+        self.pool_size = int(ENV.get("UKRDC_POOL_SIZE", 10))
         super().__init__("UKRDC", url)
 
     def get_engine(self) -> Engine:
@@ -128,7 +267,7 @@ class UKRDCConnection(DatabaseConnection):
         # want to be sure.
         return create_engine(
             url=self.url,
-            poolclass=QueuePool,
+            poolclass=MonitoredQueuePool,
             pool_size=self.pool_size,
             max_overflow=10,
             pool_timeout=30,
@@ -169,6 +308,75 @@ def create_id_generation_sequences(session: Session):
             print(f"Sequence '{key}' already exists.")
 
 
+def create_cupid_indexes(session: Session):
+    # create any indexes cupid needs which don't exist yet
+    print("Fetching existing database indexes...")
+    db_indexes = session.execute(text("SELECT indexname FROM pg_indexes;"))
+    indexes = [index[0] for index in db_indexes]
+
+    for key, sql in CUPID_INDEXES.items():
+        if key not in indexes:
+            print(f"Creating index '{key}'...")
+            session.execute(text(sql))
+            print(f"Index '{key}' created successfully.")
+        else:
+            print(f"Index '{key}' already exists.")
+
+
+# tables scanned sequentially in the plans of hot queries are allowed to read
+# this many rows, small lookup tables are often quicker to scan
+SEQ_SCAN_ROW_THRESHOLD = 1000
+
+
+def sequential_scans(
+    session: Session,
+    statement: str,
+    parameters: Optional[dict] = None,
+    max_rows: int = SEQ_SCAN_ROW_THRESHOLD,
+) -> Dict[str, int]:
+    """Run a query with EXPLAIN ANALYZE and find the tables it reads with a
+    sequential scan of more than max_rows rows. This is used to check the
+    queries made while matching and storing a file are covered by indexes
+    (see CUPID_INDEXES). The query is executed so it should be a select.
+
+    Args:
+        session (Session): database session
+        statement (str): sql as passed to the driver
+        parameters (Optional[dict], optional): driver parameters
+        max_rows (int, optional): rows a sequential scan may read
+
+    Returns:
+        Dict[str, int]: rows read by each offending scan by table
+    """
+    plan = (
+        session.connection()
+        .exec_driver_sql(f"EXPLAIN (ANALYZE, FORMAT JSON) {statement}", parameters)
+        .scalar()
+    )
+
+    scans: Dict[str, int] = {}
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get("Plans", []))
+        if node["Node Type"] != "Seq Scan":
+            continue
+        rows = node["Actual Loops"] * (
+            node["Actual Rows"] + node.get("Rows Removed by Filter", 0)
+        )
+        if rows > max_rows:
+            table = node["Relation Name"]
+            scans[table] = max(rows, scans.get(table, 0))
+
+    return scans
+
+
+def create_cupid_tables(session: Session):
+    # create the tables cupid keeps alongside the ukrdc if they don't exist
+    print("Creating cupid tables...")
+    digests_metadata.create_all(bind=session.connection())
+
+
 def populate_ukrdc_tables(session: Session, gp_info: bool = False):
     """Function populates various tables to allow foreign key relationships
 
@@ -252,6 +460,8 @@ def generate_database(url: str, gp_info=False):
     # Add generation sequences for pid and ukrdcid
     with ukrdc_sessionmaker() as session:
         create_id_generation_sequences(session)
+        create_cupid_indexes(session)
+        create_cupid_tables(session)
         populate_ukrdc_tables(session, gp_info=gp_info)
         session.commit()
 
@@ -7,7 +7,7 @@ from ukrdc_cupid.core.utils import (
     UKRDCConnection
 )
 from ukrdc_cupid.api import app
-from ukrdc_cupid.api.main import get_session
+from ukrdc_cupid.api.main import get_session, get_sessionmaker
 
 from sqlalchemy_utils import (
     database_exists,
@@ -15,7 +15,7 @@ from sqlalchemy_utils import (
 )  # type:ignore
 
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, sessionmaker
 
 
 def ukrdc_sessionmaker(url: str, gp_info: bool = False):
@@ -81,5 +81,8 @@ def ukrdc_test_session_with_gp_info():
 def client(ukrdc_test_session:Session):
     # Create a client to use for testing api
     app.dependency_overrides[get_session] = lambda: ukrdc_test_session
+    # uploads run on the store executor in a session of their own
+    test_sessionmaker = sessionmaker(bind=ukrdc_test_session.get_bind())
+    app.dependency_overrides[get_sessionmaker] = lambda: test_sessionmaker
     return TestClient(app)
     
\ No newline at end of file
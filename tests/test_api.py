@@ -2,6 +2,10 @@ from ukrdc_cupid.core.investigate.create_investigation import Investigation
 from ukrdc_sqla.ukrdc import PatientRecord, Patient, PatientNumber
 from sqlalchemy import select
 import datetime as  dt
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from ukrdc_cupid.core.utils import MonitoredQueuePool
 
 SCHEMA_VERSION = "4.2.0"
 
@@ -221,7 +225,77 @@ def test_empty_lab(client):
 
     assert response.status_code == 200
 
+def test_resent_file(client):
+    # resending an identical file (apart from the sending time) should be
+    # picked up by the hash before any matching happens
+    xml = xml_template(SCHEMA_VERSION, "", mrn="77777", nhs="9434765870")
+    response = client.post(
+        "/store/upload_patient_file/full", content=xml, headers={"Content-Type": "application/xml"}
+    )
+    assert response.status_code == 200
+
+    resent = xml.replace("2023-08-16T08:32:40.306453", "2023-08-17T08:32:40.306453")
+    response = client.post(
+        "/store/upload_patient_file/full", content=resent, headers={"Content-Type": "application/xml"}
+    )
+    assert response.status_code == 200
+    assert "matched hash for last inserted file" in response.text
+
+def test_diff(client):
+    # a diff reports what would be written without writing it
+    xml = xml_template(SCHEMA_VERSION, "", mrn="88888", nhs="9434765919")
+    response = client.post(
+        "/store/upload_patient_file/diff", content=xml, headers={"Content-Type": "application/xml"}
+    )
+    assert response.status_code == 200
+    diff = response.json()
+    assert diff["is_new"]
+    assert diff["tables"]["patientnumber"]["new"] == 2
+
+    response = client.post(
+        "/store/upload_patient_file/full", content=xml, headers={"Content-Type": "application/xml"}
+    )
+    assert "matched hash for last inserted file" not in response.text
+
+    renamed = xml.replace("<Given>John</Given>", "<Given>Jon</Given>")
+    response = client.post(
+        "/store/upload_patient_file/diff?show_changes=true",
+        content=renamed,
+        headers={"Content-Type": "application/xml"},
+    )
+    diff = response.json()
+    assert not diff["is_new"]
+    name = diff["tables"]["name"]
+    assert name["modified"] == 1
+    assert list(name["modified_keys"].values()) == [["given"]]
+    assert diff["tables"]["patientnumber"]["unchanged"] == 2
+
+
 def test_no_start_stop():
     """This should check that the default 
     """
-    assert True
\ No newline at end of file
+    assert True
+
+
+def test_pool_counters_threaded():
+    # every checkout from every thread should be counted, including the
+    # ones which had to wait for a free connection
+    pool = MonitoredQueuePool(
+        lambda: sqlite3.connect(":memory:", check_same_thread=False),
+        pool_size=2,
+        max_overflow=0,
+        timeout=30,
+    )
+
+    def checkout(_):
+        for _ in range(50):
+            conn = pool.connect()
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(checkout, range(8)))
+
+    counters = pool.counters()
+    assert counters["checkouts"] == 400
+    assert counters["timeouts"] == 0
+    assert counters["waits"] <= counters["checkouts"]
@@ -6,6 +6,7 @@ this is the core functionality of CUPID.
 
 from ukrdc_cupid.core.store.models.ukrdc import PatientRecord
 from ukrdc_cupid.core.parse.utils import load_xml_from_path
+from ukrdc_cupid.core.store.delete import DeletionStage
 import ukrdc_sqla.ukrdc as sqla
 from sqlalchemy.orm import Session
 from datetime import timedelta
@@ -204,11 +205,18 @@ def patient_record(ukrdc_test_with_data: Session):
         os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
     )
     patient_record = PatientRecord(xml_test_2)
-    patient_record.map_to_database(TEST_PID, TEST_UKRDCID, ukrdc_test_with_data)
+    patient_record.map_to_database(
+        TEST_PID, TEST_UKRDCID, ukrdc_test_with_data, is_new=False
+    )
 
     return patient_record
 
 
+def staged_for_deletion(patient_record: PatientRecord) -> dict:
+    deletion_stage = DeletionStage(patient_record.get_deletions())
+    return deletion_stage.preview(patient_record.session)
+
+
 def test_lab_orders(patient_record: PatientRecord):
 
     lab_order_orm = False
@@ -292,24 +300,58 @@ def test_laborder_start_stop(patient_record: PatientRecord):
     # should be removed if they are not in incoming any associated result items
     # should staged for deletion
 
-    ids_to_delete = ["to_delete_1", "RI_to_delete_1"]
-    deleted_ids = [orm.id for orm in patient_record.deleted_orm if isinstance(orm, sqla.ResultItem) or isinstance(orm, sqla.LabOrder)]
+    deleted_ids = staged_for_deletion(patient_record)
 
     # check the records we expect to delete are staged for deletion
-    assert ids_to_delete == deleted_ids
+    assert deleted_ids[sqla.LabOrder] == ["to_delete_1"]
+    assert deleted_ids[sqla.ResultItem] == ["RI_to_delete_1"]
 
 def test_observation_start_stop(patient_record:PatientRecord):
     ids_to_delete = ["to_delete_1"]
-    deleted_ids = [orm.id for orm in patient_record.deleted_orm if isinstance(orm, sqla.Observation)]
+    deleted_ids = staged_for_deletion(patient_record)[sqla.Observation]
     
     assert ids_to_delete == deleted_ids
 
 def test_dialysis_sessions_start_stop(patient_record:PatientRecord):
     ids_to_delete = ["to_delete_1"]
-    deleted_ids = [orm.id for orm in patient_record.deleted_orm if isinstance(orm, sqla.DialysisSession)]
+    deleted_ids = staged_for_deletion(patient_record)[sqla.DialysisSession]
     
     assert ids_to_delete == deleted_ids
 
+def test_start_stop_scoped_to_patient(ukrdc_test_with_data: Session):
+    # records of other patients within the window must not be touched
+    xml_test_2 = load_xml_from_path(
+        os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
+    )
+    obs_start = xml_test_2.observations.start.to_datetime()
+
+    other_pid = "other_pid"
+    ukrdc_test_with_data.add(
+        sqla.PatientRecord(
+            pid=other_pid,
+            sendingfacility="TEST",
+            sendingextract="UKRDC",
+            localpatientid="other",
+            repositorycreationdate=obs_start,
+            repositoryupdatedate=obs_start,
+        )
+    )
+    ukrdc_test_with_data.add(
+        sqla.Observation(
+            pid=other_pid,
+            id="other_obs",
+            observation_time=obs_start + timedelta(weeks=1),
+        )
+    )
+    ukrdc_test_with_data.commit()
+
+    patient_record = PatientRecord(xml_test_2)
+    patient_record.map_to_database(
+        TEST_PID, TEST_UKRDCID, ukrdc_test_with_data, is_new=False
+    )
+
+    assert staged_for_deletion(patient_record)[sqla.Observation] == ["to_delete_1"]
+
 def test_result_items(patient_record: PatientRecord):
     # check all the result item attributes are being loaded into the orm
     result_orms = []
@@ -1,11 +1,23 @@
+import copy
+
 from sqlalchemy.orm import Session
+import ukrdc_cupid.core.match.identify as identify
+from ukrdc_cupid.core.investigate.create_investigation import Investigation
 from ukrdc_cupid.core.parse.utils import load_xml_from_path
 from ukrdc_cupid.core.store.models.ukrdc import PatientRecord
+from ukrdc_cupid.core.store.insert import insert_incoming_data
 from ukrdc_cupid.core.match.identify import (
+    identify_across_ukrdc,
     identify_patient_feed,
+    match_feed,
+    match_many,
+    match_mrn,
+    match_ni,
     read_patient_metadata,
 )
 
+from ukrdc_cupid.core.match.cache import match_cache
+from ukrdc_cupid.core.modify.edit_feed import ukrdcid_split_merge
 from ukrdc_cupid.core.utils import DatabaseConnection
 from sqlalchemy import select
 from ukrdc_sqla.ukrdc import PatientNumber
@@ -25,6 +37,14 @@ def ukrdc_test(ukrdc_test_session: Session):
     return ukrdc_test_session
 
 
+@pytest.fixture(scope="function")
+def warm_cache():
+    # the listener isn't needed when everything happens in this process
+    match_cache.enable()
+    yield match_cache
+    match_cache.disable()
+
+
 def commit_patient_record(ukrdc_session: Session, pid, ukrdcid, xml):
     patient_record = PatientRecord(xml)
     patient_record.map_to_database(pid, ukrdcid, ukrdc_session)
@@ -45,6 +65,108 @@ def test_match_ni(ukrdc_test: Session):
     assert not investigation
 
 
+def test_match_feed(ukrdc_test: Session):
+    """The combined matching query should find the same patients as the
+    separate MRN and NI queries along with the stored birth time.
+    """
+    feed_match = match_feed(ukrdc_test, PATIENT_META_DATA)
+
+    mrn = match_mrn(ukrdc_test, PATIENT_META_DATA)
+    ni = match_ni(ukrdc_test, PATIENT_META_DATA)
+    assert feed_match.mrn == [tuple(row) for row in mrn]
+    assert feed_match.ni == [tuple(row) for row in ni]
+    assert feed_match.mrn == [(TEST_PID, TEST_UKRDCID)]
+    assert len(feed_match.birth_times[TEST_PID]) == 1
+    assert not feed_match.blocked
+
+
+def test_blocking_investigation(ukrdc_test: Session, monkeypatch):
+    """Open blocking investigations only block the patient when switched
+    on with CUPID_BLOCK_ON_INVESTIGATIONS.
+    """
+    investigation = Investigation(ukrdc_test, [(TEST_PID, TEST_UKRDCID)], 4)
+    assert not match_feed(ukrdc_test, PATIENT_META_DATA).blocked
+
+    monkeypatch.setattr(identify, "BLOCK_ON_INVESTIGATIONS", True)
+    assert match_feed(ukrdc_test, PATIENT_META_DATA).blocked == {TEST_PID}
+
+    # resolved issues don't
+    investigation.issue.is_resolved = True
+    ukrdc_test.commit()
+    assert not match_feed(ukrdc_test, PATIENT_META_DATA).blocked
+
+
+def test_match_many(ukrdc_test: Session):
+    """Matching a backlog of files together should reach the same decisions
+    as matching them one at a time.
+    """
+    new_patient = dict(PATIENT_META_DATA, MRN=["NOT_AN_MRN", "NOT_A_UNIT"], NI=[])
+    patient_infos = [PATIENT_META_DATA, new_patient, PATIENT_META_DATA]
+
+    results = match_many(ukrdc_test, patient_infos, batch_size=2)
+
+    assert results == [
+        (TEST_PID, TEST_UKRDCID, None),
+        (None, None, None),
+        (TEST_PID, TEST_UKRDCID, None),
+    ]
+    assert results == [
+        identify_patient_feed(ukrdc_test, patient_info)
+        for patient_info in patient_infos
+    ]
+
+
+def test_match_warm_cache(ukrdc_test: Session, warm_cache):
+    """Files matched from the cache should get the same answers as those
+    matched from the database, including after the match has changed.
+    """
+    first = identify_patient_feed(ukrdc_test, PATIENT_META_DATA)
+    second = identify_patient_feed(ukrdc_test, PATIENT_META_DATA)
+
+    assert first == second == (TEST_PID, TEST_UKRDCID, None)
+    assert warm_cache.hits == 1
+
+    ukrdcid_split_merge(ukrdc_test, TEST_PID, "123456789")
+    pid, ukrdcid, investigation = identify_patient_feed(ukrdc_test, PATIENT_META_DATA)
+
+    assert (pid, ukrdcid) == (TEST_PID, "123456789")
+    assert not investigation
+
+    # a file which didn't match anything until its patient was written
+    new_xml = copy.deepcopy(XML_TEST)
+    for number in new_xml.patient.patient_numbers.patient_number:
+        number.number = "NEW" + number.number
+    mrn, mrn_organization = PATIENT_META_DATA["MRN"]
+    new_info = dict(
+        PATIENT_META_DATA,
+        MRN=[f"NEW{mrn}", mrn_organization],
+        NI=[[f"NEW{ni}", org] for ni, org in PATIENT_META_DATA["NI"]],
+    )
+    assert identify_patient_feed(ukrdc_test, new_info) == (None, None, None)
+
+    insert_incoming_data(ukrdc_test, "271828", "new_ukrdcid", new_xml, is_new=True)
+
+    pid, ukrdcid, investigation = identify_patient_feed(ukrdc_test, new_info)
+    assert (pid, ukrdcid, investigation) == ("271828", "new_ukrdcid", None)
+
+
+def test_identify_across_ukrdc(ukrdc_test: Session):
+    """New feeds are linked to the ukrdcid of the records holding the same
+    national identifiers once the birth time has been checked against them.
+    MRNs issued by a national organisation are used in the same way.
+    """
+    ukrdcid, investigation = identify_across_ukrdc(ukrdc_test, PATIENT_META_DATA)
+
+    assert ukrdcid == TEST_UKRDCID
+    assert not investigation
+
+    mrn_info = dict(PATIENT_META_DATA, MRN=PATIENT_META_DATA["NI"][0], NI=[])
+    ukrdcid, investigation = identify_across_ukrdc(ukrdc_test, mrn_info)
+
+    assert ukrdcid == TEST_UKRDCID
+    assert not investigation
+
+
 def _test_overwrite_with_chi_no(ukrdc_test: Session):
     """Test the linking of record to existing scottish record if a chi number
     is added into the file. This also tests the process of overwriting a NI.
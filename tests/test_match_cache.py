@@ -0,0 +1,168 @@
+import json
+import time
+
+from sqlalchemy.orm import Session
+
+from ukrdc_cupid.core.match.cache import (
+    CLEAR_ALL,
+    MatchCache,
+    MatchCacheListener,
+    apply_notification,
+    match_key,
+    notify_match_change,
+)
+from ukrdc_cupid.core.match.identify import FeedMatch
+
+
+def patient_info(mrn: str, nis: list) -> dict:
+    return {
+        "sending_facility": "RFAC",
+        "sending_extract": "UKRDC",
+        "MRN": [mrn, "RFAC"],
+        "NI": [[ni, "NHS"] for ni in nis],
+    }
+
+
+def feed_match(pid: str) -> FeedMatch:
+    return FeedMatch([(pid, f"U{pid}")], [(pid, f"U{pid}")], {pid: [None]}, set())
+
+
+def enabled_cache(maxsize: int = 10) -> MatchCache:
+    cache = MatchCache(maxsize)
+    cache.enable()
+    return cache
+
+
+def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_match_key():
+    # the order the NIs come in doesn't matter
+    assert match_key(patient_info("1", ["a", "b"])) == match_key(
+        patient_info("1", ["b", "a"])
+    )
+    assert match_key(patient_info("1", ["a"])) != match_key(patient_info("2", ["a"]))
+
+
+def test_hits_and_misses():
+    cache = enabled_cache()
+    key = match_key(patient_info("1", ["a"]))
+
+    assert cache.get(key) is None
+    cache.put(key, feed_match("1"), cache.generation)
+    cached = cache.get(key)
+
+    assert cached == feed_match("1")
+    # callers can't change what is cached
+    cached.mrn.append(("2", "U2"))
+    assert cache.get(key) == feed_match("1")
+    assert cache.statistics()["hits"] == 2
+    assert cache.statistics()["misses"] == 1
+
+
+def test_disabled_cache_is_bypassed():
+    cache = MatchCache()
+    key = match_key(patient_info("1", ["a"]))
+    cache.put(key, feed_match("1"), cache.generation)
+
+    assert cache.get(key) is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_evicted():
+    cache = enabled_cache(maxsize=2)
+    keys = [match_key(patient_info(str(n), [])) for n in range(3)]
+    cache.put(keys[0], feed_match("0"), cache.generation)
+    cache.put(keys[1], feed_match("1"), cache.generation)
+    cache.get(keys[0])
+    cache.put(keys[2], feed_match("2"), cache.generation)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is not None
+
+
+def test_invalidate():
+    cache = enabled_cache()
+    first = match_key(patient_info("1", ["a"]))
+    second = match_key(patient_info("2", ["b"]))
+    cache.put(first, feed_match("1"), cache.generation)
+    cache.put(second, feed_match("2"), cache.generation)
+
+    # by pid
+    cache.invalidate(pids=["1"])
+    assert cache.get(first) is None
+    assert cache.get(second) is not None
+
+    # by a number the file holds, e.g. a new patient with the same NI
+    cache.invalidate(numbers=[("NI", "b", "NHS")])
+    assert cache.get(second) is None
+
+
+def test_no_match_invalidated_by_number():
+    # files which matched nobody are dropped when a patient with one of their
+    # numbers appears
+    cache = enabled_cache()
+    key = match_key(patient_info("1", ["a"]))
+    cache.put(key, FeedMatch([], [], {}, set()), cache.generation)
+
+    payload = {"pids": ["9"], "numbers": [["MRN", "1", "RFAC"]]}
+    apply_notification(cache, json.dumps(payload))
+
+    assert cache.get(key) is None
+
+
+def test_stale_match_not_stored():
+    # a match looked up before an invalidation must not be cached after it
+    cache = enabled_cache()
+    key = match_key(patient_info("1", ["a"]))
+    generation = cache.generation
+    cache.invalidate(pids=["1"])
+    cache.put(key, feed_match("1"), generation)
+
+    assert cache.get(key) is None
+
+
+def test_clear_all_notification():
+    cache = enabled_cache()
+    key = match_key(patient_info("1", ["a"]))
+    cache.put(key, feed_match("1"), cache.generation)
+
+    apply_notification(cache, CLEAR_ALL)
+
+    assert len(cache) == 0
+
+
+def test_listener(ukrdc_test_session: Session):
+    # a change committed in one process reaches the caches of the others
+    # through the listener, this cache stands in for another process
+    url = ukrdc_test_session.get_bind().url.render_as_string(hide_password=False)
+    cache = MatchCache()
+    listener = MatchCacheListener(url, cache=cache)
+    listener.start()
+    try:
+        assert wait_for(lambda: cache.enabled)
+        first = match_key(patient_info("1", ["a"]))
+        second = match_key(patient_info("2", ["b"]))
+        cache.put(first, feed_match("1"), cache.generation)
+        cache.put(second, feed_match("2"), cache.generation)
+
+        # nothing is sent until the change is committed
+        notify_match_change(ukrdc_test_session, pids=["1"])
+        time.sleep(0.5)
+        assert cache.get(first) is not None
+
+        ukrdc_test_session.commit()
+        assert wait_for(lambda: len(cache) == 1)
+        assert cache.get(first) is None
+        assert cache.get(second) is not None
+    finally:
+        listener.stop()
+
+    assert not cache.enabled
@@ -1,5 +1,14 @@
 import glob
-from ukrdc_cupid.core.parse.xml_validate import validate_rda_xml_string
+from xsdata.formats.dataclass.parsers import XmlParser
+from ukrdc_xsdata.ukrdc import PatientRecord  # type:ignore
+from ukrdc_cupid.core.parse.utils import (
+    XmlPipeline,
+    hash_xml,
+    is_legacy_hash,
+    is_rendered_hash,
+    load_xml_from_str,
+)
+from ukrdc_cupid.core.parse.xml_validate import validate_rda_xml_string, load_schema
 from ukrdc_cupid.core.parse.xml_validate import SUPPORTED_VERSIONS
 
 
@@ -93,4 +102,90 @@ def test_check_tests():
                 print(f"{line} - {error}")
                 clean = False
 
-    assert clean
\ No newline at end of file
+    assert clean
+
+def test_single_parse_pipeline():
+    # decoding from the parsed tree should give exactly the same model as
+    # decoding the raw string
+    xml_string = """<ukrdc:PatientRecord xmlns:ukrdc="http://www.rixg.org.uk/">
+    <SendingFacility channelName="UKRDCSampleExtract" schemaVersion="4.2.0" time="2022-07-21T09:00:00">ABC123</SendingFacility>
+    <SendingExtract>UKRDC</SendingExtract>
+        <Patient>
+            <!-- comments should not end up in the model -->
+            <PatientNumbers>
+                <PatientNumber>
+                    <Number>AAA111B</Number>
+                    <Organization>LOCALHOSP</Organization>
+                    <NumberType>MRN</NumberType>
+                </PatientNumber>
+            </PatientNumbers>
+            <BirthTime>2006-05-04T18:13:51.0</BirthTime>
+            <Gender>1</Gender>
+        </Patient>
+    </ukrdc:PatientRecord>"""
+
+    pipeline = XmlPipeline(xml_string)
+    pipeline.check_current_schema()
+    xml_object = pipeline.decode()
+
+    assert xml_object == XmlParser().from_string(xml_string, PatientRecord)
+    assert xml_object == load_xml_from_str(xml_string)
+    assert pipeline.metadata["sending_facility"] == "ABC123"
+    assert pipeline.metadata["schema_version"] == "4.2.0"
+    assert pipeline.tree is None
+
+
+def test_schema_cache():
+    # schemas should only be compiled once per process
+    most_recent_version = max(SUPPORTED_VERSIONS)
+    xml_schema, xsd_file_path = load_schema(most_recent_version)
+    cached_schema, cached_path = load_schema(most_recent_version)
+
+    assert cached_schema is xml_schema
+    assert cached_path == xsd_file_path
+
+
+def test_file_hash():
+    xml_template = """<ukrdc:PatientRecord xmlns:ukrdc="http://www.rixg.org.uk/">
+    <SendingFacility channelName="UKRDCSampleExtract" schemaVersion="4.2.0" time="{time}" batchNo="{batch_no}">ABC123</SendingFacility>
+    <SendingExtract>UKRDC</SendingExtract>
+        <Patient>
+            <BirthTime>2006-05-04T18:13:51.0</BirthTime>
+            <Gender>{gender}</Gender>
+        </Patient>
+        <Observations start="2021-01-01" stop="{stop}">
+        </Observations>
+    </ukrdc:PatientRecord>"""
+
+    def file_hash(time="2022-07-21T09:00:00", batch_no=1, gender=1, stop="2021-04-01"):
+        xml = xml_template.format(time=time, batch_no=batch_no, gender=gender, stop=stop)
+        return XmlPipeline(xml).content_hash
+
+    original = file_hash()
+    assert len(original) <= 50
+
+    # volatile parts of the file shouldn't change the hash
+    assert file_hash(time="2023-01-01T00:00:00") == original
+    assert file_hash(batch_no=2) == original
+    assert file_hash(stop="2022-01-01") == original
+
+    # whitespace and comments shouldn't either
+    xml = xml_template.format(time="2022", batch_no=1, gender=1, stop="2021")
+    reformatted = xml.replace("\r\n", "\n").replace("        ", "  ")
+    reformatted = reformatted.replace("</Patient>", "</Patient><!-- comment -->")
+    assert XmlPipeline(reformatted).content_hash == original
+
+    # but changes to the content should
+    assert file_hash(gender=2) != original
+
+    # attributes and text which read the same are told apart
+    attribute = XmlPipeline(xml.replace("<Gender>1</Gender>", '<Gender sex="1"/>'))
+    text = XmlPipeline(xml.replace("<Gender>1</Gender>", "<Gender>sex=1</Gender>"))
+    assert attribute.content_hash != text.content_hash
+
+    # the decoded model is hashed as xsdata renders it, which is consistent
+    # but kept apart from the hash of the raw file
+    xml_object = load_xml_from_str(xml)
+    assert hash_xml(xml_object) == hash_xml(load_xml_from_str(xml))
+    assert is_rendered_hash(hash_xml(xml_object))
+    assert not is_rendered_hash(original) and not is_legacy_hash(original)
@@ -0,0 +1,134 @@
+"""
+Checks that the queries made while matching a file are covered by indexes.
+The tables are seeded with enough rows that the planner won't scan them and
+the plan of every select made by the matching functions is checked for
+sequential scans.
+"""
+
+import datetime as dt
+
+import pytest
+import ukrdc_sqla.ukrdc as sqla
+from sqlalchemy import event, insert, text
+from sqlalchemy.orm import Session
+
+from ukrdc_cupid.core.investigate.create_investigation import get_patients
+from ukrdc_cupid.core.investigate.models import Issue, LinkPatientToIssue, PatientID
+from ukrdc_cupid.core.match.identify import match_feed
+from ukrdc_cupid.core.store.insert import find_identical_record
+from ukrdc_cupid.core.utils import sequential_scans
+
+PATIENTS = 20000
+SENDING_FACILITY = "PLANS"
+SENDING_EXTRACT = "UKRDC"
+TEST_N = PATIENTS // 2
+
+
+def seed(session: Session):
+    now = dt.datetime.now()
+    pids = [str(n) for n in range(PATIENTS)]
+    session.execute(
+        insert(sqla.PatientRecord),
+        [
+            {
+                "pid": pid,
+                "ukrdcid": f"U{pid}",
+                "sendingfacility": SENDING_FACILITY,
+                "sendingextract": SENDING_EXTRACT,
+                "localpatientid": f"MRN{pid}",
+                "channelid": f"hash{pid}",
+                "repositorycreationdate": now,
+                "repositoryupdatedate": now,
+            }
+            for pid in pids
+        ],
+    )
+    session.execute(insert(sqla.Patient), [{"pid": pid} for pid in pids])
+    session.execute(
+        insert(sqla.PatientNumber),
+        [
+            row
+            for pid in pids
+            for row in (
+                {
+                    "id": f"{pid}:0",
+                    "pid": pid,
+                    "numbertype": "MRN",
+                    "patientid": f"MRN{pid}",
+                    "organization": SENDING_FACILITY,
+                },
+                {
+                    "id": f"{pid}:1",
+                    "pid": pid,
+                    "numbertype": "NI",
+                    "patientid": f"NHS{pid}",
+                    "organization": "NHS",
+                },
+            )
+        ],
+    )
+    session.execute(
+        insert(PatientID),
+        [
+            {"id": n + 1, "pid": pid, "ukrdcid": f"U{pid}"}
+            for n, pid in enumerate(pids)
+        ],
+    )
+    session.execute(
+        insert(Issue),
+        [{"id": n + 1, "date_created": now} for n in range(PATIENTS)],
+    )
+    session.execute(
+        insert(LinkPatientToIssue),
+        [{"patient_id": n + 1, "issue_id": n + 1} for n in range(PATIENTS)],
+    )
+    session.commit()
+    session.execute(text("ANALYZE"))
+
+
+def capture_selects():
+    selects = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            selects.append((statement, parameters))
+
+    return selects, record
+
+
+@pytest.fixture(scope="function")
+def seeded_session(ukrdc_test_session: Session):
+    seed(ukrdc_test_session)
+    return ukrdc_test_session
+
+
+def test_matching_query_plans(seeded_session: Session):
+    pid = str(TEST_N)
+    patient_info = {
+        "sending_facility": SENDING_FACILITY,
+        "sending_extract": SENDING_EXTRACT,
+        "MRN": (f"MRN{pid}", SENDING_FACILITY),
+        "NI": [(f"NHS{pid}", "NHS")],
+    }
+
+    engine = seeded_session.get_bind()
+    selects, record = capture_selects()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        metadata = {
+            "sending_facility": SENDING_FACILITY,
+            "sending_extract": SENDING_EXTRACT,
+        }
+        assert find_identical_record(seeded_session, f"hash{pid}", metadata) == pid
+        assert match_feed(seeded_session, patient_info).mrn == [(pid, f"U{pid}")]
+
+        # investigations are looked up by patient and by issue
+        (patient,) = get_patients(seeded_session, [(pid, f"U{pid}")])
+        assert len(patient.issues) == 1
+        assert len(patient.issues[0].patients) == 1
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    assert len(selects) >= 5
+    for statement, parameters in selects:
+        assert sequential_scans(seeded_session, statement, parameters) == {}, statement
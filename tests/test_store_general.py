@@ -2,11 +2,32 @@
 import os
 import copy
 import datetime as dt
+from types import SimpleNamespace
 
-from ukrdc_cupid.core.parse.utils import load_xml_from_path
-from ukrdc_cupid.core.store.insert import insert_incoming_data
+from ukrdc_cupid.core.parse.utils import (
+    XmlPipeline,
+    is_rendered_hash,
+    load_xml_from_path,
+    load_xml_from_str,
+)
+from ukrdc_cupid.core.store.insert import insert_incoming_data, process_file
+from ukrdc_cupid.core.store.delete import primary_key
+from ukrdc_cupid.core.store.keygen import (
+    content_digest,
+    content_rekey,
+    deduplicate_keys,
+    generate_content_key,
+)
+from ukrdc_cupid.core.store.models.patient import Address, PatientNumber
+from ukrdc_cupid.core.store.models.relationships import ProgramMembership
+from ukrdc_cupid.core.store.models.structure import RecordStatus
 
-from xsdata.models.datatype import XmlDateTime
+import ukrdc_sqla.ukrdc as sqla
+import ukrdc_xsdata.ukrdc as xsd_ukrdc  # type: ignore
+import ukrdc_xsdata.ukrdc.program_memberships as xsd_program_memberships  # type: ignore
+import ukrdc_xsdata.ukrdc.types as xsd_types  # type: ignore
+from sqlalchemy import event, select
+from xsdata.models.datatype import XmlDate, XmlDateTime
 
 TEST_PID = "314159"
 TEST_UKRDCID = "299792458"
@@ -107,4 +128,269 @@ def test_churn(ukrdc_test_session):
     
     assert not status.new_records
     assert status.deleted_records == 1
-    assert status.unchanged_records == 17      
\ No newline at end of file
+    assert status.unchanged_records == 17
+
+
+def test_new_patient_bulk_insert(ukrdc_test_session):
+    # records of a new patient are written directly rather than through the
+    # session so check they all make it to the database
+    xml_path = os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
+    xml_test = load_xml_from_path(xml_path)
+    status = insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_test,
+        is_new=True
+    )
+
+    new_records = status.patient_record.get_new_records()
+    assert len(new_records) == status.new_records
+
+    for orm_object in new_records:
+        orm_model = type(orm_object)
+        key = getattr(orm_object, primary_key(orm_model).key)
+        assert ukrdc_test_session.get(orm_model, key) is not None
+
+
+def test_bulk_write_mode(ukrdc_test_session):
+    # modified records of an existing patient are written with upserts
+    xml_path = os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
+    xml_test = load_xml_from_path(xml_path)
+    insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_test,
+        is_new=True
+    )
+
+    xml_modified = copy.deepcopy(xml_test)
+    xml_modified.observations.observation[0].observation_value = "999"
+    status = insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_modified,
+        is_new=False,
+        bulk_write=True,
+    )
+    assert status.modified_records == 1
+    assert not status.new_records
+
+    observation = status.patient_record.get_orm_list(
+        statuses=[RecordStatus.MODIFIED]
+    )[0][RecordStatus.MODIFIED][0]
+    assert not ukrdc_test_session.is_modified(observation)
+
+    ukrdc_test_session.expire_all()
+    assert observation.observationvalue == "999"
+
+
+def test_single_flush(ukrdc_test_session):
+    # the changes from a file should be written in a single flush on commit
+    # rather than being spread across the mapping by autoflush
+    xml_path = os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
+    xml_test = load_xml_from_path(xml_path)
+    insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_test,
+        is_new=True
+    )
+
+    flushes = []
+
+    def count_flush(session, flush_context):
+        flushes.append(flush_context)
+
+    event.listen(ukrdc_test_session, "after_flush", count_flush)
+
+    xml_modified = copy.deepcopy(xml_test)
+    xml_modified.observations.observation[0].observation_value = "999"
+    del xml_modified.observations.observation[1]
+    status = insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_modified,
+        is_new=False,
+    )
+    event.remove(ukrdc_test_session, "after_flush", count_flush)
+
+    assert status.modified_records == 1
+    assert status.deleted_records == 1
+    assert len(flushes) == 1
+
+
+def test_skip_unchanged_sections(ukrdc_test_session):
+    # only the sections which differ from the last file are mapped but the
+    # records of the others are still reported as unchanged
+    xml_path = os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
+    xml_test = load_xml_from_path(xml_path)
+    insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_test,
+        is_new=True,
+        skip_unchanged_sections=True,
+    )
+
+    xml_modified = copy.deepcopy(xml_test)
+    xml_modified.observations.observation[0].observation_value = "999"
+    status = insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_modified,
+        is_new=False,
+        skip_unchanged_sections=True,
+    )
+    skipped = status.patient_record.skipped_sections
+    assert "Patient" in skipped
+    assert "Observations" not in skipped
+    assert status.modified_records == 1
+    assert status.unchanged_records == 17
+
+    # clearing the stored hash forces the whole file through again
+    status.patient_record.orm_object.channelid = None
+    ukrdc_test_session.commit()
+    status = insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_modified,
+        is_new=False,
+        skip_unchanged_sections=True,
+    )
+    assert not status.patient_record.skipped_sections
+    assert status.unchanged_records == 18
+
+
+def test_deduplicate_keys():
+    keys = ["1:100:DIA:0"] * 3 + ["1:100:SYS:0", "1:100:DIA:1", "1:100:DIA:0"]
+    assert deduplicate_keys(keys) == [
+        "1:100:DIA:0",
+        "1:100:DIA:1",
+        "1:100:DIA:2",
+        "1:100:SYS:0",
+        "1:100:DIA:3",
+        "1:100:DIA:4",
+    ]
+
+
+def test_content_keys(ukrdc_test_session):
+    # dropping a record keyed by content leaves the keys of the rest alone
+    xml_path = os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
+    xml_test = load_xml_from_path(xml_path)
+    insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_test,
+        is_new=True,
+        content_keys=True,
+    )
+
+    xml_modified = copy.deepcopy(xml_test)
+    del xml_modified.patient.patient_numbers.patient_number[0]
+    status = insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_modified,
+        is_new=False,
+        content_keys=True,
+    )
+    assert status.modified_records == 0
+    assert status.deleted_records == 1
+
+
+def test_content_rekey():
+    # stored rows get the keys the xml would give them, identical records
+    # are numbered in order
+    number = SimpleNamespace(number="111", organization="NHS", number_type="NI")
+    digest = content_digest(number, PatientNumber.key_fields)
+    rows = [
+        SimpleNamespace(
+            pid="1", id=f"1:{idx}", patientid="111", organization="NHS", numbertype="NI"
+        )
+        for idx in range(2)
+    ]
+    assert content_rekey(rows, PatientNumber.key_fields) == [
+        ("1:0", generate_content_key("1", digest, 0), 0),
+        ("1:1", generate_content_key("1", digest, 1), 1),
+    ]
+    assert content_rekey(rows[1:], PatientNumber.key_fields)[0][1] == (
+        generate_content_key("1", digest, 0)
+    )
+
+
+def test_content_rekey_stored_rows(ukrdc_test_session):
+    # rows stored with content keys, including those keyed on date columns,
+    # rekey to the keys they already have
+    xml_path = os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
+    xml_test = load_xml_from_path(xml_path)
+    xml_test.patient.addresses = xsd_ukrdc.Patient.Addresses(
+        address=[
+            xsd_types.Address(
+                from_time=XmlDate(2020, 1, 1), street="1 Street", postcode="AB1 2CD"
+            )
+        ]
+    )
+    xml_test.program_memberships = xsd_ukrdc.PatientRecord.ProgramMemberships(
+        program_membership=[
+            xsd_program_memberships.ProgramMembership(
+                program_name="TRANSPLANT", from_time=XmlDate(2020, 1, 1)
+            )
+        ]
+    )
+    insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        xml_test,
+        is_new=True,
+        content_keys=True,
+    )
+
+    for node, orm_model in (
+        (PatientNumber, sqla.PatientNumber),
+        (Address, sqla.Address),
+        (ProgramMembership, sqla.ProgramMembership),
+    ):
+        rows = ukrdc_test_session.scalars(
+            select(orm_model)
+            .where(orm_model.pid == TEST_PID)
+            .order_by(orm_model.id)
+        ).all()
+        assert rows, orm_model
+        assert content_rekey(rows, node.key_fields) == [], orm_model
+
+
+def test_resent_after_direct_insert(ukrdc_test_session):
+    # a file written without its raw hash gets it the first time it is sent
+    # raw, from then on resends of it skip matching
+    xml_path = os.path.join("tests", "xml_files", "store_tests", "test_2.xml")
+    with open(xml_path, "r", encoding="utf-8") as file:
+        xml_body = file.read()
+    insert_incoming_data(
+        ukrdc_test_session,
+        TEST_PID,
+        TEST_UKRDCID,
+        load_xml_from_str(xml_body),
+        is_new=True,
+    )
+    patient_record = ukrdc_test_session.get(sqla.PatientRecord, TEST_PID)
+    assert is_rendered_hash(patient_record.channelid)
+
+    process_file(xml_body, ukrdc_test_session)
+    ukrdc_test_session.expire_all()
+    patient_record = ukrdc_test_session.get(sqla.PatientRecord, TEST_PID)
+    assert patient_record.channelid == XmlPipeline(xml_body).content_hash
+
+    msg = process_file(xml_body, ukrdc_test_session)
+    assert msg.startswith("Incoming file matched hash for last inserted file")
+    assert f"pid = {TEST_PID}" in msg
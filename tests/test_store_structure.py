@@ -1,10 +1,18 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 
 import pytest
 import ukrdc_sqla.ukrdc as sqla
 import ukrdc_xsdata.ukrdc as xsd_ukrdc
+import ukrdc_xsdata.ukrdc.observations as xsd_observations
 import ukrdc_xsdata.ukrdc.types as xsd_types
 from sqlalchemy.orm import Session
+from ukrdc_cupid.core.store.models.changes import (
+    ChangeLog,
+    compare,
+    recording_changes,
+)
+from ukrdc_cupid.core.store.models.fields import Code, Item, to_datetime
 from ukrdc_cupid.core.store.models.structure import Node, RecordStatus
 from xsdata.models.datatype import XmlDateTime
 
@@ -41,6 +49,23 @@ class PatientNumber(Node):
         self.add_item("numbertype", self.xml.number_type)
 
 
+class Observation(Node):
+    fields = (
+        Item("observationtime", "observation_time", to_datetime, optional=False),
+        Code("observationcode", "observationcodestd", "observationdesc", "observation_code"),
+        Item("observationvalue", "observation_value"),
+    )
+
+    def __init__(self, xml: xsd_observations.Observation):
+        super().__init__(xml, sqla.Observation)
+
+    def sqla_mapped() -> str:
+        return "observations"
+
+    def map_xml_to_orm(self, _) -> None:
+        self.map_fields()
+
+
 # set up patient node
 @pytest.fixture(scope="function")
 def patient_node():
@@ -118,6 +143,139 @@ def test_add_item(patient_node: Node):
 
 
 
+def test_map_fields():
+    xml = xsd_observations.Observation(
+        observation_time=XmlDateTime.from_string("2021-01-01T12:00:00+01:00"),
+        observation_code=xsd_types.CodedField(
+            code="DIA", coding_standard="UKRR", description="Diastolic BP"
+        ),
+        observation_value="80",
+    )
+    node = Observation(xml)
+    node.orm_object = sqla.Observation(id="test")
+    node.status = RecordStatus.NEW
+    node.map_xml_to_orm(None)
+
+    orm_object = node.orm_object
+    assert orm_object.observationtime == datetime(2021, 1, 1, 11)
+    assert orm_object.observationcode == "DIA"
+    assert orm_object.observationcodestd == "UKRR"
+    assert orm_object.observationdesc == "Diastolic BP"
+    assert orm_object.observationvalue == "80"
+
+    # mapping the same values again leaves the record unchanged
+    node.status = RecordStatus.UNCHANGED
+    node.map_xml_to_orm(None)
+    assert node.status == RecordStatus.UNCHANGED
+
+    # a missing code is blanked
+    xml.observation_code = None
+    node.map_xml_to_orm(None)
+    assert node.status == RecordStatus.MODIFIED
+    assert orm_object.observationcode is None
+    assert orm_object.observationdesc is None
+
+    xml.observation_time = None
+    with pytest.raises(ValueError):
+        node.map_xml_to_orm(None)
+
+
+@pytest.mark.parametrize(
+    "value, persisted, changed, reason",
+    [
+        ("", None, False, "empty"),
+        (None, "", False, "empty"),
+        ("1.0", Decimal("1.00"), False, "decimal"),
+        (1.5, Decimal("1.50"), False, "decimal"),
+        ("false", False, False, "boolean"),
+        ("false", True, True, "changed"),
+        ("N/A", True, True, "changed"),
+        ("N/A", False, True, "changed"),
+        (
+            datetime(2021, 1, 1, 12, tzinfo=timezone(timedelta(hours=1))),
+            datetime(2021, 1, 1, 11),
+            False,
+            "timezone",
+        ),
+        (5, "5", False, "type"),
+        ("6", "5", True, "changed"),
+        (None, "5", True, "cleared"),
+        ("5", None, True, "set"),
+    ],
+)
+def test_compare(value, persisted, changed, reason):
+    comparison = compare(value, persisted)
+    assert comparison.changed == changed
+    assert comparison.reason == reason
+
+
+def test_new_record_keeps_empty_strings():
+    # new records store "" as sent, as they did before the comparators
+    xml = xsd_observations.Observation(
+        observation_time=XmlDateTime.from_string("2021-01-01T12:00:00"),
+        observation_code=xsd_types.CodedField(code=""),
+        observation_value="",
+    )
+    node = Observation(xml)
+    node.orm_object = sqla.Observation(id="test")
+    node.status = RecordStatus.NEW
+    node.map_xml_to_orm(None)
+    node.add_item("observationunits", "")
+
+    assert node.orm_object.observationcode == ""
+    assert node.orm_object.observationvalue == ""
+    assert node.orm_object.observationunits == ""
+
+    # and resending them doesn't modify the record
+    node.status = RecordStatus.UNCHANGED
+    node.map_xml_to_orm(None)
+    assert node.status == RecordStatus.UNCHANGED
+
+
+def test_change_log():
+    xml = xsd_observations.Observation(
+        observation_time=XmlDateTime.from_string("2021-01-01T12:00:00"),
+        observation_code=xsd_types.CodedField(code=""),
+        observation_value="80",
+    )
+    node = Observation(xml)
+    node.orm_object = sqla.Observation(
+        id="test", observationtime=datetime(2021, 1, 1, 12), observationvalue="79"
+    )
+    node.status = RecordStatus.UNCHANGED
+
+    change_log = ChangeLog()
+    with recording_changes(change_log):
+        node.map_xml_to_orm(None)
+
+    assert node.status == RecordStatus.MODIFIED
+    assert change_log.rows == {"observation": 1}
+    assert change_log.fields == {("observation", "observationvalue", "changed"): 1}
+    assert change_log.normalised == {("observation", "observationcode", "empty"): 1}
+
+
+def test_collect(patient_node: Node):
+    patient_node.status = RecordStatus.MODIFIED
+    statuses = [RecordStatus.NEW, RecordStatus.UNCHANGED, RecordStatus.NEW]
+    for n, status in enumerate(statuses):
+        child = PatientNumber(xml=None)
+        child.orm_object = sqla.PatientNumber(id=str(n))
+        child.status = status
+        patient_node.mapped_classes.append(child)
+    patient_node.mapped_classes[1].deletions.append("staged")
+
+    # objects, counts and deletions are all gathered in a single walk
+    collection = patient_node.collect([RecordStatus.NEW])
+    new = collection.orm_objects[RecordStatus.NEW]
+    assert [orm_object.id for orm_object in new] == ["0", "2"]
+    assert collection.counts == {
+        RecordStatus.NEW: 2,
+        RecordStatus.MODIFIED: 1,
+        RecordStatus.UNCHANGED: 1,
+    }
+    assert collection.deletions == ["staged"]
+
+
 @pytest.mark.parametrize("seq_no", [0, 1])
 def test_add_children(ukrdc_test_session: Session, patient_node: Node, seq_no: int):
     # test parsing of xml attributes accross a couple of levels